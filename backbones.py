@@ -0,0 +1,183 @@
+import argparse
+import queue
+import resource
+import time
+
+import torch
+import torch.multiprocessing as multiprocessing
+import torch.nn as nn
+import torch.utils.model_zoo as model_zoo
+import torchvision.models as models
+from torchvision.models.resnet import Bottleneck
+
+import params
+import small_resnet_for_cifar
+import weight_registry
+
+# configuration of VGG16 as in torchvision, 'M' is max pooling
+vgg16_configuration = [64, 64, 'M', 128, 128, 'M', 256, 256, 256, 'M', 512, 512, 512, 'M', 512, 512, 512, 'M']
+
+
+# the same layers as vgg16().features[:number_of_layers], but the layers after them are never created
+def make_vgg16_features(number_of_layers):
+    layers = []
+    in_channels = 3
+    for value in vgg16_configuration:
+        if value == 'M':
+            layers.append(nn.MaxPool2d(kernel_size=2, stride=2))
+        else:
+            layers.append(nn.Conv2d(in_channels, value, kernel_size=3, padding=1))
+            layers.append(nn.ReLU(inplace=True))
+            in_channels = value
+    return nn.Sequential(*layers[:number_of_layers])
+
+
+# pretrained weights are read from the registry, if they are not there, they are downloaded once (unless
+# params.offline_weights is set), the used subset is registered, and the next starts read only the registry
+def get_pretrained_state_dict(name, url, select):
+    if not weight_registry.contains(name):
+        if params.offline_weights:
+            raise Exception('Weights %s are not in the registry %s!' % (name, params.weight_registry_folder))
+        weight_registry.register(name, select_state_dict(model_zoo.load_url(url), select))
+    return weight_registry.load_state_dict(name)
+
+
+# tensors of the full pretrained state_dict which are used, renamed by select
+def select_state_dict(full_state_dict, select):
+    state_dict = {}
+    for tensor_name, tensor in full_state_dict.items():
+        new_name = select(tensor_name)
+        if new_name is not None:
+            state_dict[new_name] = tensor
+    return state_dict
+
+
+# weights of 'features.i' of the pretrained VGG16 for i < number_of_layers renamed to 'i'
+def select_vgg16_features(number_of_layers):
+    def select(name):
+        parts = name.split('.')
+        if parts[0] == 'features' and int(parts[1]) < number_of_layers:
+            return '.'.join(parts[1:])
+        return None
+    return select
+
+
+# the fc layer of ResNet-50 is replaced by the layer for num_classes, so its weights are not used
+def select_resnet50_trunk(name):
+    return None if name.startswith('fc.') else name
+
+
+# the selection of the tensors for the registry names 'vgg16-features-N' and 'resnet50-trunk',
+# None for other names
+def get_selection(name):
+    if name.startswith('vgg16-features-'):
+        return select_vgg16_features(int(name[len('vgg16-features-'):]))
+    if name == 'resnet50-trunk':
+        return select_resnet50_trunk
+    return None
+
+
+def create_vgg16_features(number_of_layers=29, pretrained=True):
+    network = make_vgg16_features(number_of_layers)
+    if pretrained:
+        state_dict = get_pretrained_state_dict('vgg16-features-%d' % number_of_layers, models.vgg.model_urls['vgg16'],
+                                               select_vgg16_features(number_of_layers))
+        weight_registry.assign_state_dict(network, state_dict)
+    return network
+
+
+# the last layer of the pretrained network is not used by representation learning, so it is not loaded,
+# the network is created with the final layer for num_classes and L2 - normalization at once
+def create_resnet50_for_representation(num_classes, pretrained=True):
+    network = models.resnet.ResNet(Bottleneck, [3, 4, 6, 3])
+    num_ftrs = network.fc.in_features
+    network.fc = torch.nn.Sequential()
+    network.fc.add_module('fc', nn.Linear(num_ftrs, num_classes))
+    network.fc.add_module('l2normalization',
+                          small_resnet_for_cifar.L2Normalization())  # need normalization for histogramm loss
+    if pretrained:
+        state_dict = get_pretrained_state_dict('resnet50-trunk', models.resnet.model_urls['resnet50'],
+                                               select_resnet50_trunk)
+        weight_registry.assign_state_dict(network, state_dict, not_loaded_prefixes=['fc.'])
+    return network
+
+
+##################################################################
+#
+# Startup time and resident memory of full and lean backbones
+#
+##################################################################
+
+def create_full_vgg16_features():
+    vgg = models.vgg16(pretrained=True)
+    return nn.Sequential(*list(vgg.features.children())[:29])
+
+
+def create_full_resnet50_for_representation():
+    network = models.resnet50(pretrained=True)
+    num_ftrs = network.fc.in_features
+    network.fc = torch.nn.Sequential()
+    network.fc.add_module('fc', nn.Linear(num_ftrs, params.num_classes))
+    network.fc.add_module('l2normalization', small_resnet_for_cifar.L2Normalization())
+    return network
+
+
+builders = {'vgg16-full': create_full_vgg16_features,
+            'vgg16-lean': lambda: create_vgg16_features(29),
+            'resnet50-full': create_full_resnet50_for_representation,
+            'resnet50-lean': lambda: create_resnet50_for_representation(params.num_classes)}
+
+
+def measure_builder(name, results):
+    start_time = time.time()
+    network = builders[name]()
+    startup_time = time.time() - start_time
+    # ru_maxrss is in kilobytes on linux
+    results.put((name, startup_time, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+                 sum(parameter.numel() for parameter in network.parameters())))
+
+
+# the result of the process or None if it has exited without the result
+def wait_for_result(process, results, poll_timeout=5):
+    while True:
+        try:
+            return results.get(timeout=poll_timeout)
+        except queue.Empty:
+            if not process.is_alive():
+                # the result can be put just before the exit
+                try:
+                    return results.get(timeout=1)
+                except queue.Empty:
+                    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Startup time and peak memory of full and lean backbones')
+    parser.add_argument('--builders', nargs='+', default=['vgg16-full', 'vgg16-lean', 'resnet50-full',
+                                                          'resnet50-lean'])
+    arguments = parser.parse_args()
+
+    # every builder runs in its own fresh process, so the memory of one does not count for the others
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    for name in arguments.builders:
+        # the first start of the lean builders can download and register the weights, it is not measured
+        number_of_runs = 2 if name.endswith('-lean') else 1
+        for run in range(number_of_runs):
+            process = context.Process(target=measure_builder, args=(name, results))
+            process.start()
+            result = wait_for_result(process, results)
+            process.join()
+            if result is None:
+                break
+        if result is None:
+            # e.g. the weights are not in the registry with params.offline_weights or the download has failed
+            print('%s: failed with exit code %s' % (name, process.exitcode))
+            continue
+        name, startup_time, peak_rss, number_of_parameters = result
+        print('%s: startup %f s, peak memory %f MB, %d parameters' % (name, startup_time, peak_rss,
+                                                                      number_of_parameters))
+
+
+if __name__ == '__main__':
+    main()
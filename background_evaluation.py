@@ -0,0 +1,121 @@
+import copy
+import queue
+
+import numpy as np
+import torch
+import torch.multiprocessing as multiprocessing
+import torch.utils.data as data
+
+import metric_learning_utils
+import params
+import test
+
+
+def evaluate_representation(network, test_dataset):
+    # the same evaluation as in learning.learning_process, but with the own loader of the worker
+    test_loader = data.DataLoader(test_dataset,
+                                  batch_size=params.batch_size_for_representation,
+                                  shuffle=False,
+                                  num_workers=2)
+    all_outputs_test, all_labels_test = metric_learning_utils.get_all_outputs_and_labels(test_loader, network)
+    return test.full_test_for_representation(k=params.k_for_recall,
+                                             all_outputs=all_outputs_test,
+                                             all_labels=all_labels_test)
+
+
+def evaluate_similarity(network, all_outputs_train, all_labels_train, all_outputs_test, all_labels_test):
+    # test.partial_test_for_representation waits for the input from the console after the neighbors search,
+    # so in the worker we compute the same recall with the blocked search
+    recalls = []
+    for all_outputs, all_labels in [(all_outputs_train, all_labels_train), (all_outputs_test, all_labels_test)]:
+        if torch.cuda.is_available():
+            all_outputs = all_outputs.cuda()
+        _, neighbors_lists = test.get_neighbors_lists_by_blocks(params.k_for_recall, all_outputs,
+                                                                similarity_network=network)
+        recalls.append(test.get_recall_at_k_from_neighbors_lists(neighbors_lists, all_labels.numpy()))
+    return tuple(recalls)
+
+
+def evaluation_loop(network, evaluation_function, evaluation_arguments, snapshots, results):
+    if torch.cuda.is_available():
+        network = network.cuda()
+    while True:
+        snapshot = snapshots.get()
+        if snapshot is None:
+            break
+        epoch, state_dict = snapshot
+        network.load_state_dict(state_dict)
+        network.eval()
+        print('background evaluation for epoch %d' % epoch)
+        results.put((epoch, evaluation_function(network, *evaluation_arguments)))
+
+
+class BackgroundEvaluator():
+    """Evaluates cpu snapshots of the network in a separate process while the training goes on
+    Arguments:
+        network : the network is copied to the worker once, later only its weights are sent
+        evaluation_function : module level function (network, *evaluation_arguments) -> recall
+        evaluation_arguments (tuple) : everything the evaluation needs besides the network
+        queue_size (int) : number of snapshots waiting for evaluation, if the worker is slower than
+                           the training the oldest waiting snapshot is replaced by the new one
+    """
+
+    def __init__(self, network, evaluation_function, evaluation_arguments,
+                 queue_size=params.background_evaluation_queue_size):
+        # cuda can be used in the child process only if it is spawned, not forked
+        context = multiprocessing.get_context('spawn')
+        self.snapshots = context.Queue(maxsize=queue_size)
+        self.results = context.Queue()
+        self.process = context.Process(target=evaluation_loop,
+                                       args=(copy.deepcopy(network).cpu(),
+                                             evaluation_function,
+                                             evaluation_arguments,
+                                             self.snapshots,
+                                             self.results))
+        self.process.start()
+
+    def submit(self, network, epoch):
+        state_dict = network.state_dict()
+        snapshot = (epoch, type(state_dict)((name, tensor.cpu().clone()) for name, tensor in state_dict.items()))
+        while True:
+            try:
+                self.snapshots.put_nowait(snapshot)
+                return
+            except queue.Full:
+                try:
+                    skipped_epoch, _ = self.snapshots.get_nowait()
+                    print('evaluation for epoch %d is skipped, the worker is still busy' % skipped_epoch)
+                except queue.Empty:
+                    pass
+
+    # returns the list of (epoch, recall) evaluated since the last call without waiting
+    def get_results(self):
+        results = []
+        while True:
+            try:
+                results.append(self.results.get_nowait())
+            except queue.Empty:
+                return results
+
+    # waits for all the submitted snapshots and returns their results
+    def close(self):
+        self.snapshots.put(None)
+        results = []
+        while self.process.is_alive() or not self.results.empty():
+            try:
+                results.append(self.results.get(timeout=1))
+            except queue.Empty:
+                pass
+        self.process.join()
+        return results
+
+
+def plot_recall(vis, recall_plot, results, r_recall, epochs, legend):
+    for epoch, recall_at_k in results:
+        print('background recall for epoch %d: ' % epoch, recall_at_k)
+        epochs.append(epoch)
+        r_recall.append(recall_at_k)
+    if len(results) > 0:
+        recall_plot = vis.line(Y=np.array(r_recall), X=np.array(epochs),
+                               win=recall_plot, opts=dict(legend=legend))
+    return recall_plot
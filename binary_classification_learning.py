@@ -6,15 +6,17 @@ import torch
 import visdom
 from torch.autograd import Variable
 
+import multi_label_test
 import params
 import utils
 
 
+# labels are the packed multi - hot vectors of omniglot.MultiLabels, the pair of images is positive
+# if they have at least one common label
 def get_labels_matrix(labels_list_1, labels_list_2):
-    matrix = torch.from_numpy(np.zeros((labels_list_1.shape[0], labels_list_2.shape[0])))
-    for i, labels1 in enumerate(labels_list_1):
-        for j, labels2 in enumerate(labels_list_2):
-            matrix[i, j] = int(np.in1d(labels1, labels2).any())
+    multi_hot_1 = np.unpackbits(labels_list_1.numpy(), axis=1).astype(np.float32)
+    multi_hot_2 = np.unpackbits(labels_list_2.numpy(), axis=1).astype(np.float32)
+    matrix = torch.from_numpy((multi_hot_1.dot(multi_hot_2.T) > 0).astype(np.float64))
     print('matrix ', matrix)
     return matrix
 
@@ -29,12 +31,16 @@ def binary_learning(train_loader,
     vis = visdom.Visdom()
     r_loss = []
     r_recall = []
+    r_recall_test = []
+    r_map = []
+    r_map_test = []
     iterations = []
     epochs = []
     total_iteration = 0
 
     loss_plot = vis.line(Y=np.zeros(1), X=np.zeros(1))
     recall_plot = vis.line(Y=np.zeros(1), X=np.zeros(1))
+    map_plot = vis.line(Y=np.zeros(1), X=np.zeros(1))
 
     for epoch in range(start_epoch, params.number_of_epochs_for_metric_learning):
         lr_scheduler.step(epoch=epoch)
@@ -81,15 +87,29 @@ def binary_learning(train_loader,
             gc.collect()
 
             print('Evaluation on train internal')
-            recall_at_k = 0.0
+            recall_at_k, mean_average_precision = multi_label_test.test_for_multi_label_similarity(
+                train_loader.dataset, network, params.k_for_recall,
+                number_of_images=params.number_of_images_for_multi_label_evaluation)
             r_recall.append(recall_at_k)
-            options = dict(legend=['recall'])
-            recall_plot = vis.line(Y=np.array(r_recall), X=np.array(epochs),
-                                 # , update='append',
-                                 win=recall_plot, opts=options)
+            r_map.append(mean_average_precision)
 
             print('Evaluation on test internal')
-            recall_at_k = 0.0
+            recall_at_k, mean_average_precision = multi_label_test.test_for_multi_label_similarity(
+                test_loader.dataset, network, params.k_for_recall,
+                number_of_images=params.number_of_images_for_multi_label_evaluation)
+            r_recall_test.append(recall_at_k)
+            r_map_test.append(mean_average_precision)
+
+            options = dict(legend=['recall train', 'recall test'])
+            recall_plot = vis.line(Y=np.column_stack((np.array(r_recall), np.array(r_recall_test))),
+                                   X=np.column_stack((np.array(epochs), np.array(epochs))),
+                                   # , update='append',
+                                   win=recall_plot, opts=options)
+            options = dict(legend=['mAP train', 'mAP test'])
+            map_plot = vis.line(Y=np.column_stack((np.array(r_map), np.array(r_map_test))),
+                                X=np.column_stack((np.array(epochs), np.array(epochs))),
+                                win=map_plot, opts=options)
+            gc.collect()
 
             utils.save_checkpoint(network=network,
                                  optimizer=optimizer,
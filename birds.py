@@ -1,11 +1,14 @@
 import numpy as np
 import torch.utils.data as data
 import torchvision.transforms as transforms
-from PIL import Image
 from torch.utils.data import Dataset
 from torch.utils.data.sampler import BatchSampler
 
+import compact_tables
+import image_cache
+import image_decoding
 import params
+import records
 from sampling import UniformSampler
 
 
@@ -29,7 +32,7 @@ def get_filenames_and_labels(data_folder, test_or_train='test'):
             train_labels.append(label)
         if test_or_train == 'test' and label > 100:
             test_labels.append(label)
-    images_labels = np.array(images_labels)
+    images_labels = compact_tables.create_label_table(images_labels)
 
     print('images_labels.shape ', images_labels.shape)
     for x in lines_i:
@@ -49,8 +52,12 @@ def get_filenames_and_labels(data_folder, test_or_train='test'):
     f_l.close()
 
     images_indices = np.array(images_indices)
-    train_images = np.array(train_images)
-    test_images = np.array(test_images)
+    # paths are kept in one buffer and labels in flat arrays, so the forked workers of the loader share them
+    images_paths = compact_tables.PathTable(images_paths)
+    train_images = compact_tables.PathTable(train_images)
+    train_labels = compact_tables.create_label_table(train_labels)
+    test_images = compact_tables.PathTable(test_images)
+    test_labels = compact_tables.create_label_table(test_labels)
 
     return images_indices, images_labels, images_paths, train_images, train_labels, test_images, test_labels
 
@@ -73,6 +80,15 @@ class BIRDS100(Dataset):
                                                     test_or_train=test_or_train)
 
         print('self.images_labels ', self.images_labels)
+        # images smaller than this after the transformation are reported in __getitem__
+        self.minimum_image_size = params.initial_image_size
+        paths = self.train_images if self.train else self.test_images
+        self.image_cache = None
+        if params.use_image_cache:
+            self.image_cache = image_cache.open_image_cache(list(paths))
+        self.records = None
+        if params.use_records:
+            self.records = records.open_records(list(paths))
 
     def __len__(self):
         if self.train:
@@ -80,25 +96,27 @@ class BIRDS100(Dataset):
         else:
             return len(self.test_images)
 
+    # decoded image from the cache is not larger than the scale size, transforms.Scale upscales only small ones
+    def open_image(self, index):
+        if self.image_cache is not None:
+            return self.image_cache.get_image(index)
+        if self.records is not None:
+            return self.records.get_image(index)
+        if self.train:
+            return image_decoding.open_image(self.train_images[index])
+        else:
+            return image_decoding.open_image(self.test_images[index])
+
     def __getitem__(self, index):
-        transform_for_correction = transforms.Compose([
-            transforms.ToPILImage(),
-        ])
+        # images are already RGB, grayscale ones are converted once when they are opened
         if self.train:
-            image = self.transform(Image.open(self.train_images[index]))
+            image = self.transform(self.open_image(index))
             label = self.train_labels[index]
         else:
-            image = self.transform(Image.open(self.test_images[index]))
+            image = self.transform(self.open_image(index))
             label = self.test_labels[index]
 
-        if image.shape[0] == 1:
-            # print('Grayscale image is found! ', self.images_paths[index])
-            image = transform_for_correction(image)
-            image = transforms.ImageOps.colorize(image, (0, 0, 0), (255, 255, 255))
-            image = self.transform(image)
-            # print('new image.shape ', image.shape)
-
-        if image.shape[1] < params.initial_image_size or image.shape[2] < params.initial_image_size:
+        if image.shape[1] < self.minimum_image_size or image.shape[2] < self.minimum_image_size:
             print('image is too small', image.shape)
 
         return image, label
@@ -152,7 +170,8 @@ def download_BIRDS_for_classification(data_folder):
 
     train_loader_for_classification = data.DataLoader(train_dataset_for_classification,
                                                       batch_size=params.batch_size_for_classification,
-                                                      shuffle=True,
+                                                      sampler=records.create_shuffling_sampler(
+                                                          train_dataset_for_classification),
                                                       num_workers=2)
     test_loader_for_classification = data.DataLoader(train_dataset_for_classification,  # here for preclassification
                                                      # we just take train and test sets the same
@@ -196,8 +215,9 @@ def download_BIRDS_for_representation(data_folder):
 
                                   drop_last=True, # we need to drop last batch because it can had length less than k
                                   # and we won't be able to calculate recall at k
-                                  shuffle=True, # shuffle is extremely importatnt here because we take 10 neighbors
+                                  # shuffle is extremely importatnt here because we take 10 neighbors
                                   # out of 16 images in the batch
+                                  sampler=records.create_shuffling_sampler(new_test_dataset),
                                   num_workers=2)
 
     print('new_train_dataset ', new_train_dataset.__len__())
@@ -0,0 +1,157 @@
+import argparse
+import time
+
+import numpy as np
+import torch
+import torch.utils.data as data
+import torchvision.transforms as transforms
+from PIL import Image
+from torch.autograd import Variable
+from torch.utils.data import Dataset
+from torch.utils.data.sampler import Sampler
+
+import UKB
+import params
+import spoc
+import test
+
+
+# the size of the image after the resize: the longer side becomes max_side and both sides are rounded to
+# the multiple of step, all images with the same size go to the same bucket
+def get_bucket_size(width, height, max_side=None, step=None):
+    if max_side is None:
+        max_side = params.max_side_for_buckets
+    if step is None:
+        step = params.step_for_buckets
+    scale = float(max_side) / max(width, height)
+    return max(step, int(round(width * scale / step)) * step), max(step, int(round(height * scale / step)) * step)
+
+
+def get_images_sizes(paths):
+    # only the header of the image is read to get its size
+    sizes = []
+    for path in paths:
+        with Image.open(path) as image:
+            sizes.append(image.size)
+    return np.array(sizes, dtype=np.int64).reshape(-1, 2)
+
+
+class BucketedImages(Dataset):
+    """Images resized to the size of their bucket without cropping, returns (image, label, index)
+    Arguments:
+        paths (PathTable) : paths of the images
+        labels (array of int64) : labels of the images
+    """
+
+    def __init__(self, paths, labels):
+        self.paths = paths
+        self.labels = labels
+        sizes = get_images_sizes(paths)
+        self.buckets_sizes = np.array([get_bucket_size(width, height) for width, height in sizes],
+                                      dtype=np.int64).reshape(-1, 2)
+        self.to_tensor = transforms.ToTensor()
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, index):
+        width, height = self.buckets_sizes[index]
+        image = Image.open(self.paths[index]).convert('RGB').resize((int(width), int(height)), Image.BILINEAR)
+        return self.to_tensor(image), self.labels[index], index
+
+
+def create_bucketed_images(dataset):
+    if dataset.train:
+        return BucketedImages(dataset.train_images, dataset.train_labels)
+    else:
+        return BucketedImages(dataset.test_images, dataset.test_labels)
+
+
+# the order of the images: by buckets, in every bucket by index, so the order is the same for every run
+def get_order_of_images(dataset):
+    keys = dataset.buckets_sizes[:, 0] * (dataset.buckets_sizes[:, 1].max() + 1) + dataset.buckets_sizes[:, 1]
+    return np.lexsort((np.arange(len(dataset)), keys))
+
+
+class BucketBatchSampler(Sampler):
+    """Batches of images from the same bucket in the deterministic order
+    Arguments:
+        dataset (BucketedImages) : images with their buckets
+        max_pixels_in_batch (int) : batches of large images contain fewer images
+        start (int) : number of images in the order which are already done and are skipped
+    """
+
+    def __init__(self, dataset, max_pixels_in_batch=None, start=0):
+        if max_pixels_in_batch is None:
+            max_pixels_in_batch = params.max_pixels_in_batch_for_buckets
+        self.batches = []
+        order = get_order_of_images(dataset)[start:]
+        batch = []
+        for index in order:
+            width, height = dataset.buckets_sizes[index]
+            if len(batch) > 0 and ((dataset.buckets_sizes[batch[0]] != (width, height)).any() or
+                                   (len(batch) + 1) * width * height > max_pixels_in_batch):
+                self.batches.append(batch)
+                batch = []
+            batch.append(int(index))
+        if len(batch) > 0:
+            self.batches.append(batch)
+
+    def __iter__(self):
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
+
+
+def create_bucket_loader(dataset, start=0):
+    return data.DataLoader(dataset, batch_sampler=BucketBatchSampler(dataset, start=start),
+                           num_workers=params.number_of_workers_for_spoc_extraction)
+
+
+##################################################################
+#
+# Images per second of the current loader and the bucket loader
+#
+##################################################################
+
+def extract_spocs_with_loader(loader, network, number_of_images):
+    all_spocs = []
+    all_labels = []
+    number_of_done_images = 0
+    start_time = time.time()
+    for batch in loader:
+        images, labels = batch[0], batch[1]
+        outputs = network(Variable(images, volatile=True).cuda())
+        all_spocs.append(spoc.compute_spoc_by_outputs(outputs, 'test').data)
+        all_labels.append(labels)
+        number_of_done_images = number_of_done_images + images.size(0)
+        if number_of_done_images >= number_of_images:
+            break
+    # the time includes the wait for the last batch on GPU
+    torch.cuda.synchronize()
+    images_per_second = number_of_done_images / (time.time() - start_time)
+    return torch.cat(all_spocs, dim=0), torch.cat(all_labels, dim=0), images_per_second
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare SPoC extraction with the current and the bucket loader')
+    parser.add_argument('--data-folder', default='ukbench/full')
+    parser.add_argument('--images', type=int, default=1000000, help='maximum number of images for every loader')
+    arguments = parser.parse_args()
+
+    _, test_loader = UKB.download_UKB_for_representation(data_folder=arguments.data_folder)
+    network = spoc.create_representation_network()
+    current_loader = data.DataLoader(test_loader.dataset, batch_size=params.batch_size_for_spoc_extraction,
+                                     shuffle=False, num_workers=params.number_of_workers_for_spoc_extraction)
+    bucket_loader = create_bucket_loader(create_bucketed_images(test_loader.dataset))
+    print('%d buckets' % np.unique(bucket_loader.dataset.buckets_sizes, axis=0).shape[0])
+
+    for name, loader in [('current', current_loader), ('buckets', bucket_loader)]:
+        all_spocs, all_labels, images_per_second = extract_spocs_with_loader(loader, network, arguments.images)
+        print('%s loader: %f images/s' % (name, images_per_second))
+        test.full_test_for_representation(k=params.k_for_recall, all_outputs=all_spocs, all_labels=all_labels)
+
+
+if __name__ == '__main__':
+    main()
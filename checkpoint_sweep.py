@@ -0,0 +1,128 @@
+import argparse
+import copy
+import glob
+import re
+import time
+
+import torch
+import torch.multiprocessing as multiprocessing
+from torch.autograd import Variable
+
+import params
+import spoc
+import similarity_network_effective
+import test
+
+# the state every worker gets once at start: outputs, labels and the network to load the checkpoints into
+worker_state = {}
+
+
+def get_epoch_and_stage_from_checkpoint_name(checkpoint_name):
+    # checkpoints of the similarity network are saved as prefix-epoch-stage[loss_function_name]
+    match = re.search(r'-(\d+)-(\d+)([a-z]*)$', checkpoint_name)
+    if match is not None:
+        return int(match.group(1)), int(match.group(2))
+    match = re.search(r'-(\d+)$', checkpoint_name)
+    if match is not None:
+        return int(match.group(1)), None
+    return None, None
+
+
+def initialize_worker(all_outputs, all_labels, network_template, ks, number_of_threads):
+    torch.set_num_threads(number_of_threads)
+    worker_state['all_outputs'] = all_outputs
+    worker_state['all_labels'] = all_labels
+    worker_state['network_template'] = network_template
+    worker_state['ks'] = ks
+
+
+def evaluate_checkpoint(checkpoint_name):
+    start_time = time.time()
+    similarity_network = copy.deepcopy(worker_state['network_template'])
+    checkpoint = torch.load(checkpoint_name, map_location=lambda storage, location: storage)
+    similarity_network.load_state_dict(checkpoint['state_dict'])
+    similarity_network.eval()
+
+    # fc1 and fc2 of the AllPairs layer with the weights of its fc3 are applied to every item once,
+    # the pairs only add the projections
+    all_outputs = Variable(worker_state['all_outputs'], volatile=True)
+    projected_gallery = similarity_network.fc1.project_first(all_outputs)
+    projected_queries = similarity_network.fc1.project_second(all_outputs)
+
+    ks = worker_state['ks']
+    _, neighbors_lists = test.get_top_k_from_projections(projected_queries, projected_gallery,
+                                                         similarity_network, max(ks),
+                                                         largest=params.distance_type == 'cosine')
+    # the neighbors are sorted from the best, so recall at smaller k is computed from the first columns
+    recalls = [test.get_recall_at_k_from_neighbors_lists(neighbors_lists[:, :k], worker_state['all_labels'])
+               for k in ks]
+    return checkpoint_name, recalls, time.time() - start_time
+
+
+def sweep_checkpoints(checkpoints_names, all_outputs, all_labels, ks, number_of_workers, number_of_input_features):
+    # network is created on the main process only once, workers get its copy and load the checkpoints into it
+    network_template = similarity_network_effective.EffectiveSimilarityNetwork(
+        number_of_input_features=number_of_input_features, l1_initialization=False).cpu()
+    network_template.share_memory()
+    all_outputs = all_outputs.cpu().share_memory_()
+    all_labels = all_labels.cpu().numpy()
+
+    results = []
+    context = multiprocessing.get_context('fork')
+    pool = context.Pool(processes=number_of_workers,
+                        initializer=initialize_worker,
+                        initargs=(all_outputs, all_labels, network_template, ks,
+                                  params.number_of_threads_per_evaluation_worker))
+    try:
+        for checkpoint_name, recalls, elapsed_time in pool.imap_unordered(evaluate_checkpoint, checkpoints_names):
+            print('evaluated ', checkpoint_name, ' in %f s' % elapsed_time)
+            epoch, stage = get_epoch_and_stage_from_checkpoint_name(checkpoint_name)
+            results.append((epoch, stage, checkpoint_name, recalls))
+    finally:
+        pool.close()
+        pool.join()
+
+    results.sort(key=lambda result: (result[1] is None, result[1], result[0] is None, result[0], result[2]))
+    return results
+
+
+def print_results_table(results, ks, file=None):
+    header = ['epoch', 'stage'] + ['recall@%d' % k for k in ks] + ['checkpoint']
+    lines = ['\t'.join(header)]
+    for epoch, stage, checkpoint_name, recalls in results:
+        lines.append('\t'.join([str(epoch), str(stage)] + ['%f' % recall for recall in recalls] + [checkpoint_name]))
+    table = '\n'.join(lines)
+    print(table)
+    if file is not None:
+        with open(file, 'w') as fout:
+            fout.write(table + '\n')
+
+    best = max(results, key=lambda result: result[3][0])
+    print('best recall@%d = %f for epoch %s stage %s' % (ks[0], best[3][0], best[0], best[1]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Evaluate all the checkpoints of the similarity network')
+    parser.add_argument('checkpoints', help='glob for checkpoints, for example "similarity-model-*-1"')
+    parser.add_argument('--outputs', default='all_spocs_file_test_after_pca')
+    parser.add_argument('--labels', default='all_labels_file_test')
+    parser.add_argument('--k', type=int, nargs='+', default=[params.k_for_recall])
+    parser.add_argument('--workers', type=int, default=params.number_of_workers_for_evaluation)
+    parser.add_argument('--table', default=None, help='file to save the table of results')
+    arguments = parser.parse_args()
+
+    checkpoints_names = sorted(glob.glob(arguments.checkpoints))
+    print('found %d checkpoints' % len(checkpoints_names))
+    if len(checkpoints_names) == 0:
+        return
+
+    # outputs and labels are read only once for all the checkpoints
+    all_outputs, all_labels = spoc.read_spocs_and_labels(arguments.outputs, arguments.labels)
+    results = sweep_checkpoints(checkpoints_names, all_outputs, all_labels, arguments.k,
+                                number_of_workers=arguments.workers,
+                                number_of_input_features=all_outputs.size(1))
+    print_results_table(results, arguments.k, file=arguments.table)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+import argparse
+import os
+
+import numpy as np
+import torch.utils.data as data
+from torch.utils.data import Dataset
+
+import UKB
+import birds
+import omniglot
+
+
+class PathTable(object):
+    """Paths of the images as one bytes buffer with offsets
+    Arguments:
+        paths (list of strings) : paths of the images
+    The workers of the loader are forked, a list of strings or an object array is a Python object per path,
+    and reading a path changes its reference count, so every worker gets its own copy of the pages it reads.
+    The buffer and the offsets are two arrays whose pages are only read, so they stay shared by all workers.
+    """
+
+    def __init__(self, paths):
+        encoded = [str(path).encode('utf-8') for path in paths]
+        self.offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(path) for path in encoded], out=self.offsets[1:])
+        self.buffer = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+
+    def __len__(self):
+        return self.offsets.shape[0] - 1
+
+    def __getitem__(self, index):
+        if index < 0:
+            index = index + len(self)
+        return self.buffer[self.offsets[index]:self.offsets[index + 1]].tobytes().decode('utf-8')
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def __repr__(self):
+        return self.__class__.__name__ + ' (%d paths, %d bytes)' % (len(self), self.buffer.shape[0])
+
+
+# labels as one flat int64 array instead of a list of Python ints
+def create_label_table(labels):
+    return np.asarray(labels, dtype=np.int64).reshape(-1)
+
+
+# private memory of the process is the memory which is not shared with the parent and other workers,
+# Pss divides the shared pages between the processes which use them
+def get_memory_of_process(pid):
+    memory = {}
+    with open('/proc/%d/smaps_rollup' % pid) as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) == 3 and fields[2] == 'kB':
+                memory[fields[0].rstrip(':')] = int(fields[1])
+    return {'rss_mb': memory.get('Rss', 0) / 1024.0,
+            'pss_mb': memory.get('Pss', 0) / 1024.0,
+            'private_mb': (memory.get('Private_Clean', 0) + memory.get('Private_Dirty', 0)) / 1024.0}
+
+
+class TableReader(Dataset):
+    """Reads only the path and the label of every image, so the memory of the workers is the memory of the tables
+    Arguments:
+        paths (PathTable or list of strings) : paths of the images
+        labels (array or list) : labels of the images
+    """
+
+    def __init__(self, paths, labels):
+        self.paths = paths
+        self.labels = labels
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, index):
+        return len(self.paths[index]) + len(str(self.labels[index]))
+
+
+# collate_fn runs in the worker, so the worker reports its own memory after every batch
+def report_memory(batch):
+    memory = get_memory_of_process(os.getpid())
+    memory['pid'] = os.getpid()
+    return memory
+
+
+def measure(paths, labels, number_of_workers, batch_size):
+    loader = data.DataLoader(TableReader(paths, labels), batch_size=batch_size, shuffle=True,
+                             num_workers=number_of_workers, collate_fn=report_memory)
+    last_memory = {}
+    for memory in loader:
+        last_memory[memory['pid']] = memory
+    return list(last_memory.values())
+
+
+def main():
+    datasets = {'UKB': lambda: UKB.UKB('ukbench/full', test_or_train='train'),
+                'BIRDS100': lambda: birds.BIRDS100('CUB_200_2011', test_or_train='train'),
+                'Omniglot': lambda: omniglot.Omniglot('', test_or_train='train')}
+    parser = argparse.ArgumentParser(description='Memory of the loader workers with lists and with compact tables')
+    parser.add_argument('dataset', help='UKB, BIRDS100 or Omniglot')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--batch-size', type=int, default=256)
+    arguments = parser.parse_args()
+
+    dataset = datasets[arguments.dataset]()
+    labels = dataset.train_labels
+    if isinstance(labels, omniglot.MultiLabels):
+        # the number of labels of every image, the CSR arrays themselves are already flat
+        labels = labels.get_lengths()
+    layouts = {'lists': (list(dataset.train_images), [int(label) for label in labels]),
+               'compact': (PathTable(dataset.train_images), create_label_table(labels))}
+    print('%d images, parent: ' % len(dataset.train_images), get_memory_of_process(os.getpid()))
+    print('\t'.join(['layout', 'workers', 'mean RSS MB', 'mean PSS MB', 'mean private MB', 'max private MB']))
+    for layout in ['lists', 'compact']:
+        paths, labels = layouts[layout]
+        for number_of_workers in arguments.workers:
+            memories = measure(paths, labels, number_of_workers, arguments.batch_size)
+            private = [memory['private_mb'] for memory in memories]
+            print('%s\t%d\t%f\t%f\t%f\t%f' % (layout, number_of_workers,
+                                              np.mean([memory['rss_mb'] for memory in memories]),
+                                              np.mean([memory['pss_mb'] for memory in memories]),
+                                              np.mean(private), np.max(private)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+import params
+import test
+
+
+# hash of the weights, so the same network gives the same hash whichever checkpoint file it was loaded from
+def get_network_hash(network):
+    if network is None:
+        return 'no-network'
+    sha1 = hashlib.sha1()
+    for name, tensor in sorted(network.state_dict().items()):
+        sha1.update(name.encode('utf-8'))
+        sha1.update(np.ascontiguousarray(tensor.cpu().numpy()).tobytes())
+    return sha1.hexdigest()
+
+
+# digest of every (output, label) pair, sorting the digests gives the order which does not depend on
+# the order of the items, so a permutation of the same items has the same hash
+def get_canonical_order_and_hash(all_outputs, all_labels):
+    all_outputs = np.ascontiguousarray(all_outputs.cpu().numpy(), dtype=np.float32)
+    all_labels = np.ascontiguousarray(all_labels.cpu().numpy(), dtype=np.int64)
+    digests = np.array([hashlib.blake2b(row.tobytes() + label.tobytes(), digest_size=16).digest()
+                        for row, label in zip(all_outputs, all_labels)], dtype='S16')
+    # order[canonical_index] = current_index
+    order = np.argsort(digests, kind='mergesort')
+    set_hash = hashlib.sha1(digests[order].tobytes()).hexdigest()
+    return order, set_hash
+
+
+# settings of the search which change the neighbors: without the network the search is always euclidean,
+# with the network the distance type decides if larger or smaller scores are better
+def get_search_settings(similarity_network):
+    if similarity_network is None:
+        return 'euclidean'
+    return 'similarity-%s' % params.distance_type
+
+
+def get_key(network_hash, set_hash, metric, k, search_settings):
+    return hashlib.sha1(('%s-%s-%s-%d-%s' % (network_hash, set_hash, metric, k, search_settings)).encode(
+        'utf-8')).hexdigest()
+
+
+def load(key):
+    path = os.path.join(params.evaluation_cache_folder, key)
+    if not os.path.exists(path + '.json'):
+        return None, None
+    with open(path + '.json', 'r') as f:
+        values = json.load(f)
+    return np.load(path + '.npy'), values
+
+
+def save(key, canonical_neighbors_lists, values):
+    if not os.path.exists(params.evaluation_cache_folder):
+        os.makedirs(params.evaluation_cache_folder)
+    path = os.path.join(params.evaluation_cache_folder, key)
+    np.save(path + '.npy', canonical_neighbors_lists)
+    # json is written last and atomically, so the entry is either complete or absent
+    with open(path + '.json.tmp', 'w') as f:
+        json.dump(values, f)
+    os.replace(path + '.json.tmp', path + '.json')
+
+
+# the same recall at k as test.partial_test_for_representation, but the neighbors lists and the metric
+# are kept on disk by the key (network, set of outputs with labels, metric, k, search settings),
+# repeated and reordered evaluations read them instead of computing again
+def cached_test_for_representation(k, all_outputs, all_labels, similarity_network=None, metric='recall'):
+    order, set_hash = get_canonical_order_and_hash(all_outputs, all_labels)
+    key = get_key(get_network_hash(similarity_network), set_hash, metric, k, get_search_settings(similarity_network))
+    # canonical_position[current_index] = canonical_index
+    canonical_position = np.empty_like(order)
+    canonical_position[order] = np.arange(order.shape[0])
+
+    canonical_neighbors_lists, values = load(key)
+    if values is not None:
+        # neighbors are stored as canonical indices for queries in canonical order
+        neighbors_lists = order[canonical_neighbors_lists[canonical_position]]
+        print('recall_at_', k, ' from the evaluation cache: %f ' % values['recall_at_k'])
+        return values['recall_at_k'], neighbors_lists
+
+    _, neighbors_lists = test.get_neighbors_lists_by_blocks(k, all_outputs, similarity_network=similarity_network)
+    recall_at_k = test.get_recall_at_k_from_neighbors_lists(neighbors_lists, all_labels.cpu().numpy())
+    canonical_neighbors_lists = np.empty_like(neighbors_lists)
+    canonical_neighbors_lists[canonical_position] = canonical_position[neighbors_lists]
+    save(key, canonical_neighbors_lists, {'recall_at_k': recall_at_k, 'k': k, 'metric': metric,
+                                          'number_of_items': int(order.shape[0])})
+    print('recall_at_', k, ' of the network on the ', order.shape[0], ' items: %f ' % recall_at_k)
+    return recall_at_k, neighbors_lists
@@ -0,0 +1,162 @@
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+import torch
+import torch.utils.data as data
+from torch.autograd import Variable
+
+import UKB
+import params
+import spoc
+import spoc_extraction
+import test
+
+# columns of the index: chunk, offset in the chunk (in fp16 elements), channels, height, width, label
+INDEX_COLUMNS = 6
+
+pooling_functions = {'sum': spoc.compute_sum_pooled_spoc_by_outputs,
+                     'max': spoc.compute_max_pooled_spoc_by_outputs,
+                     'gem': spoc.compute_gem_by_outputs,
+                     'regional': spoc.compute_regional_spoc_by_outputs}
+
+
+def get_chunk_path(folder, chunk):
+    return os.path.join(folder, 'chunk-%05d.fp16' % chunk)
+
+
+def get_folder_size_in_mb(folder):
+    return sum(os.path.getsize(os.path.join(folder, name)) for name in os.listdir(folder)) / (1024.0 * 1024.0)
+
+
+def read_fingerprint(folder):
+    path = os.path.join(folder, 'fingerprint.json')
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        return json.load(f)['fingerprint']
+
+
+# the cache is complete if it has the index, and it is of the same images and the same backbone
+# if it has the same fingerprint (see spoc_extraction.get_feature_maps_fingerprint)
+def is_cache_built(folder, fingerprint):
+    return os.path.exists(os.path.join(folder, 'index.npy')) and read_fingerprint(folder) == fingerprint
+
+
+# feature maps of the representation network for all the images of the dataset are appended as fp16
+# to the chunk files, the index keeps where every map is and its shape, so the maps can have different sizes
+def build_feature_map_cache(dataset, network, folder):
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    # the old cache is removed first, so the cache which is built partially is never taken as complete
+    for name in os.listdir(folder):
+        if name == 'index.npy' or name == 'fingerprint.json' or name.startswith('chunk-'):
+            os.remove(os.path.join(folder, name))
+    fingerprint = spoc_extraction.get_feature_maps_fingerprint(dataset, network)
+    chunk_size = params.feature_map_cache_chunk_size_in_mb * 1024 * 1024 // 2
+    index = np.zeros((len(dataset), INDEX_COLUMNS), dtype=np.int64)
+    loader = data.DataLoader(dataset, batch_size=params.batch_size_for_spoc_extraction, shuffle=False,
+                             num_workers=params.number_of_workers_for_spoc_extraction)
+    start_time = time.time()
+    chunk = 0
+    offset = 0
+    position = 0
+    chunk_file = open(get_chunk_path(folder, chunk), 'wb')
+    try:
+        for images, labels in loader:
+            outputs = network(Variable(images, volatile=True).cuda()).data.half().cpu().numpy()
+            for feature_map, label in zip(outputs, labels.numpy()):
+                if offset > 0 and offset + feature_map.size > chunk_size:
+                    chunk_file.close()
+                    chunk = chunk + 1
+                    offset = 0
+                    chunk_file = open(get_chunk_path(folder, chunk), 'wb')
+                chunk_file.write(np.ascontiguousarray(feature_map).tobytes())
+                index[position] = [chunk, offset] + list(feature_map.shape) + [label]
+                offset = offset + feature_map.size
+                position = position + 1
+            if position % 1000 < params.batch_size_for_spoc_extraction:
+                print('progress %d / %d' % (position, len(dataset)))
+    finally:
+        chunk_file.close()
+    with open(os.path.join(folder, 'fingerprint.json'), 'w') as f:
+        json.dump({'fingerprint': fingerprint}, f)
+    # the index is written last, so the cache with the index is complete
+    np.save(os.path.join(folder, 'index.npy'), index)
+    backbone_time = time.time() - start_time
+    print('feature maps of %d images are cached in %f s, the cache takes %f MB' %
+          (len(dataset), backbone_time, get_folder_size_in_mb(folder)))
+    return backbone_time
+
+
+class FeatureMapCache(object):
+    def __init__(self, folder):
+        self.folder = folder
+        self.index = np.load(os.path.join(folder, 'index.npy'))
+        self.chunks = [np.memmap(get_chunk_path(folder, chunk), dtype=np.float16, mode='r')
+                       for chunk in range(int(self.index[:, 0].max()) + 1)]
+
+    def __len__(self):
+        return self.index.shape[0]
+
+    def get_feature_map(self, position):
+        chunk, offset, channels, height, width, _ = self.index[position]
+        return self.chunks[chunk][offset:offset + channels * height * width].reshape(channels, height, width)
+
+    # consecutive images with the same shape of the map go to the same batch
+    def iterate_batches(self, batch_size):
+        start = 0
+        while start < len(self):
+            stop = start + 1
+            while stop < len(self) and stop - start < batch_size and \
+                    (self.index[stop, 2:5] == self.index[start, 2:5]).all():
+                stop = stop + 1
+            feature_maps = np.stack([self.get_feature_map(position) for position in range(start, stop)])
+            yield torch.from_numpy(feature_maps.astype(np.float32)), torch.from_numpy(self.index[start:stop, 5])
+            start = stop
+
+
+# recomputes descriptors with any pooling from the cached maps instead of running the network again
+def compute_spocs_from_cache(cache, pooling, test_or_train='test'):
+    all_spocs = []
+    all_labels = []
+    for feature_maps, labels in cache.iterate_batches(params.batch_size_for_similarity):
+        outputs = Variable(feature_maps, volatile=True).cuda()
+        all_spocs.append(pooling_functions[pooling](outputs, test_or_train).data)
+        all_labels.append(labels)
+    return torch.cat(all_spocs, dim=0), torch.cat(all_labels, dim=0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Cache feature maps of UKB once and compare poolings on them')
+    parser.add_argument('--data-folder', default='ukbench/full')
+    parser.add_argument('--folder', default=params.feature_map_cache_folder)
+    parser.add_argument('--poolings', nargs='+', default=['sum', 'max', 'gem', 'regional'])
+    arguments = parser.parse_args()
+
+    _, test_loader = UKB.download_UKB_for_representation(data_folder=arguments.data_folder)
+    network = spoc.create_representation_network()
+    if is_cache_built(arguments.folder, spoc_extraction.get_feature_maps_fingerprint(test_loader.dataset, network)):
+        print('the cache is already built in ', arguments.folder)
+        backbone_time = None
+    else:
+        backbone_time = build_feature_map_cache(test_loader.dataset, network, arguments.folder)
+    cache = FeatureMapCache(arguments.folder)
+    print('cache of %d images takes %f MB' % (len(cache), get_folder_size_in_mb(arguments.folder)))
+
+    for pooling in arguments.poolings:
+        start_time = time.time()
+        all_spocs, all_labels = compute_spocs_from_cache(cache, pooling)
+        pooling_time = time.time() - start_time
+        if backbone_time is not None:
+            print('%s pooling from the cache in %f s, %f times faster than the network' %
+                  (pooling, pooling_time, backbone_time / pooling_time))
+        else:
+            print('%s pooling from the cache in %f s' % (pooling, pooling_time))
+        test.full_test_for_representation(k=params.k_for_recall, all_outputs=all_spocs, all_labels=all_labels)
+
+
+if __name__ == '__main__':
+    main()
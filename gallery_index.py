@@ -0,0 +1,334 @@
+import json
+import os
+import struct
+import threading
+
+import numpy as np
+
+import params
+
+operation_add = 1
+operation_delete = 2
+# operation, id, label, then representation_length float32 values for add
+record_header = struct.Struct('<Bqq')
+
+
+class GalleryIndex():
+    """Mutable gallery which is never rebuilt from scratch
+    New items are appended, deleted ones are only marked as dead (tombstones) and removed later
+    by compaction in a background thread. Every change is written to the log before it is applied,
+    the log is replayed on top of the last snapshot when the gallery is opened again.
+    Arguments:
+        folder (string) : folder for the snapshot and the log, created if it does not exist
+        representation_length (int) : length of the stored vectors
+    """
+
+    def __init__(self, folder, representation_length, initial_capacity=1024):
+        self.folder = folder
+        self.representation_length = representation_length
+        self.lock = threading.RLock()
+        self.snapshot_lock = threading.Lock()
+        self.compaction_thread = None
+
+        self.embeddings = np.zeros((initial_capacity, representation_length), dtype=np.float32)
+        self.labels = np.zeros(initial_capacity, dtype=np.int64)
+        self.ids = np.zeros(initial_capacity, dtype=np.int64)
+        self.alive = np.zeros(initial_capacity, dtype=bool)
+        self.count = 0
+        self.number_of_dead = 0
+        self.row_of_id = {}
+        self.next_id = 0
+        self.snapshot_version = None
+
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        self.load_snapshot()
+        # the old log exists only if we crashed while saving the snapshot
+        self.replay_log(self.get_path('log.old'))
+        self.replay_log(self.get_path('log'))
+        self.log = open(self.get_path('log'), 'ab')
+        print('gallery index with %d items (%d dead) is opened' % (len(self.row_of_id), self.number_of_dead))
+
+    def get_path(self, name):
+        return os.path.join(self.folder, name)
+
+    def __len__(self):
+        return len(self.row_of_id)
+
+    ##################################################################
+    #
+    # Changes
+    #
+    ##################################################################
+
+    def ensure_capacity(self, capacity):
+        if capacity <= self.embeddings.shape[0]:
+            return
+        new_capacity = max(capacity, 2 * self.embeddings.shape[0])
+        # searches which are running now keep the references to the old arrays, so we do not resize in place
+        embeddings = np.zeros((new_capacity, self.representation_length), dtype=np.float32)
+        embeddings[:self.count] = self.embeddings[:self.count]
+        labels = np.zeros(new_capacity, dtype=np.int64)
+        labels[:self.count] = self.labels[:self.count]
+        ids = np.zeros(new_capacity, dtype=np.int64)
+        ids[:self.count] = self.ids[:self.count]
+        alive = np.zeros(new_capacity, dtype=bool)
+        alive[:self.count] = self.alive[:self.count]
+        self.embeddings, self.labels, self.ids, self.alive = embeddings, labels, ids, alive
+
+    def apply_add(self, item_id, label, embedding):
+        # ids are given in the increasing order, so an id below next_id is already applied (it can be
+        # deleted since then), this makes the replay of the same records twice harmless
+        if item_id < self.next_id:
+            return
+        self.ensure_capacity(self.count + 1)
+        self.embeddings[self.count] = embedding
+        self.labels[self.count] = label
+        self.ids[self.count] = item_id
+        self.alive[self.count] = True
+        self.row_of_id[item_id] = self.count
+        self.count = self.count + 1
+        self.next_id = max(self.next_id, item_id + 1)
+
+    def apply_delete(self, item_id):
+        row = self.row_of_id.pop(item_id, None)
+        if row is None:
+            return
+        self.alive[row] = False
+        self.number_of_dead = self.number_of_dead + 1
+
+    def write_to_log(self, record):
+        self.log.write(record)
+        self.log.flush()
+        if params.gallery_index_fsync:
+            os.fsync(self.log.fileno())
+
+    # returns the ids of the new items
+    def add(self, embeddings, labels):
+        embeddings = np.asarray(embeddings, dtype=np.float32).reshape(-1, self.representation_length)
+        labels = np.asarray(labels, dtype=np.int64).reshape(-1)
+        with self.lock:
+            new_ids = np.arange(self.next_id, self.next_id + embeddings.shape[0])
+            records = []
+            for item_id, label, embedding in zip(new_ids, labels, embeddings):
+                records.append(record_header.pack(operation_add, int(item_id), int(label)))
+                records.append(embedding.tobytes())
+            self.write_to_log(b''.join(records))
+            for item_id, label, embedding in zip(new_ids, labels, embeddings):
+                self.apply_add(int(item_id), int(label), embedding)
+        return new_ids
+
+    def delete(self, ids):
+        with self.lock:
+            ids = [int(item_id) for item_id in np.asarray(ids).reshape(-1) if int(item_id) in self.row_of_id]
+            self.write_to_log(b''.join(record_header.pack(operation_delete, item_id, 0) for item_id in ids))
+            for item_id in ids:
+                self.apply_delete(item_id)
+            if self.number_of_dead > params.gallery_index_compaction_threshold * max(self.count, 1):
+                self.start_compaction()
+        return len(ids)
+
+    ##################################################################
+    #
+    # Search
+    #
+    ##################################################################
+
+    # arrays of the first count rows never change except the alive flags,
+    # so the search works with the consistent state without holding the lock
+    def get_view(self):
+        with self.lock:
+            count = self.count
+            return self.embeddings[:count], self.labels[:count], self.ids[:count], self.alive[:count].copy()
+
+    # returns euclidean distances, ids and labels of the k nearest alive items, the nearest go first
+    def search(self, query_outputs, k):
+        if hasattr(query_outputs, 'cpu'):
+            query_outputs = query_outputs.cpu().numpy()
+        query_outputs = np.asarray(query_outputs, dtype=np.float32)
+        embeddings, labels, ids, alive = self.get_view()
+        k = min(k, int(alive.sum()))
+        if k == 0:
+            empty = np.zeros((query_outputs.shape[0], 0))
+            return empty.astype(np.float32), empty.astype(np.int64), empty.astype(np.int64)
+
+        squared_norms_of_queries = np.sum(query_outputs * query_outputs, axis=1).reshape(-1, 1)
+        best_distances = np.zeros((query_outputs.shape[0], 0), dtype=np.float32)
+        best_rows = np.zeros((query_outputs.shape[0], 0), dtype=np.int64)
+        block_size = params.gallery_block_size_for_evaluation
+        for start in range(0, embeddings.shape[0], block_size):
+            block = embeddings[start:start + block_size]
+            distances = squared_norms_of_queries + np.sum(block * block, axis=1).reshape(1, -1) - \
+                        2 * np.dot(query_outputs, block.T)
+            distances[:, ~alive[start:start + block_size]] = np.inf
+            rows = np.broadcast_to(np.arange(start, start + block.shape[0]), distances.shape)
+            # merge the top k of the current block with the top k found so far
+            distances = np.hstack((best_distances, distances))
+            rows = np.hstack((best_rows, rows))
+            positions = np.argpartition(distances, k - 1, axis=1)[:, :k] if distances.shape[1] > k else \
+                np.broadcast_to(np.arange(distances.shape[1]), distances.shape)
+            best_distances = np.take_along_axis(distances, positions, axis=1)
+            best_rows = np.take_along_axis(rows, positions, axis=1)
+
+        order = np.argsort(best_distances, axis=1)
+        best_distances = np.sqrt(np.maximum(np.take_along_axis(best_distances, order, axis=1), 0))
+        best_rows = np.take_along_axis(best_rows, order, axis=1)
+        return best_distances, ids[best_rows], labels[best_rows]
+
+    ##################################################################
+    #
+    # Compaction and persistence
+    #
+    ##################################################################
+
+    def start_compaction(self):
+        with self.lock:
+            if self.compaction_thread is not None and self.compaction_thread.is_alive():
+                return
+            self.compaction_thread = threading.Thread(target=self.compact)
+            self.compaction_thread.daemon = True
+            self.compaction_thread.start()
+
+    def compact(self):
+        with self.lock:
+            count = self.count
+            embeddings, labels, ids = self.embeddings, self.labels, self.ids
+            alive_rows = np.where(self.alive[:count])[0]
+
+        # copying is done without the lock, rows below count are not changed by adds
+        compacted_embeddings = embeddings[alive_rows]
+        compacted_labels = labels[alive_rows]
+        compacted_ids = ids[alive_rows]
+        row_of_id = dict(zip(compacted_ids.tolist(), range(alive_rows.shape[0])))
+
+        with self.lock:
+            # items added and deleted while we were copying
+            still_alive = self.alive[alive_rows]
+            appended_rows = np.arange(count, self.count)
+            new_count = alive_rows.shape[0] + appended_rows.shape[0]
+            capacity = max(2 * new_count, 1024)
+
+            new_embeddings = np.zeros((capacity, self.representation_length), dtype=np.float32)
+            new_embeddings[:alive_rows.shape[0]] = compacted_embeddings
+            new_embeddings[alive_rows.shape[0]:new_count] = self.embeddings[appended_rows]
+            new_labels = np.zeros(capacity, dtype=np.int64)
+            new_labels[:new_count] = np.concatenate((compacted_labels, self.labels[appended_rows]))
+            new_ids = np.zeros(capacity, dtype=np.int64)
+            new_ids[:new_count] = np.concatenate((compacted_ids, self.ids[appended_rows]))
+            new_alive = np.zeros(capacity, dtype=bool)
+            new_alive[:new_count] = np.concatenate((still_alive, self.alive[appended_rows]))
+
+            for item_id in compacted_ids[~still_alive].tolist():
+                row_of_id.pop(item_id, None)
+            for row, item_id in enumerate(new_ids[alive_rows.shape[0]:new_count].tolist()):
+                if new_alive[alive_rows.shape[0] + row]:
+                    row_of_id[item_id] = alive_rows.shape[0] + row
+
+            self.embeddings, self.labels, self.ids, self.alive = new_embeddings, new_labels, new_ids, new_alive
+            self.count = new_count
+            self.number_of_dead = new_count - len(row_of_id)
+            self.row_of_id = row_of_id
+        print('gallery index is compacted from %d to %d rows' % (count, new_count))
+        self.save_snapshot()
+
+    def save_snapshot(self):
+        with self.snapshot_lock:
+            self.save_snapshot_unsafe()
+
+    # arrays of every snapshot have their own version in the file names, snapshot.json points to the current one
+    # and is replaced last, so the snapshot is switched atomically, old snapshots without the version are read too
+    def get_snapshot_path(self, version, name):
+        if version is None:
+            return self.get_path('snapshot-%s.npy' % name)
+        return self.get_path('snapshot-%d-%s.npy' % (version, name))
+
+    # changes after this moment go to the new log, the old one is removed after the snapshot is saved,
+    # if the old log is still there (the previous snapshot was not saved), the log is appended to it,
+    # so its records are not lost
+    def rotate_log(self):
+        self.log.close()
+        if os.path.exists(self.get_path('log.old')):
+            with open(self.get_path('log'), 'rb') as f:
+                content = f.read()
+            with open(self.get_path('log.old'), 'ab') as f:
+                f.write(content)
+                f.flush()
+                os.fsync(f.fileno())
+            # records which are in both logs after a crash here are applied once (see apply_add)
+            os.remove(self.get_path('log'))
+        else:
+            os.replace(self.get_path('log'), self.get_path('log.old'))
+        self.log = open(self.get_path('log'), 'ab')
+
+    def save_snapshot_unsafe(self):
+        with self.lock:
+            embeddings, labels, ids, alive = self.get_view()
+            alive_rows = np.where(alive)[0]
+            next_id = self.next_id
+            self.rotate_log()
+
+        previous_version = self.snapshot_version
+        version = previous_version + 1 if previous_version is not None else 0
+        for name, array in [('embeddings', embeddings[alive_rows]), ('labels', labels[alive_rows]),
+                            ('ids', ids[alive_rows])]:
+            with open(self.get_snapshot_path(version, name), 'wb') as f:
+                np.save(f, array)
+                f.flush()
+                os.fsync(f.fileno())
+        with open(self.get_path('snapshot.json.tmp'), 'w') as f:
+            json.dump({'version': version, 'next_id': next_id, 'representation_length': self.representation_length},
+                      f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self.get_path('snapshot.json.tmp'), self.get_path('snapshot.json'))
+        self.snapshot_version = version
+        os.remove(self.get_path('log.old'))
+        for name in ['embeddings', 'labels', 'ids']:
+            if os.path.exists(self.get_snapshot_path(previous_version, name)):
+                os.remove(self.get_snapshot_path(previous_version, name))
+
+    def load_snapshot(self):
+        if not os.path.exists(self.get_path('snapshot.json')):
+            return
+        with open(self.get_path('snapshot.json'), 'r') as f:
+            meta = json.load(f)
+        version = meta.get('version')
+        embeddings = np.load(self.get_snapshot_path(version, 'embeddings'))
+        labels = np.load(self.get_snapshot_path(version, 'labels'))
+        ids = np.load(self.get_snapshot_path(version, 'ids'))
+        self.ensure_capacity(embeddings.shape[0])
+        self.embeddings[:embeddings.shape[0]] = embeddings
+        self.labels[:labels.shape[0]] = labels
+        self.ids[:ids.shape[0]] = ids
+        self.alive[:ids.shape[0]] = True
+        self.count = ids.shape[0]
+        self.row_of_id = dict(zip(ids.tolist(), range(ids.shape[0])))
+        self.next_id = meta['next_id']
+        self.snapshot_version = version
+
+    # replaying is idempotent, so an operation which is already in the snapshot is just skipped
+    def replay_log(self, path):
+        if not os.path.exists(path):
+            return
+        embedding_size = 4 * self.representation_length
+        with open(path, 'rb') as f:
+            content = f.read()
+        position = 0
+        while position + record_header.size <= len(content):
+            operation, item_id, label = record_header.unpack_from(content, position)
+            position = position + record_header.size
+            if operation == operation_add:
+                if position + embedding_size > len(content):
+                    break  # the last record was not written completely
+                embedding = np.frombuffer(content, dtype=np.float32, count=self.representation_length,
+                                          offset=position)
+                position = position + embedding_size
+                self.apply_add(item_id, label, embedding)
+            else:
+                self.apply_delete(item_id)
+
+    def close(self):
+        if self.compaction_thread is not None:
+            self.compaction_thread.join()
+        self.save_snapshot()
+        self.log.close()
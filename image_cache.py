@@ -0,0 +1,123 @@
+import argparse
+import hashlib
+import os
+import time
+
+import numpy as np
+import torch.utils.data as data
+import torchvision.transforms as transforms
+from PIL import Image
+from torch.utils.data import Dataset
+
+import UKB
+import birds
+import image_decoding
+import omniglot
+import params
+
+
+# images are decoded once, converted to RGB and downscaled as by transforms.Scale(scale_size) if their shorter
+# side is larger, smaller images are kept in their size, then all of them are stored one after another
+# as uint8 height x width x 3 in images.uint8, index.npy keeps offset, height and width of every image,
+# so transforms.Scale of the dataset does nothing for large images and upscales small ones as before.
+# The decoded pixels depend on the JPEG draft, so it is a part of the key too.
+def get_cache_folder(paths, scale_size):
+    sha1 = hashlib.sha1(('%d\n%d\n' % (scale_size, params.use_jpeg_draft) +
+                         '\n'.join(str(path) for path in paths)).encode('utf-8'))
+    return os.path.join(params.image_cache_folder, sha1.hexdigest())
+
+
+class DecodedImages(Dataset):
+    def __init__(self, paths, scale_size):
+        self.paths = paths
+        self.scale_size = scale_size
+        self.scale = transforms.Scale(scale_size)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, index):
+        image = image_decoding.open_image(self.paths[index], self.scale_size)
+        # small images, e.g. 105 x 105 of Omniglot, would take (scale_size / 105) ^ 2 times more space upscaled
+        if min(image.size) > self.scale_size:
+            image = self.scale(image)
+        return np.asarray(image, dtype=np.uint8)
+
+
+def keep_list(batch):
+    return batch
+
+
+def build_image_cache(paths, folder, scale_size):
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    start_time = time.time()
+    index = np.zeros((len(paths), 3), dtype=np.int64)
+    # images are decoded by the workers in parallel and written in order
+    loader = data.DataLoader(DecodedImages(paths, scale_size), batch_size=64, shuffle=False,
+                             num_workers=params.number_of_workers_for_image_cache, collate_fn=keep_list)
+    position = 0
+    offset = 0
+    with open(os.path.join(folder, 'images.uint8.tmp'), 'wb') as f:
+        for images in loader:
+            for image in images:
+                f.write(np.ascontiguousarray(image).tobytes())
+                index[position] = [offset, image.shape[0], image.shape[1]]
+                offset = offset + image.size
+                position = position + 1
+            print('progress %d / %d' % (position, len(paths)))
+    os.replace(os.path.join(folder, 'images.uint8.tmp'), os.path.join(folder, 'images.uint8'))
+    # the index is written last, so the cache with the index is complete
+    np.save(os.path.join(folder, 'index.npy'), index)
+    print('%d images are cached in %f s, %f MB' % (len(paths), time.time() - start_time, offset / (1024.0 * 1024.0)))
+
+
+class ImageCache(object):
+    """Decoded and scaled images in one memory-mapped uint8 array
+    Arguments:
+        folder (string) : folder with images.uint8 and index.npy made by build_image_cache
+    The memmap is opened before the workers of the loader are forked, so all of them share its pages.
+    """
+
+    def __init__(self, folder):
+        self.index = np.load(os.path.join(folder, 'index.npy'))
+        # memmap of the empty file is not possible
+        if np.sum(self.index[:, 1] * self.index[:, 2]) > 0:
+            self.images = np.memmap(os.path.join(folder, 'images.uint8'), dtype=np.uint8, mode='r')
+        else:
+            self.images = np.zeros(0, dtype=np.uint8)
+
+    def __len__(self):
+        return self.index.shape[0]
+
+    def get_image(self, index):
+        offset, height, width = self.index[index]
+        array = self.images[offset:offset + height * width * 3].reshape(height, width, 3)
+        return Image.fromarray(array, mode='RGB')
+
+
+def open_image_cache(paths, scale_size=None):
+    if scale_size is None:
+        scale_size = params.initial_image_scale_size
+    folder = get_cache_folder(paths, scale_size)
+    if not os.path.exists(os.path.join(folder, 'index.npy')):
+        print('build the image cache for %d images in ' % len(paths), folder)
+        build_image_cache(paths, folder, scale_size)
+    return ImageCache(folder)
+
+
+def main():
+    datasets = {'UKB': lambda split: UKB.UKB('ukbench/full', test_or_train=split),
+                'BIRDS100': lambda split: birds.BIRDS100('CUB_200_2011', test_or_train=split),
+                'Omniglot': lambda split: omniglot.Omniglot('', test_or_train=split)}
+    parser = argparse.ArgumentParser(description='Build the image caches before the training')
+    parser.add_argument('datasets', nargs='+', help='UKB, BIRDS100 or Omniglot')
+    arguments = parser.parse_args()
+    for name in arguments.datasets:
+        for split in ['train', 'test']:
+            dataset = datasets[name](split)
+            open_image_cache(list(dataset.train_images if dataset.train else dataset.test_images))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+import argparse
+import time
+
+import numpy as np
+import torchvision.transforms as transforms
+from PIL import Image
+
+import UKB
+import birds
+import omniglot
+import params
+
+
+# JPEG is decoded by the DCT - domain downscale with the largest factor (1/2, 1/4, 1/8) which keeps both sides
+# not less than scale_size, so the shorter side is still not less than scale_size for transforms.Scale,
+# and the mode is converted once, grayscale images become RGB before any transformation
+def open_image(file, scale_size=None):
+    if scale_size is None:
+        scale_size = params.initial_image_scale_size
+    image = Image.open(file)
+    if params.use_jpeg_draft and image.format == 'JPEG':
+        image.draft('RGB', (scale_size, scale_size))
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    return image
+
+
+# the old path of the datasets: the full decoding, the transformation and for grayscale images
+# ToPILImage, colorize and the transformation once more
+def decode_as_before(path, transform):
+    image = transform(Image.open(path))
+    if image.shape[0] == 1:
+        image = transforms.ImageOps.colorize(transforms.ToPILImage()(image), (0, 0, 0), (255, 255, 255))
+        image = transform(image)
+    return image
+
+
+def decode_with_draft(path, transform):
+    return transform(open_image(path))
+
+
+def measure(decode, paths, transform):
+    start_time = time.time()
+    for path in paths:
+        decode(path, transform)
+    return (time.time() - start_time) / len(paths)
+
+
+def main():
+    datasets = {'UKB': lambda: UKB.UKB('ukbench/full', test_or_train='test'),
+                'BIRDS100': lambda: birds.BIRDS100('CUB_200_2011', test_or_train='test'),
+                'Omniglot': lambda: omniglot.Omniglot('', test_or_train='test')}
+    parser = argparse.ArgumentParser(description='Decode time per image with and without JPEG draft')
+    parser.add_argument('datasets', nargs='+', help='UKB, BIRDS100 or Omniglot')
+    parser.add_argument('--images', type=int, default=500)
+    arguments = parser.parse_args()
+
+    transform = transforms.Compose([
+        transforms.Scale(params.initial_image_scale_size),
+        transforms.CenterCrop(params.initial_image_size),
+        transforms.ToTensor(),
+    ])
+    for name in arguments.datasets:
+        paths = list(datasets[name]().test_images)
+        paths = [paths[i] for i in np.random.RandomState(0).choice(len(paths), min(arguments.images, len(paths)),
+                                                                   replace=False)]
+        # the first pass warms up the page cache, so both paths read the files from memory
+        measure(decode_as_before, paths, transform)
+        time_before = measure(decode_as_before, paths, transform)
+        time_after = measure(decode_with_draft, paths, transform)
+        print('%s: %f ms per image before, %f ms per image with draft, %f times faster' %
+              (name, time_before * 1000, time_after * 1000, time_before / time_after))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+import time
+
+import numpy as np
+import scipy.sparse as sparse
+import torch
+
+import params
+import test
+
+
+def to_numpy(outputs):
+    if hasattr(outputs, 'cpu'):
+        return outputs.cpu().numpy()
+    return np.asarray(outputs, dtype=np.float32)
+
+
+def to_tensor(outputs):
+    if hasattr(outputs, 'cpu'):
+        return outputs
+    return torch.from_numpy(np.ascontiguousarray(outputs, dtype=np.float32))
+
+
+# outputs should be L2 - normalized, then euclidean distance d and cosine similarity s are related as s = 1 - d^2 / 2
+def get_top_k_similarities(k, query_outputs, gallery_outputs):
+    query_outputs = to_tensor(query_outputs)
+    gallery_outputs = to_tensor(gallery_outputs)
+    # expanded queries and the graph are computed on cpu, while the outputs can be on GPU
+    if query_outputs.is_cuda != gallery_outputs.is_cuda:
+        query_outputs = query_outputs.cuda()
+        gallery_outputs = gallery_outputs.cuda()
+    distances, neighbors_lists = test.get_neighbors_lists_by_blocks(k, query_outputs, gallery_outputs)
+    return 1.0 - distances * distances / 2.0, neighbors_lists
+
+
+# sparse graph where every gallery item is connected with its k nearest neighbors (not with itself),
+# built by blocks so that we never have the number_of_items x number_of_items matrix
+def build_knn_graph(gallery_outputs, k):
+    start_time = time.time()
+    number_of_items = gallery_outputs.shape[0]
+    similarities, neighbors_lists = get_top_k_similarities(k + 1, gallery_outputs, gallery_outputs)
+
+    # remove every item from its own list, if it is not there we remove the farthest neighbor
+    is_self = neighbors_lists == np.arange(number_of_items).reshape(-1, 1)
+    is_self[~is_self.any(axis=1), -1] = True
+    neighbors_lists = neighbors_lists[~is_self].reshape(number_of_items, k)
+    similarities = similarities[~is_self].reshape(number_of_items, k)
+
+    # negative similarities are not used as weights in the diffusion
+    weights = np.power(np.maximum(similarities, 0), params.diffusion_gamma).astype(np.float32)
+    graph = sparse.csr_matrix((weights.reshape(-1), neighbors_lists.reshape(-1),
+                               np.arange(0, number_of_items * k + 1, k)),
+                              shape=(number_of_items, number_of_items))
+    print('knn graph with %d items and %d edges is built in %f s' % (number_of_items, graph.nnz,
+                                                                     time.time() - start_time))
+    return graph
+
+
+# average query expansion: the query is replaced by the mean of itself and its top neighbors
+def average_query_expansion(query_outputs, gallery_outputs, neighbors_lists, number_of_expansions):
+    query_outputs = to_numpy(query_outputs)
+    gallery_outputs = to_numpy(gallery_outputs)
+    expanded = query_outputs + gallery_outputs[neighbors_lists[:, :number_of_expansions]].sum(axis=1)
+    expanded = expanded / np.linalg.norm(expanded, axis=1).reshape(-1, 1)
+    return expanded.astype(np.float32)
+
+
+def rerank_with_query_expansion(k, query_outputs, gallery_outputs):
+    _, neighbors_lists = get_top_k_similarities(params.number_of_query_expansions, query_outputs, gallery_outputs)
+    expanded = average_query_expansion(query_outputs, gallery_outputs, neighbors_lists,
+                                       params.number_of_query_expansions)
+    return get_top_k_similarities(k, expanded, gallery_outputs)
+
+
+# normalized affinity S = D^-1/2 W D^-1/2 of the mutual neighbors graph
+def get_normalized_affinity(graph):
+    mutual_graph = graph.minimum(graph.T).tocsr()
+    degrees = np.asarray(mutual_graph.sum(axis=1)).reshape(-1)
+    inverse_square_roots = np.zeros_like(degrees)
+    inverse_square_roots[degrees > 0] = 1.0 / np.sqrt(degrees[degrees > 0])
+    normalization = sparse.diags(inverse_square_roots)
+    return (normalization.dot(mutual_graph).dot(normalization)).tocsr()
+
+
+# solves (I - alpha S) F = Y for all columns of Y at once,
+# every iteration costs one product of the sparse S with O(N * k) entries and the dense block of columns
+def conjugate_gradient(affinity, right_hand_sides, alpha, number_of_iterations, tolerance):
+    solutions = np.zeros_like(right_hand_sides)
+    residuals = right_hand_sides.copy()
+    directions = residuals.copy()
+    squared_norms_of_residuals = np.sum(residuals * residuals, axis=0)
+    norms_of_right_hand_sides = np.sqrt(squared_norms_of_residuals) + 1e-12
+    for iteration in range(number_of_iterations):
+        products = directions - alpha * affinity.dot(directions)
+        step = squared_norms_of_residuals / np.maximum(np.sum(directions * products, axis=0), 1e-12)
+        solutions = solutions + directions * step
+        residuals = residuals - products * step
+        new_squared_norms_of_residuals = np.sum(residuals * residuals, axis=0)
+        if np.all(np.sqrt(new_squared_norms_of_residuals) < tolerance * norms_of_right_hand_sides):
+            break
+        directions = residuals + directions * (new_squared_norms_of_residuals /
+                                               np.maximum(squared_norms_of_residuals, 1e-12))
+        squared_norms_of_residuals = new_squared_norms_of_residuals
+    return solutions
+
+
+# Efficient Diffusion on Region Manifolds, Iscen et al.
+# https://arxiv.org/abs/1611.05113
+# the query is connected with its k nearest gallery items and the ranking is the stationary state of the diffusion
+def rerank_with_diffusion(k, query_outputs, gallery_outputs, graph=None):
+    start_time = time.time()
+    gallery_outputs = to_numpy(gallery_outputs)
+    number_of_items = gallery_outputs.shape[0]
+    if graph is None:
+        graph = build_knn_graph(gallery_outputs, params.k_for_knn_graph)
+    affinity = get_normalized_affinity(graph)
+
+    similarities, neighbors_lists = get_top_k_similarities(params.k_for_knn_graph, query_outputs, gallery_outputs)
+    weights = np.power(np.maximum(similarities, 0), params.diffusion_gamma).astype(np.float32)
+
+    number_of_queries = neighbors_lists.shape[0]
+    all_scores = np.zeros((number_of_queries, k), dtype=np.float32)
+    all_neighbors = np.zeros((number_of_queries, k), dtype=np.int64)
+    block_size = params.diffusion_query_block_size
+    for start in range(0, number_of_queries, block_size):
+        stop = min(start + block_size, number_of_queries)
+        # only k_for_knn_graph entries of every column are not zero
+        right_hand_sides = sparse.csc_matrix((weights[start:stop].reshape(-1),
+                                              neighbors_lists[start:stop].reshape(-1),
+                                              np.arange(0, (stop - start) * params.k_for_knn_graph + 1,
+                                                        params.k_for_knn_graph)),
+                                             shape=(number_of_items, stop - start)).toarray()
+        scores = conjugate_gradient(affinity, right_hand_sides, params.diffusion_alpha,
+                                    params.diffusion_number_of_iterations, params.diffusion_tolerance).T
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k] if number_of_items > k else \
+            np.broadcast_to(np.arange(number_of_items), scores.shape)
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        order = np.argsort(-top_scores, axis=1)
+        all_scores[start:stop] = np.take_along_axis(top_scores, order, axis=1)
+        all_neighbors[start:stop] = np.take_along_axis(top, order, axis=1)
+    print('diffusion for %d queries in %f s' % (number_of_queries, time.time() - start_time))
+    return all_scores, all_neighbors
+
+
+def get_reranked_neighbors_lists(k, query_outputs, gallery_outputs, method=None, graph=None):
+    if method is None:
+        method = params.reranking
+    if method == 'qe':
+        return rerank_with_query_expansion(k, query_outputs, gallery_outputs)
+    if method == 'diffusion':
+        return rerank_with_diffusion(k, query_outputs, gallery_outputs, graph=graph)
+    if method == 'none':
+        return get_top_k_similarities(k, query_outputs, gallery_outputs)
+    raise Exception('You should use none, qe or diffusion reranking!')
+
+
+# the same recall as test.full_test_for_representation, but with the reranked neighbors
+def test_with_reranking_for_representation(k, all_outputs, all_labels, method=None):
+    if method is None:
+        method = params.reranking
+    _, neighbors_lists = get_reranked_neighbors_lists(k, all_outputs, all_outputs, method=method)
+    recall_at_k = test.get_recall_at_k_from_neighbors_lists(neighbors_lists, all_labels.cpu().numpy())
+    print('recall_at_', k, ' with ', method, ' reranking: %f ' % recall_at_k)
+    return recall_at_k
@@ -8,6 +8,7 @@ import visdom
 from torch.autograd import Variable
 from torch.optim import lr_scheduler
 
+import background_evaluation
 import metric_learning_utils
 import params
 import test
@@ -25,10 +26,13 @@ def learning_process(train_loader,
                      lr_scheduler=lr_scheduler):
     vis = visdom.Visdom()
     r_loss = []
+    r_recall = []
     iterations = []
+    epochs = []
     total_iteration = 0
 
     loss_plot = vis.line(Y=np.zeros(1), X=np.zeros(1))
+    recall_plot = vis.line(Y=np.zeros(1), X=np.zeros(1))
 
     number_of_epochs = 0
     name_prefix_for_saved_model = ''
@@ -39,6 +43,13 @@ def learning_process(train_loader,
         number_of_epochs = params.number_of_epochs_for_representation
         name_prefix_for_saved_model = params.name_prefix_for_saved_model_for_representation
 
+    # the worker re-embeds the test set and computes recall, so the training does not wait for it
+    background_evaluator = None
+    if params.background_evaluation and mode == params.mode_representation:
+        background_evaluator = background_evaluation.BackgroundEvaluator(network,
+                                                                         background_evaluation.evaluate_representation,
+                                                                         (test_loader.dataset,))
+
     for epoch in range(start_epoch, number_of_epochs):  # loop over the dataset multiple times
         pr = cProfile.Profile()
         pr.enable()
@@ -98,7 +109,9 @@ def learning_process(train_loader,
             if mode == params.mode_classification:
                 accuracy = test.test_for_classification(test_loader=test_loader,
                                                         network=network)
-            if mode == params.mode_representation:
+            if mode == params.mode_representation and background_evaluator is not None:
+                background_evaluator.submit(network, epoch)
+            if mode == params.mode_representation and background_evaluator is None:
                 # we should recalculate all outputs before the evaluation because our network changed during the trainig
                 all_outputs_test, all_labels_test = metric_learning_utils.get_all_outputs_and_labels(test_loader,
                                                                                                      network)
@@ -109,6 +122,9 @@ def learning_process(train_loader,
                                   optimizer=optimizer,
                                   filename=name_prefix_for_saved_model + '-%d' % epoch,
                                   epoch=epoch)
+        if background_evaluator is not None:
+            recall_plot = background_evaluation.plot_recall(vis, recall_plot, background_evaluator.get_results(),
+                                                            r_recall, epochs, legend=['recall for ' + mode])
         total_iteration = total_iteration + i
         print('total_iteration = ', total_iteration)
 
@@ -120,4 +136,9 @@ def learning_process(train_loader,
         # ps.print_stats()
         # print(s.getvalue())
 
+    if background_evaluator is not None:
+        print('Waiting for the background evaluation')
+        background_evaluation.plot_recall(vis, recall_plot, background_evaluator.close(),
+                                          r_recall, epochs, legend=['recall for ' + mode])
+
     print('Finished Training')
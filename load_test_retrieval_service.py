@@ -0,0 +1,80 @@
+import argparse
+import json
+import os
+import threading
+import time
+import urllib.request
+
+import numpy as np
+
+import params
+
+
+def send_request(url, image_bytes):
+    request = urllib.request.Request(url, data=image_bytes, headers={'Content-Type': 'application/octet-stream'})
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read().decode('utf-8'))
+
+
+def client_loop(url, images, number_of_requests, latencies, errors, lock):
+    for i in range(number_of_requests):
+        image_bytes = images[np.random.randint(low=0, high=len(images))]
+        start_time = time.time()
+        try:
+            send_request(url, image_bytes)
+            with lock:
+                latencies.append(time.time() - start_time)
+        except Exception as exception:
+            with lock:
+                errors.append(str(exception))
+
+
+def load_test(port, folder, number_of_clients, number_of_requests_per_client, k):
+    files = sorted(file for file in os.listdir(folder) if file.lower().endswith(('.jpg', '.jpeg', '.png')))
+    images = []
+    for file in files[:1000]:
+        with open(os.path.join(folder, file), 'rb') as f:
+            images.append(f.read())
+    print('%d images for the load test' % len(images))
+
+    url = 'http://127.0.0.1:%d/search?k=%d' % (port, k)
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    clients = [threading.Thread(target=client_loop,
+                                args=(url, images, number_of_requests_per_client, latencies, errors, lock))
+               for _ in range(number_of_clients)]
+    start_time = time.time()
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    elapsed_time = time.time() - start_time
+
+    latencies = np.array(latencies) * 1000
+    print('clients %d, requests %d, errors %d, time %f s' % (number_of_clients, latencies.shape[0],
+                                                             len(errors), elapsed_time))
+    if latencies.shape[0] > 0:
+        print('throughput %f requests per second' % (latencies.shape[0] / elapsed_time))
+        print('latency p50 %f ms, p90 %f ms, p99 %f ms' % (np.percentile(latencies, 50),
+                                                           np.percentile(latencies, 90),
+                                                           np.percentile(latencies, 99)))
+    with urllib.request.urlopen('http://127.0.0.1:%d/stats' % port) as response:
+        print('service statistics ', json.loads(response.read().decode('utf-8')))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test for retrieval_service.py')
+    parser.add_argument('folder', help='folder with query images')
+    parser.add_argument('--port', type=int, default=params.service_port)
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 4, 16, 32])
+    parser.add_argument('--requests', type=int, default=100, help='number of requests for every client')
+    parser.add_argument('--k', type=int, default=params.k_for_recall)
+    arguments = parser.parse_args()
+    # several levels of concurrency show how micro-batching trades latency for throughput
+    for number_of_clients in arguments.clients:
+        load_test(arguments.port, arguments.folder, number_of_clients, arguments.requests, arguments.k)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,11 +3,12 @@ import torch.nn as nn
 import torch.optim as optim
 import torch.utils.model_zoo
 import torchvision
-import torchvision.models as models
 from torch.optim import lr_scheduler
 
+import backbones
 import birds
 import cifar
+import evaluation_cache
 import histogramm_loss
 import learning
 import metric_learning
@@ -151,6 +152,20 @@ def representations_learning(network, train_loader, test_loader):
                                           all_outputs=all_outputs_test, all_labels=all_labels_test)
 
 
+# the results are kept in the evaluation cache, so reordered or repeated evaluations are not computed again
+def evaluate_similarity_network(k, all_outputs, all_labels, similarity_network):
+    if params.use_evaluation_cache:
+        recall_at_k, _ = evaluation_cache.cached_test_for_representation(k=k,
+                                                                         all_outputs=all_outputs,
+                                                                         all_labels=all_labels,
+                                                                         similarity_network=similarity_network)
+        return recall_at_k
+    return test.partial_test_for_representation(k=k,
+                                                all_outputs=all_outputs,
+                                                all_labels=all_labels,
+                                                similarity_network=similarity_network)
+
+
 def visual_similarity_learning(network, train_loader, test_loader):
     ##################################################################
     #
@@ -235,19 +250,14 @@ def visual_similarity_learning(network, train_loader, test_loader):
                                                                      name_prefix_for_saved_model=
                                                                      params.name_prefix_for_similarity_saved_model,
                                                                      stage=1)
-    # for epoch in range(0, 100, 10):
-    #    print('Recover similarity network before the 2 stage ---- epoch %d', epoch)
-    #    similarity_learning_network = utils.load_network_from_checkpoint(network=similarity_learning_network,
-    #                                                                 epoch=epoch,
-    #                                                                 name_prefix_for_saved_model=
-    #                                                                 params.name_prefix_for_similarity_saved_model,
-    #                                                                 stage=1)
+    # to compare the checkpoints of all the epochs run checkpoint_sweep.py,
+    # it loads the outputs once and evaluates the checkpoints in parallel
 
     print('Evaluation on train after the stage 1')
-    recall_at_k = test.partial_test_for_representation(k=params.k_for_recall,
-                                                       all_outputs=all_outputs_train,
-                                                       all_labels=all_labels_train,
-                                                       similarity_network=similarity_learning_network)
+    recall_at_k = evaluate_similarity_network(k=params.k_for_recall,
+                                              all_outputs=all_outputs_train,
+                                              all_labels=all_labels_train,
+                                              similarity_network=similarity_learning_network)
 
     # reorder outputs and labels for histogramm loss for UKB!!!!!!!
     if params.sampling_for_similarity:
@@ -258,19 +268,19 @@ def visual_similarity_learning(network, train_loader, test_loader):
         print('all_outputs_train sorted ', all_outputs_train)
 
     print('Evaluation on train after the stage 1 and reordering!')
-    recall_at_k = test.partial_test_for_representation(k=params.k_for_recall,
-                                                       all_outputs=all_outputs_train,
-                                                       all_labels=all_labels_train,
-                                                       similarity_network=similarity_learning_network)
+    recall_at_k = evaluate_similarity_network(k=params.k_for_recall,
+                                              all_outputs=all_outputs_train,
+                                              all_labels=all_labels_train,
+                                              similarity_network=similarity_learning_network)
 
 
 
 
     print('Evaluation on test after the stage 1')
-    recall_at_k = test.partial_test_for_representation(k=params.k_for_recall,
-                                                       all_outputs=all_outputs_test,
-                                                       all_labels=all_labels_test,
-                                                       similarity_network=similarity_learning_network)
+    recall_at_k = evaluate_similarity_network(k=params.k_for_recall,
+                                              all_outputs=all_outputs_test,
+                                              all_labels=all_labels_test,
+                                              similarity_network=similarity_learning_network)
     # reorder outputs and labels for histogramm loss for UKB!!!!!!!
     if params.sampling_for_similarity:
         all_labels_test, indices = torch.sort(all_labels_test)
@@ -279,10 +289,10 @@ def visual_similarity_learning(network, train_loader, test_loader):
         all_outputs_test = all_outputs_test[indices.cuda()]
         print('all_outputs_test sorted ', all_outputs_test)
     print('Evaluation on test after the stage 1 and reordering!')
-    recall_at_k = test.partial_test_for_representation(k=params.k_for_recall,
-                                                       all_outputs=all_outputs_test,
-                                                       all_labels=all_labels_test,
-                                                       similarity_network=similarity_learning_network)
+    recall_at_k = evaluate_similarity_network(k=params.k_for_recall,
+                                              all_outputs=all_outputs_test,
+                                              all_labels=all_labels_test,
+                                              similarity_network=similarity_learning_network)
 
     # *********
     # Stage 2
@@ -308,15 +318,26 @@ def visual_similarity_learning(network, train_loader, test_loader):
                                                                      stage=2,
                                                                      loss_function_name=params.loss_for_similarity)
     print('Evaluation on train after the stage 2')
-    recall_at_k = test.partial_test_for_representation(k=params.k_for_recall,
-                                                       all_outputs=all_outputs_train,
-                                                       all_labels=all_labels_train,
-                                                       similarity_network=similarity_learning_network)
+    recall_at_k = evaluate_similarity_network(k=params.k_for_recall,
+                                              all_outputs=all_outputs_train,
+                                              all_labels=all_labels_train,
+                                              similarity_network=similarity_learning_network)
     print('Evaluation on test after the stage 2')
-    recall_at_k = test.partial_test_for_representation(k=params.k_for_recall,
-                                                       all_outputs=all_outputs_test,
-                                                       all_labels=all_labels_test,
-                                                       similarity_network=similarity_learning_network)
+    recall_at_k = evaluate_similarity_network(k=params.k_for_recall,
+                                              all_outputs=all_outputs_test,
+                                              all_labels=all_labels_test,
+                                              similarity_network=similarity_learning_network)
+
+
+def create_network():
+    network = None
+    if params.network == 'small-resnet':
+        network = small_resnet_for_cifar.small_resnet_for_cifar(num_classes=params.num_classes, n=3).cuda()
+    if params.network == 'resnet-50':
+        # the pretrained fc layer is never created, the new one with L2 - normalization is built at once
+        network = backbones.create_resnet50_for_representation(num_classes=params.num_classes).cuda()
+        print(network)
+    return network
 
 
 def main():
@@ -346,18 +367,8 @@ def main():
 
     print('Create a network ' + params.network)
     network = None
-    if params.network == 'small-resnet' and (params.learn_classification or params.learn_representation):
-        network = small_resnet_for_cifar.small_resnet_for_cifar(num_classes=params.num_classes, n=3).cuda()
-    if params.network == 'resnet-50' and (params.learn_classification or params.learn_representation):
-        network = models.resnet50(pretrained=True).cuda()
-
-        num_ftrs = network.fc.in_features
-        network.fc = torch.nn.Sequential()
-        network.fc.add_module('fc', nn.Linear(num_ftrs, params.num_classes))
-        network.fc.add_module('l2normalization',
-                              small_resnet_for_cifar.L2Normalization())  # need normalization for histogramm loss
-        network = network.cuda()
-        print(network)
+    if params.learn_classification or params.learn_representation:
+        network = create_network()
 
     ##################################################################
     #
@@ -6,10 +6,12 @@ import torch
 import visdom
 from torch.autograd import Variable
 
+import background_evaluation
 import histogramm_loss_for_similarity
 import margin_loss_for_similarity
 import metric_learning_utils
 import params
+import proxy_evaluation
 import test
 import utils
 
@@ -60,6 +62,23 @@ def metric_learning(all_outputs_train, all_labels_train,
     print('reordered cosine_similarity_matrix constant ', cosine_similarity_matrix)
     print('reordered  signs_matrix ', signs_matrix)
 
+    # the worker gets the outputs once, later only the weights of the similarity network
+    background_evaluator = None
+    if params.background_evaluation:
+        background_evaluator = background_evaluation.BackgroundEvaluator(similarity_network,
+                                                                         background_evaluation.evaluate_similarity,
+                                                                         (all_outputs_train.cpu(),
+                                                                          all_labels_train.cpu(),
+                                                                          all_outputs_test.cpu(),
+                                                                          all_labels_test.cpu()))
+
+    # cheap recall on a fixed stratified subset of test queries decides when the full evaluation is worth it
+    proxy_schedule = None
+    if params.proxy_evaluation:
+        proxy_query_indices = proxy_evaluation.get_stratified_query_indices(
+            all_labels_test.cpu().numpy(), params.number_of_proxy_queries_per_class)
+        proxy_schedule = proxy_evaluation.AdaptiveEvaluationSchedule()
+
     for epoch in range(start_epoch,
                        params.number_of_epochs_for_metric_learning):  # loop over the dataset multiple times
         lr_scheduler.step(epoch=epoch)
@@ -155,7 +174,23 @@ def metric_learning(all_outputs_train, all_labels_train,
                              # , update='append',
                              win=loss_plot, opts=options)
 
-        if epoch % 10 == 0:
+        run_full_evaluation = epoch % 10 == 0
+        if proxy_schedule is not None:
+            run_full_evaluation = False
+            if epoch % params.proxy_evaluation_every_epochs == 0:
+                proxy_recall, lower_bound, upper_bound = \
+                    proxy_evaluation.proxy_test_for_representation(k=params.k_for_recall,
+                                                                   query_indices=proxy_query_indices,
+                                                                   all_outputs=all_outputs_test,
+                                                                   all_labels=all_labels_test,
+                                                                   similarity_network=similarity_network)
+                run_full_evaluation = proxy_schedule.should_run_full_evaluation(proxy_recall,
+                                                                                lower_bound,
+                                                                                upper_bound)
+
+        if run_full_evaluation and background_evaluator is not None:
+            background_evaluator.submit(similarity_network, epoch)
+        if run_full_evaluation and background_evaluator is None:
             epochs.append(epoch)
             # print the quality metric
             # Here evaluation is heavy so we do it only every 10 epochs
@@ -177,7 +212,21 @@ def metric_learning(all_outputs_train, all_labels_train,
             recall_at_k = test.partial_test_for_representation(k=params.k_for_recall,
                                                             all_outputs=all_outputs_test, all_labels=all_labels_test,
                                                             similarity_network=similarity_network)
-
+            if proxy_schedule is not None:
+                proxy_schedule.add_full_evaluation_result(recall_at_k)
+
+        if background_evaluator is not None:
+            background_results = background_evaluator.get_results()
+            if proxy_schedule is not None:
+                for _, recalls in background_results:
+                    proxy_schedule.add_full_evaluation_result(recalls[-1])
+            recall_plot = background_evaluation.plot_recall(vis, recall_plot, background_results,
+                                                            r_recall, epochs,
+                                                            legend=['train recall for stage ' + str(stage),
+                                                                    'test recall for stage ' + str(stage)])
+
+        # the checkpoint of every fully evaluated epoch is kept so that the best one can be restored
+        if epoch % 10 == 0 or run_full_evaluation:
             if stage == 1:
                 loss_function_name =''
             else:
@@ -192,4 +241,10 @@ def metric_learning(all_outputs_train, all_labels_train,
         print('total_iteration = ', total_iteration)
 
 
+    if background_evaluator is not None:
+        print('Waiting for the background evaluation')
+        background_evaluation.plot_recall(vis, recall_plot, background_evaluator.close(), r_recall, epochs,
+                                          legend=['train recall for stage ' + str(stage),
+                                                  'test recall for stage ' + str(stage)])
+
     print('Finished Training for similarity learning for stage %d ' % stage)
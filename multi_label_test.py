@@ -0,0 +1,120 @@
+import time
+
+import numpy as np
+import scipy.sparse as sparse
+import torch
+from torch.autograd import Variable
+
+import params
+import test
+
+
+# labels of Centaurus Omniglot images are omniglot.MultiLabels in the CSR form,
+# which are rows of the sparse number_of_images x number_of_labels matrix
+def get_sparse_labels_matrix(multi_labels, indices):
+    labels_matrix = sparse.csr_matrix((np.ones(multi_labels.ids.shape[0], dtype=np.int8), multi_labels.ids,
+                                       multi_labels.offsets),
+                                      shape=(len(multi_labels), multi_labels.number_of_labels))[indices]
+    # the same label can be written twice for the image, it should be counted once
+    labels_matrix.sum_duplicates()
+    labels_matrix.data[:] = 1
+    return labels_matrix
+
+
+# hits[i, j] is True if the query i and its neighbor neighbors_lists[i, j] have at least one common label,
+# rows of the labels matrix are aligned pair by pair, so there is no loop over the pairs
+def get_hits(neighbors_lists, labels_matrix):
+    neighbors_lists = np.asarray(neighbors_lists)
+    number_of_queries, k = neighbors_lists.shape
+    query_rows = labels_matrix[np.repeat(np.arange(number_of_queries), k)]
+    neighbor_rows = labels_matrix[neighbors_lists.reshape(-1)]
+    common_labels = query_rows.multiply(neighbor_rows).tocsr()
+    return (common_labels.getnnz(axis=1) > 0).reshape(number_of_queries, k)
+
+
+# number of other images which have at least one common label with the image
+def get_numbers_of_relevant_images(labels_matrix, block_size=None):
+    if block_size is None:
+        block_size = params.batch_size_for_similarity
+    labels_matrix = labels_matrix.astype(np.int32)
+    transposed = labels_matrix.T.tocsc()
+    numbers_of_relevant = np.zeros(labels_matrix.shape[0], dtype=np.int64)
+    for start in range(0, labels_matrix.shape[0], block_size):
+        overlaps = labels_matrix[start:start + block_size].dot(transposed)
+        # the image itself is always among the images with a common label if it has labels
+        numbers_of_relevant[start:start + block_size] = overlaps.getnnz(axis=1) - \
+                                                        (labels_matrix[start:start + block_size].getnnz(axis=1) > 0)
+    return numbers_of_relevant
+
+
+def get_recall_at_k_from_hits(hits):
+    return float(np.mean(hits))
+
+
+# average precision at k normalized by the number of relevant images which can be in the list of length k
+def get_mean_average_precision_at_k_from_hits(hits, numbers_of_relevant):
+    k = hits.shape[1]
+    precisions = np.cumsum(hits, axis=1) / np.arange(1, k + 1, dtype=np.float64).reshape(1, -1)
+    average_precisions = np.sum(precisions * hits, axis=1) / np.maximum(np.minimum(numbers_of_relevant, k), 1)
+    return float(np.mean(average_precisions))
+
+
+# images are fed to the network flattened as in binary_classification_learning, only the first channel is used
+def get_flattened_images(dataset, indices):
+    images = []
+    for index in indices:
+        image, _ = dataset[index]
+        images.append(image[0].contiguous().view(-1))
+    return torch.stack(images)
+
+
+# fc1 and fc2 of the AllPairs layer with the weights of its fc3 are applied to every image once, by blocks of images
+def get_projections(dataset, indices, network):
+    block_size = params.batch_size_for_similarity
+    projected_gallery = []
+    projected_queries = []
+    for start in range(0, len(indices), block_size):
+        images = Variable(get_flattened_images(dataset, indices[start:start + block_size]), volatile=True).cuda()
+        projected_gallery.append(network.fc1.project_first(images).data)
+        projected_queries.append(network.fc1.project_second(images).data)
+    return Variable(torch.cat(projected_gallery), volatile=True), Variable(torch.cat(projected_queries), volatile=True)
+
+
+def get_multi_labels(dataset):
+    if dataset.train:
+        return dataset.train_labels
+    else:
+        return dataset.test_labels
+
+
+# recall at k and mAP at k for the images with several labels, where the neighbor is relevant if it has
+# any common label with the query, on the fixed random subset of the dataset (all images with number_of_images=None)
+def test_for_multi_label_similarity(dataset, network, k, number_of_images=None):
+    start_time = time.time()
+    multi_labels = get_multi_labels(dataset)
+    if number_of_images is None or number_of_images >= len(multi_labels):
+        indices = np.arange(len(multi_labels))
+    else:
+        # the same subset every time, so evaluations after different epochs are comparable
+        indices = np.sort(np.random.RandomState(0).choice(len(multi_labels), number_of_images, replace=False))
+    labels_matrix = get_sparse_labels_matrix(multi_labels, indices)
+
+    network.eval()
+    projected_gallery, projected_queries = get_projections(dataset, indices, network)
+    # every image is the query and the gallery item, so the image finds itself, we take one more neighbor
+    # and remove the image from its own list
+    _, neighbors_lists = test.get_top_k_from_projections(projected_queries, projected_gallery, network, k + 1,
+                                                         largest=True)
+    network.train()
+    number_of_queries = neighbors_lists.shape[0]
+    is_self = neighbors_lists == np.arange(number_of_queries).reshape(-1, 1)
+    is_self[~is_self.any(axis=1), -1] = True
+    neighbors_lists = neighbors_lists[~is_self].reshape(number_of_queries, k)
+
+    hits = get_hits(neighbors_lists, labels_matrix)
+    recall_at_k = get_recall_at_k_from_hits(hits)
+    mean_average_precision = get_mean_average_precision_at_k_from_hits(hits,
+                                                                       get_numbers_of_relevant_images(labels_matrix))
+    print('recall_at_', k, ' = %f mAP_at_' % recall_at_k, k, ' = %f for %d images in %f s' %
+          (mean_average_precision, number_of_queries, time.time() - start_time))
+    return recall_at_k, mean_average_precision
@@ -1,67 +1,94 @@
+import time
+
 import numpy as np
 import torch.utils.data as data
 import torchvision.transforms as transforms
-from PIL import Image
 from torch.utils.data import Dataset
 from torch.utils.data.sampler import BatchSampler
 
+import compact_tables
+import image_cache
+import image_decoding
 import params
+import records
 from sampling import UniformSampler
 
 
+class MultiLabels(object):
+    """Several labels for every image in the CSR form
+    Arguments:
+        offsets (array of int64) : the labels of the image i are ids[offsets[i]:offsets[i + 1]]
+        ids (array of int32) : numbers of the labels in the vocabulary
+        number_of_labels (int) : size of the vocabulary
+    """
+
+    def __init__(self, offsets, ids, number_of_labels):
+        self.offsets = offsets
+        self.ids = ids
+        self.number_of_labels = number_of_labels
+
+    def __len__(self):
+        return self.offsets.shape[0] - 1
+
+    def __getitem__(self, index):
+        return self.ids[self.offsets[index]:self.offsets[index + 1]]
+
+    def get_lengths(self):
+        return np.diff(self.offsets)
+
+    # multi - hot vector of the labels packed to bits, it has the same size for all images, so it can be batched
+    def get_packed_multi_hot(self, index):
+        multi_hot = np.zeros(self.number_of_labels, dtype=bool)
+        multi_hot[self[index]] = True
+        return np.packbits(multi_hot)
+
+    def __repr__(self):
+        return self.__class__.__name__ + ' (%d images, %d labels, %d ids)' % (len(self), self.number_of_labels,
+                                                                              self.ids.shape[0])
+
+
+# every line of the labels file is 'image label label ...', the vocabulary of the labels is built in one pass
+def read_multi_labels(labels_file):
+    vocabulary = {}
+    ids = []
+    lengths = []
+    with open(labels_file, "r", encoding="utf-8") as f_l:
+        for x in f_l:
+            x = x.replace('\n', '')
+            if x == '':
+                continue
+            labels = x.split(' ')[1:]
+            for label in labels:
+                ids.append(vocabulary.setdefault(label, len(vocabulary)))
+            lengths.append(len(labels))
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return MultiLabels(offsets, np.array(ids, dtype=np.int32), len(vocabulary))
+
+
 def get_filenames_and_labels(data_folder, test_or_train='test'):
-    images_paths = []
-    images_indices = []
-    images_labels = []
-    train_labels = []
-    test_labels = []
-    train_images = []
-    test_images = []
-
-    f_l = open(data_folder + 'labels_natasha_omniglot_%s' % test_or_train, "r", encoding="utf-8")
-    lines_l = f_l.readlines()
-
-    all_possible_labels = []
-    for x in lines_l:
-        x = x.replace('\n', '')
-        labels = x.split(' ')[1:]
-        images_labels.append(labels)
-        all_possible_labels.extend(labels)
-
-    # convert string labels to numeric
-    all_possible_labels = np.asarray(list(set(all_possible_labels)))
-    for labels in images_labels:
-        for i, label in enumerate(labels):
-            #print('np.where(all_possible_labels == str(label))[0][0] ', np.where(all_possible_labels == str(label))[0][0].dtype)
-            labels[i] = (np.where(all_possible_labels == str(label))[0][0])
-            #print('labels[i]', labels[i].dtype)
-        labels = np.array(labels)
-
-
-    for i in range(100000):
-        path = data_folder + ('natasha_omniglot_%s/%d.jpg' % (test_or_train, i))
-        images_paths.append(path)
-        images_indices.append(i)
-        if test_or_train == 'train':
-            train_images.append(path)
-            train_labels.append(images_labels[i])
-        else:    
-            test_labels.append(images_labels[i])
-            test_images.append(path)
-            
+    start_time = time.time()
+    images_labels = read_multi_labels(data_folder + 'labels_natasha_omniglot_%s' % test_or_train)
+    empty_labels = MultiLabels(np.zeros(1, dtype=np.int64), np.zeros(0, dtype=np.int32),
+                               images_labels.number_of_labels)
+
+    # the number of images is the number of lines in the labels file
+    images_indices = np.arange(len(images_labels))
+    # paths are kept in one buffer, so the forked workers of the loader share them
+    images_paths = compact_tables.PathTable([data_folder + ('natasha_omniglot_%s/%d.jpg' % (test_or_train, i))
+                                             for i in images_indices])
+    print('images_labels ', images_labels, ' are read in %f ms' % ((time.time() - start_time) * 1000))
+
     if test_or_train == 'train':
-        images_labels = train_labels
+        train_images = images_paths
+        train_labels = images_labels
+        test_images = compact_tables.PathTable([])
+        test_labels = empty_labels
     else:
-        images_labels = test_labels
-
-    images_labels = np.array(images_labels)
-    train_labels = np.array(train_labels)
-    test_labels = np.array(test_labels)
-    print('images_labels.shape ', images_labels.shape)
-
-    images_indices = np.array(images_indices)
-    train_images = np.array(train_images)
-    test_images = np.array(test_images)
+        train_images = compact_tables.PathTable([])
+        train_labels = empty_labels
+        test_images = images_paths
+        test_labels = images_labels
 
     return images_indices, images_labels, images_paths, train_images, train_labels, test_images, test_labels
 
@@ -84,6 +111,15 @@ class Omniglot(Dataset):
                                                     test_or_train=test_or_train)
 
         print('self.images_labels ', self.images_labels)
+        # images smaller than this after the transformation are reported in __getitem__
+        self.minimum_image_size = params.initial_image_size
+        paths = self.train_images if self.train else self.test_images
+        self.image_cache = None
+        if params.use_image_cache:
+            self.image_cache = image_cache.open_image_cache(list(paths))
+        self.records = None
+        if params.use_records:
+            self.records = records.open_records(list(paths))
 
     def __len__(self):
         if self.train:
@@ -91,25 +127,27 @@ class Omniglot(Dataset):
         else:
             return len(self.test_images)
 
-    def __getitem__(self, index):
-        transform_for_correction = transforms.Compose([
-            transforms.ToPILImage(),
-        ])
+    # decoded image from the cache is not larger than the scale size, transforms.Scale upscales only small ones
+    def open_image(self, index):
+        if self.image_cache is not None:
+            return self.image_cache.get_image(index)
+        if self.records is not None:
+            return self.records.get_image(index)
         if self.train:
-            image = self.transform(Image.open(self.train_images[index]))
-            label = self.train_labels[index]
+            return image_decoding.open_image(self.train_images[index])
         else:
-            image = self.transform(Image.open(self.test_images[index]))
-            label = self.test_labels[index]
+            return image_decoding.open_image(self.test_images[index])
 
-        if image.shape[0] == 1:
-            # print('Grayscale image is found! ', self.images_paths[index])
-            image = transform_for_correction(image)
-            image = transforms.ImageOps.colorize(image, (0, 0, 0), (255, 255, 255))
-            image = self.transform(image)
-            # print('new image.shape ', image.shape)
+    def __getitem__(self, index):
+        # images are already RGB, grayscale ones are converted once when they are opened
+        if self.train:
+            image = self.transform(self.open_image(index))
+            label = self.train_labels.get_packed_multi_hot(index)
+        else:
+            image = self.transform(self.open_image(index))
+            label = self.test_labels.get_packed_multi_hot(index)
 
-        if image.shape[1] < params.initial_image_size or image.shape[2] < params.initial_image_size:
+        if image.shape[1] < self.minimum_image_size or image.shape[2] < self.minimum_image_size:
             print('image is too small', image.shape)
 
         return image, label
@@ -187,8 +225,9 @@ def download_Omniglot_for_representation(data_folder):
 
                                   drop_last=True, # we need to drop last batch because it can had length less than k
                                   # and we won't be able to calculate recall at k
-                                  shuffle=True, # shuffle is extremely importatnt here because we take 10 neighbors
+                                  # shuffle is extremely importatnt here because we take 10 neighbors
                                   # out of 16 images in the batch
+                                  sampler=records.create_shuffling_sampler(new_test_dataset),
                                   num_workers=2)
 
     print('new_train_dataset ', new_train_dataset.__len__())
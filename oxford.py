@@ -0,0 +1,173 @@
+import os
+import time
+
+import numpy as np
+import torch
+import torch.utils.data as data
+import torchvision.transforms as transforms
+from PIL import Image
+from torch.autograd import Variable
+from torch.utils.data import Dataset
+
+import knn_graph
+import params
+import spoc
+import test
+
+
+# Oxford5k: https://www.robots.ox.ac.uk/~vgg/data/oxbuildings/
+# Paris6k: https://www.robots.ox.ac.uk/~vgg/data/parisbuildings/
+# images_folder contains all the jpg images (for Paris they are in the subfolders of landmarks),
+# ground_truth_folder contains files like all_souls_1_query.txt, all_souls_1_good.txt,
+# all_souls_1_ok.txt, all_souls_1_junk.txt for 55 queries
+def get_filenames_and_ground_truth(images_folder, ground_truth_folder):
+    images_paths = []
+    images_names = []
+    for root, _, files in sorted(os.walk(images_folder)):
+        for file in sorted(files):
+            if file.endswith('.jpg'):
+                images_paths.append(os.path.join(root, file))
+                images_names.append(file[:-len('.jpg')])
+    index_of_image = dict((name, index) for index, name in enumerate(images_names))
+
+    queries_names = []
+    queries_indices = []
+    queries_boxes = []
+    good = []
+    ok = []
+    junk = []
+    for file in sorted(os.listdir(ground_truth_folder)):
+        if not file.endswith('_query.txt'):
+            continue
+        query_name = file[:-len('_query.txt')]
+        with open(os.path.join(ground_truth_folder, file), 'r') as f_q:
+            # query line looks like 'oxc1_all_souls_000013 136.5 34.1 648.5 955.9'
+            fields = f_q.readline().split()
+        image_name = fields[0].replace('oxc1_', '')
+        queries_names.append(query_name)
+        queries_indices.append(index_of_image[image_name])
+        queries_boxes.append([float(x) for x in fields[1:5]])
+        for ground_truth, suffix in [(good, '_good.txt'), (ok, '_ok.txt'), (junk, '_junk.txt')]:
+            with open(os.path.join(ground_truth_folder, query_name + suffix), 'r') as f_gt:
+                names = [line.strip() for line in f_gt if line.strip() != '']
+            ground_truth.append(np.array([index_of_image[name] for name in names if name in index_of_image],
+                                         dtype=np.int64))
+
+    print('number of images ', len(images_paths), ' number of queries ', len(queries_names))
+    return images_paths, images_names, queries_names, np.array(queries_indices), np.array(queries_boxes), \
+           good, ok, junk
+
+
+# positive images are good and ok ones, junk images are removed from the ranked lists
+def get_ground_truth_masks(number_of_images, good, ok, junk):
+    number_of_queries = len(good)
+    positive_mask = np.zeros((number_of_queries, number_of_images), dtype=bool)
+    junk_mask = np.zeros((number_of_queries, number_of_images), dtype=bool)
+    for i in range(number_of_queries):
+        positive_mask[i, good[i]] = True
+        positive_mask[i, ok[i]] = True
+        junk_mask[i, junk[i]] = True
+    return positive_mask, junk_mask
+
+
+# ranks is an array number_of_queries x k of the indices of images, the best go first,
+# if k is less than the number of images positives which are not in the list count as not found
+# the same interpolation as in compute_ap.cpp of the Oxford protocol, but for all queries at once
+def get_average_precisions(ranks, positive_mask, junk_mask):
+    rows = np.arange(ranks.shape[0]).reshape(-1, 1)
+    is_junk = junk_mask[rows, ranks]
+    is_positive = positive_mask[rows, ranks] & ~is_junk
+
+    # position of every image in the list without junk images and the number of positives before it
+    positions = np.cumsum(~is_junk, axis=1) - 1
+    positives_before = np.cumsum(is_positive, axis=1) - is_positive
+    precision_before = np.where(positions > 0, positives_before / np.maximum(positions, 1).astype(np.float64), 1.0)
+    precision_after = (positives_before + 1) / (positions + 1).astype(np.float64)
+
+    contributions = np.where(is_positive, (precision_before + precision_after) / 2.0, 0.0)
+    number_of_positives = np.maximum(positive_mask.sum(axis=1), 1)
+    return contributions.sum(axis=1) / number_of_positives
+
+
+def get_mean_average_precision(ranks, positive_mask, junk_mask):
+    start_time = time.time()
+    average_precisions = get_average_precisions(np.asarray(ranks), positive_mask, junk_mask)
+    mean_average_precision = float(np.mean(average_precisions))
+    print('mAP = %f for %d queries in %f ms' % (mean_average_precision, average_precisions.shape[0],
+                                                  (time.time() - start_time) * 1000))
+    return mean_average_precision, average_precisions
+
+
+class OxfordParis(Dataset):
+    def __init__(self, images_folder, ground_truth_folder, transform=None, queries=False):
+        self.transform = transform
+        self.queries = queries
+        self.images_paths, \
+        self.images_names, \
+        self.queries_names, \
+        self.queries_indices, \
+        self.queries_boxes, \
+        self.good, \
+        self.ok, \
+        self.junk = get_filenames_and_ground_truth(images_folder, ground_truth_folder)
+        self.positive_mask, self.junk_mask = get_ground_truth_masks(len(self.images_paths),
+                                                                    self.good, self.ok, self.junk)
+
+    def __len__(self):
+        if self.queries:
+            return len(self.queries_names)
+        else:
+            return len(self.images_paths)
+
+    def __getitem__(self, index):
+        if self.queries:
+            # queries are cropped by their bounding boxes as in the protocol
+            image = Image.open(self.images_paths[self.queries_indices[index]]).convert('RGB')
+            x1, y1, x2, y2 = self.queries_boxes[index]
+            image = image.crop((int(round(x1)), int(round(y1)), int(round(x2)), int(round(y2))))
+        else:
+            image = Image.open(self.images_paths[index]).convert('RGB')
+        return self.transform(image), index
+
+
+def download_OxfordParis_for_retrieval(images_folder, ground_truth_folder):
+    # images are not cropped to the same size, so the batch contains only one image
+    transform = transforms.Compose([
+        transforms.Scale(params.initial_image_scale_size),
+        transforms.ToTensor(),
+    ])
+    images_dataset = OxfordParis(images_folder, ground_truth_folder, transform=transform, queries=False)
+    queries_dataset = OxfordParis(images_folder, ground_truth_folder, transform=transform, queries=True)
+    images_loader = data.DataLoader(images_dataset, batch_size=1, shuffle=False, num_workers=2)
+    queries_loader = data.DataLoader(queries_dataset, batch_size=1, shuffle=False, num_workers=2)
+    return images_loader, queries_loader
+
+
+def get_all_spocs(loader, network):
+    all_spocs = []
+    for images, _ in loader:
+        outputs = network(Variable(images, volatile=True).cuda())
+        all_spocs.append(spoc.compute_spoc_by_outputs(outputs, 'test').data)
+    return torch.cat(all_spocs, dim=0)
+
+
+# ranked lists come from the blocked search, with k = number of images we rank the full dataset
+def test_for_retrieval(query_outputs, images_outputs, positive_mask, junk_mask, k=None):
+    if k is None:
+        k = images_outputs.size(0)
+    if params.reranking == 'none':
+        _, ranks = test.get_neighbors_lists_by_blocks(k, query_outputs, images_outputs)
+    else:
+        _, ranks = knn_graph.get_reranked_neighbors_lists(k, query_outputs, images_outputs)
+    return get_mean_average_precision(ranks, positive_mask, junk_mask)
+
+
+def test_spoc_on_OxfordParis(images_folder, ground_truth_folder, network, PCA_matrix=None, singular_values=None):
+    images_loader, queries_loader = download_OxfordParis_for_retrieval(images_folder, ground_truth_folder)
+    images_spocs = get_all_spocs(images_loader, network)
+    queries_spocs = get_all_spocs(queries_loader, network)
+    if PCA_matrix is not None:
+        images_spocs = spoc.apply_PCA_to_spocs(images_spocs, PCA_matrix, singular_values)
+        queries_spocs = spoc.apply_PCA_to_spocs(queries_spocs, PCA_matrix, singular_values)
+    dataset = images_loader.dataset
+    return test_for_retrieval(queries_spocs, images_spocs, dataset.positive_mask, dataset.junk_mask)
@@ -0,0 +1,94 @@
+import copy
+import time
+
+import numpy as np
+import torch
+import torch.multiprocessing as multiprocessing
+
+import params
+import test
+
+# every worker process keeps here the shared query and gallery outputs, so that they are
+# sent to the worker only once at start and not with every block of queries
+worker_state = {}
+
+
+def initialize_worker(query_outputs, gallery_outputs, similarity_network, k, number_of_threads):
+    torch.set_num_threads(number_of_threads)
+    worker_state['query_outputs'] = query_outputs
+    worker_state['gallery_outputs'] = gallery_outputs
+    worker_state['similarity_network'] = similarity_network
+    worker_state['k'] = k
+
+
+def get_top_k_for_query_block(block):
+    start, stop = block
+    scores, indices = test.get_top_k_for_block(worker_state['query_outputs'][start:stop],
+                                               worker_state['gallery_outputs'],
+                                               worker_state['k'],
+                                               similarity_network=worker_state['similarity_network'])
+    return start, scores.numpy(), indices.numpy()
+
+
+def move_to_shared_memory(outputs):
+    # if outputs are on GPU we get a new cpu tensor, otherwise we move the storage of the given one
+    return outputs.cpu().share_memory_()
+
+
+def get_neighbors_lists_in_parallel(k, query_outputs, gallery_outputs=None, similarity_network=None,
+                                    number_of_workers=None):
+    if number_of_workers is None:
+        number_of_workers = params.number_of_workers_for_evaluation
+
+    query_outputs = move_to_shared_memory(query_outputs)
+    if gallery_outputs is None:
+        gallery_outputs = query_outputs
+    else:
+        gallery_outputs = move_to_shared_memory(gallery_outputs)
+
+    if similarity_network is None:
+        query_block_size = params.query_block_size_for_evaluation
+    else:
+        query_block_size = params.batch_size_for_similarity
+        # workers score the pairs on cpu with their own copy of the weights which lives in the shared memory
+        similarity_network = copy.deepcopy(similarity_network).cpu()
+        similarity_network.eval()
+        similarity_network.share_memory()
+
+    number_of_queries = query_outputs.size(0)
+    blocks = [(start, min(start + query_block_size, number_of_queries))
+              for start in range(0, number_of_queries, query_block_size)]
+
+    all_scores = np.zeros((number_of_queries, k), dtype=np.float32)
+    all_indices = np.zeros((number_of_queries, k), dtype=np.int64)
+
+    start_time = time.time()
+    context = multiprocessing.get_context('fork')
+    pool = context.Pool(processes=number_of_workers,
+                        initializer=initialize_worker,
+                        initargs=(query_outputs, gallery_outputs, similarity_network, k,
+                                  params.number_of_threads_per_evaluation_worker))
+    try:
+        # every worker returns the local top k for its blocks of queries,
+        # the blocks do not intersect so merging is just putting them in place
+        for start, scores, indices in pool.imap_unordered(get_top_k_for_query_block, blocks):
+            all_scores[start:start + scores.shape[0]] = scores
+            all_indices[start:start + indices.shape[0]] = indices
+    finally:
+        pool.close()
+        pool.join()
+    elapsed_time = time.time() - start_time
+    print('%d queries against %d gallery items on %d workers in %f s (%f queries per second)' %
+          (number_of_queries, gallery_outputs.size(0), number_of_workers, elapsed_time,
+           number_of_queries / max(elapsed_time, 1e-12)))
+
+    return all_scores, all_indices
+
+
+def parallel_test_for_representation(k, all_outputs, all_labels, similarity_network=None, number_of_workers=None):
+    _, neighbors_lists = get_neighbors_lists_in_parallel(k, all_outputs,
+                                                         similarity_network=similarity_network,
+                                                         number_of_workers=number_of_workers)
+    recall_at_k = test.get_recall_at_k_from_neighbors_lists(neighbors_lists, all_labels.cpu().numpy())
+    print('recall_at_', k, ' of the network on the ', all_outputs.size(0), ' items: %f ' % recall_at_k)
+    return recall_at_k
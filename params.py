@@ -22,6 +22,17 @@ network = 'resnet-50' # possible values 'small-resnet', 'resnet-50'
 
 initial_image_size = 586 # 224 for resnet-50, 586 for VGG
 initial_image_scale_size = 586 # 256 for resnet-50, 586 for VGG
+use_jpeg_draft = True # decode JPEG at the smallest 1/2, 1/4 or 1/8 scale which is not less than the scale size
+use_image_cache = False # read decoded and scaled images from the uint8 memmap instead of JPEG files
+image_cache_folder = 'image_cache'
+number_of_workers_for_image_cache = 8
+use_records = False # read original JPEG bytes from large shard files instead of one file per image
+records_folder = 'records'
+records_shard_size_in_mb = 256
+records_shuffle_buffer_size = 2048 # shuffled loaders read shards sequentially and shuffle inside this buffer
+records_seed = 0
+weight_registry_folder = 'weight_registry' # pretrained weights of the backbones, see weight_registry.py
+offline_weights = False # never download weights, they should be in the registry
 
 ##################################################################
 #
@@ -62,6 +73,91 @@ distance_type = 'cosine' # possible values l1, euclidean, cosine
 
 delta_for_similarity = 0.05
 
+##################################################################
+#
+# Evaluation parameters
+#
+##################################################################
+
+query_block_size_for_evaluation = 1024 # without similarity network, queries are processed by blocks of this size
+gallery_block_size_for_evaluation = 8192 # and compared with the gallery by blocks of this size
+number_of_workers_for_evaluation = 4
+number_of_threads_per_evaluation_worker = 1 # more threads per worker only fight with other workers for the cores
+
+reranking = 'none' # possible values 'none', 'qe', 'diffusion'
+number_of_query_expansions = 3 # number of top neighbors averaged with the query for 'qe'
+k_for_knn_graph = 50 # number of neighbors of every item in the sparse graph for 'diffusion'
+diffusion_alpha = 0.99
+diffusion_gamma = 3 # similarities are raised to this power to get the weights of the graph
+diffusion_number_of_iterations = 20
+diffusion_tolerance = 1e-6
+diffusion_query_block_size = 64 # the diffusion is solved for this number of queries at once
+
+use_evaluation_cache = True # keep neighbors lists and recall on disk by the hash of the network and the outputs
+evaluation_cache_folder = 'evaluation_cache'
+
+# random subset of Centaurus Omniglot for multi-label evaluation, None for all the images,
+# projections of the AllPairs layer (fc1 or fc2 with the weights of fc3) are 2048 floats for every image,
+# so 10000 images take 2 x 82 MB
+number_of_images_for_multi_label_evaluation = 10000
+
+# the largest gallery for the slow search paths in retrieval_benchmark.py
+benchmark_max_items = {'sklearn': 100000, 'diffusion': 100000}
+background_evaluation = True # evaluate during the training in a separate process
+background_evaluation_queue_size = 1 # snapshots waiting for the evaluation, older ones are dropped
+proxy_evaluation = True # full evaluation only when recall on a subset of queries suggests a new best
+proxy_evaluation_every_epochs = 1
+number_of_proxy_queries_per_class = 1
+proxy_plateau_patience = 10 # run the full evaluation after this number of proxy evaluations without improvement
+z_for_proxy_confidence_interval = 1.96 # 95% confidence interval
+
+##################################################################
+#
+# SPoC parameters
+#
+##################################################################
+
+spoc_dimension = 512 # number of channels of the last convolutional layer of VGG16
+spoc_dimension_after_PCA = 256
+pooling = 'sum' # possible values 'sum', 'max', 'gem', 'regional'
+p_for_gem = 3 # power of the generalized mean, 1 is average pooling and large values are close to max pooling
+eps_for_gem = 1e-6
+number_of_levels_for_regions = 3 # levels of R-MAC regions for 'regional' pooling
+spoc_extractor_checkpoint = 'spoc-extractor' # VGG16, pooling and PCA - whitening saved together
+feature_map_cache_folder = 'feature_map_cache'
+feature_map_cache_chunk_size_in_mb = 1024 # feature maps are appended to fp16 chunk files of this size
+use_memmap_spoc_extraction = True # write SPoCs to memmap files with a manifest, so the extraction can be resumed
+batch_size_for_spoc_extraction = 4
+number_of_workers_for_spoc_extraction = 4
+use_buckets_for_spoc_extraction = False # whole images resized to buckets of similar size instead of crops
+max_side_for_buckets = 586 # the longer side of the image in the bucket
+step_for_buckets = 32 # sides of the buckets are multiples of this
+max_pixels_in_batch_for_buckets = 4 * 586 * 586 # the same number of pixels as 4 cropped images
+spoc_extraction_flush_every_batches = 50 # memmaps and the manifest are written to disk every this number of batches
+PCA_method = 'covariance' # possible values 'svd', 'covariance', 'randomized'
+batch_size_for_PCA = 65536 # SPoCs are read from disk by batches of this size to learn PCA
+randomized_PCA_oversampling = 10
+randomized_PCA_number_of_iterations = 4
+
+##################################################################
+#
+# Retrieval service parameters
+#
+##################################################################
+
+service_port = 8765 # the service listens only on localhost
+service_max_batch_size = 16 # concurrent requests are coalesced into batches up to this size
+service_max_batch_delay_ms = 10 # the first request of the batch waits for others not longer than this
+service_number_of_warm_up_batches = 3
+service_number_of_latencies_for_statistics = 10000
+service_gallery_outputs = 'all_spocs_file_train_after_pca'
+service_gallery_labels = 'all_labels_file_train'
+service_spoc_extractor = '' # if not empty, the SPoC extractor checkpoint is used instead of the network and PCA
+service_PCA_matrix = '' # empty if the representation network output is used without PCA
+service_singular_values = ''
+gallery_index_compaction_threshold = 0.2 # dead items are removed when they are more than this fraction
+gallery_index_fsync = False # fsync the log after every change, slower but survives a power loss
+
 ##################################################################
 #
 # Main flow parameters
@@ -0,0 +1,81 @@
+import numpy as np
+import torch
+
+import params
+import test
+
+
+# fixed subset of queries with the same number of queries for every class,
+# the seed is fixed so that proxy recall of different epochs is computed on the same queries
+def get_stratified_query_indices(labels, number_of_queries_per_class, seed=0):
+    labels = np.asarray(labels)
+    random_state = np.random.RandomState(seed)
+    query_indices = []
+    for label in np.unique(labels):
+        indices_of_label = np.where(labels == label)[0]
+        query_indices.append(random_state.permutation(indices_of_label)[:number_of_queries_per_class])
+    return np.sort(np.concatenate(query_indices))
+
+
+# recall at k for the subset of queries against the full gallery
+# returns recall together with the lower and upper bounds of its confidence interval
+def proxy_test_for_representation(k, query_indices, all_outputs, all_labels, similarity_network=None):
+    all_labels = all_labels.cpu().numpy()
+    query_indices_tensor = torch.from_numpy(query_indices).long()
+    if all_outputs.is_cuda:
+        query_indices_tensor = query_indices_tensor.cuda()
+    query_outputs = all_outputs.index_select(0, query_indices_tensor)
+
+    _, neighbors_lists = test.get_neighbors_lists_by_blocks(k, query_outputs, all_outputs,
+                                                            similarity_network=similarity_network)
+    # fraction of correct labels among the k neighbors for every query, recall is their mean
+    fractions_of_correct_labels = np.mean(all_labels[neighbors_lists] == all_labels[query_indices].reshape(-1, 1),
+                                          axis=1)
+    recall_at_k = float(np.mean(fractions_of_correct_labels))
+    if fractions_of_correct_labels.shape[0] > 1:
+        half_width = params.z_for_proxy_confidence_interval * np.std(fractions_of_correct_labels, ddof=1) / \
+                     np.sqrt(fractions_of_correct_labels.shape[0])
+    else:
+        # the variance is unknown for one query, the interval is not bounded
+        half_width = np.inf
+    print('proxy recall_at_', k, ' on ', query_indices.shape[0], ' queries: %f [%f, %f]' %
+          (recall_at_k, recall_at_k - half_width, recall_at_k + half_width))
+    return recall_at_k, recall_at_k - half_width, recall_at_k + half_width
+
+
+class AdaptiveEvaluationSchedule():
+    """Decides after every proxy evaluation if the full evaluation is needed
+    Arguments:
+        plateau_patience (int) : number of proxy evaluations without a full evaluation
+                                 after which the full evaluation is run anyway
+    The full evaluation is run if the upper bound of the proxy recall is above the best full recall,
+    so the network can be better than the best one, or if the lower bound is above the best proxy recall,
+    so the proxy recall is better than the best one not only because of the noise.
+    """
+
+    def __init__(self, plateau_patience=params.proxy_plateau_patience):
+        self.plateau_patience = plateau_patience
+        self.best_proxy_recall = -np.inf
+        self.best_full_recall = -np.inf
+        self.number_of_evaluations_without_improvement = 0
+
+    # test recall of the full evaluation, for the background evaluation it comes some epochs later
+    def add_full_evaluation_result(self, full_recall):
+        self.best_full_recall = max(self.best_full_recall, full_recall)
+
+    def should_run_full_evaluation(self, proxy_recall, lower_bound, upper_bound):
+        best_proxy_recall = self.best_proxy_recall
+        self.best_proxy_recall = max(self.best_proxy_recall, proxy_recall)
+        if upper_bound > self.best_full_recall or lower_bound > best_proxy_recall:
+            print('proxy recall %f [%f, %f] suggests a new best, best full recall is %f, best proxy recall is %f' %
+                  (proxy_recall, lower_bound, upper_bound, self.best_full_recall, best_proxy_recall))
+            self.number_of_evaluations_without_improvement = 0
+            return True
+
+        self.number_of_evaluations_without_improvement = self.number_of_evaluations_without_improvement + 1
+        if self.number_of_evaluations_without_improvement >= self.plateau_patience:
+            print('proxy recall is on plateau for %d evaluations, best full recall is %f, current interval [%f, %f]' %
+                  (self.number_of_evaluations_without_improvement, self.best_full_recall, lower_bound, upper_bound))
+            self.number_of_evaluations_without_improvement = 0
+            return True
+        return False
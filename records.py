@@ -0,0 +1,153 @@
+import argparse
+import hashlib
+import io
+import os
+import time
+
+import numpy as np
+from torch.utils.data.sampler import RandomSampler
+from torch.utils.data.sampler import Sampler
+
+import UKB
+import birds
+import image_decoding
+import omniglot
+import params
+
+
+# original JPEG bytes of the images are packed one after another into large shard files,
+# index.npy keeps shard, offset and length of every image, so an image is one read from an open file
+# and the images of a shard are read sequentially
+def get_records_folder(paths):
+    sha1 = hashlib.sha1('\n'.join(str(path) for path in paths).encode('utf-8'))
+    return os.path.join(params.records_folder, sha1.hexdigest())
+
+
+def get_shard_path(folder, shard):
+    return os.path.join(folder, 'shard-%05d.records' % shard)
+
+
+def pack(paths, folder):
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    start_time = time.time()
+    shard_size = params.records_shard_size_in_mb * 1024 * 1024
+    index = np.zeros((len(paths), 3), dtype=np.int64)
+    shard = 0
+    offset = 0
+    shard_file = open(get_shard_path(folder, shard), 'wb')
+    try:
+        for position, path in enumerate(paths):
+            with open(path, 'rb') as f:
+                content = f.read()
+            if offset > 0 and offset + len(content) > shard_size:
+                shard_file.close()
+                shard = shard + 1
+                offset = 0
+                shard_file = open(get_shard_path(folder, shard), 'wb')
+            shard_file.write(content)
+            index[position] = [shard, offset, len(content)]
+            offset = offset + len(content)
+            if (position + 1) % 10000 == 0:
+                print('progress %d / %d' % (position + 1, len(paths)))
+    finally:
+        shard_file.close()
+    # the index is written last, so the records with the index are complete
+    np.save(os.path.join(folder, 'index.npy'), index)
+    print('%d images are packed to %d shards in %f s' % (len(paths), shard + 1, time.time() - start_time))
+
+
+class Records(object):
+    """Reader of the images packed by pack
+    Arguments:
+        folder (string) : folder with the shards and index.npy
+    Files are opened again in every process, because the workers of the loader must not share file offsets.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.index = np.load(os.path.join(folder, 'index.npy'))
+        self.number_of_shards = int(self.index[:, 0].max()) + 1 if self.index.shape[0] > 0 else 0
+        self.files = None
+        self.pid = None
+
+    def __len__(self):
+        return self.index.shape[0]
+
+    def get_bytes(self, index):
+        if self.pid != os.getpid():
+            self.files = [open(get_shard_path(self.folder, shard), 'rb') for shard in range(self.number_of_shards)]
+            self.pid = os.getpid()
+        shard, offset, length = self.index[index]
+        shard_file = self.files[shard]
+        shard_file.seek(offset)
+        return shard_file.read(length)
+
+    def get_image(self, index):
+        return image_decoding.open_image(io.BytesIO(self.get_bytes(index)))
+
+
+def open_records(paths):
+    folder = get_records_folder(paths)
+    if not os.path.exists(os.path.join(folder, 'index.npy')):
+        print('pack %d images to ' % len(paths), folder)
+        pack(paths, folder)
+    return Records(folder)
+
+
+class ShardOrderedSampler(Sampler):
+    """Random order of the images which reads every shard sequentially
+    Arguments:
+        records (Records) : packed images
+        buffer_size (int) : images are shuffled inside the buffer of this size
+    Shards go in the random order, the images of the shard go in the order of the file into the buffer,
+    and the random image of the buffer is taken every time.
+    """
+
+    def __init__(self, records, buffer_size=None):
+        self.records = records
+        self.buffer_size = buffer_size if buffer_size is not None else params.records_shuffle_buffer_size
+        self.epoch = 0
+
+    def __iter__(self):
+        random_state = np.random.RandomState(params.records_seed + self.epoch)
+        self.epoch = self.epoch + 1
+        order = np.lexsort((self.records.index[:, 1], random_state.permutation(self.records.number_of_shards)
+                            [self.records.index[:, 0]]))
+        buffer = []
+        for index in order:
+            buffer.append(int(index))
+            if len(buffer) >= self.buffer_size:
+                position = random_state.randint(len(buffer))
+                buffer[position], buffer[-1] = buffer[-1], buffer[position]
+                yield buffer.pop()
+        random_state.shuffle(buffer)
+        for index in buffer:
+            yield index
+
+    def __len__(self):
+        return len(self.records)
+
+
+# the sampler for the loaders with shuffle=True
+def create_shuffling_sampler(dataset):
+    if getattr(dataset, 'records', None) is not None:
+        return ShardOrderedSampler(dataset.records)
+    return RandomSampler(dataset)
+
+
+def main():
+    datasets = {'UKB': lambda split: UKB.UKB('ukbench/full', test_or_train=split),
+                'BIRDS100': lambda split: birds.BIRDS100('CUB_200_2011', test_or_train=split),
+                'Omniglot': lambda split: omniglot.Omniglot('', test_or_train=split)}
+    parser = argparse.ArgumentParser(description='Pack the images of the datasets to shards')
+    parser.add_argument('datasets', nargs='+', help='UKB, BIRDS100 or Omniglot')
+    arguments = parser.parse_args()
+    for name in arguments.datasets:
+        for split in ['train', 'test']:
+            dataset = datasets[name](split)
+            open_records(list(dataset.train_images if dataset.train else dataset.test_images))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+import argparse
+import json
+import queue
+import resource
+import time
+
+import numpy as np
+import torch
+import torch.multiprocessing as multiprocessing
+import torch.utils.data as data
+import torchvision.transforms as transforms
+from torch.autograd import Variable
+
+import UKB
+import main
+import params
+import spoc
+import test
+import utils
+
+
+# the same transformation as the test transformation of UKB, but for the given resolution
+def create_test_loader(data_folder, resolution, batch_size):
+    transform = transforms.Compose([
+        transforms.Scale(resolution),
+        transforms.CenterCrop(resolution),
+        transforms.ToTensor(),
+    ])
+    dataset = UKB.UKB(data_folder=data_folder, transform=transform, test_or_train='test')
+    # images are smaller than params.initial_image_size at small resolutions on purpose
+    dataset.minimum_image_size = resolution
+    return data.DataLoader(dataset, batch_size=batch_size, shuffle=False,
+                           num_workers=params.number_of_workers_for_spoc_extraction)
+
+
+# 'spoc' is VGG16 with sum pooling (and PCA if it is given), 'representation' is the network from the checkpoint
+def create_embedding(backbone, epoch, PCA_matrix_file, singular_values_file):
+    if backbone == 'spoc':
+        network = spoc.create_representation_network()
+        network.eval()
+        PCA_matrix, singular_values = None, None
+        if PCA_matrix_file is not None:
+            PCA_matrix = torch.load(PCA_matrix_file).cuda()
+            singular_values = torch.load(singular_values_file).cuda()
+
+        def embed(images):
+            spocs = spoc.compute_spoc_by_outputs(network(Variable(images, volatile=True).cuda()), 'test').data
+            if PCA_matrix is not None:
+                spocs = spoc.apply_PCA_to_spocs(spocs, PCA_matrix, singular_values)
+            return spocs
+        return embed
+
+    network = utils.load_network_from_checkpoint(network=main.create_network(), epoch=epoch,
+                                                 name_prefix_for_saved_model=
+                                                 params.name_prefix_for_saved_model_for_representation)
+    network.eval()
+    return lambda images: network(Variable(images, volatile=True).cuda()).data
+
+
+# latency is measured for single images, so it does not depend on the batch size
+def measure_latency(embed, loader, number_of_images):
+    latencies = []
+    for images, _ in loader:
+        for image in images:
+            torch.cuda.synchronize()
+            start_time = time.time()
+            embed(image.unsqueeze(0))
+            torch.cuda.synchronize()
+            latencies.append(time.time() - start_time)
+            if len(latencies) >= number_of_images:
+                return np.array(latencies)
+    return np.array(latencies)
+
+
+def evaluate_resolution(arguments, resolution, results):
+    embed = create_embedding(arguments.backbone, arguments.epoch, arguments.pca, arguments.singular_values)
+    loader = create_test_loader(arguments.data_folder, resolution, arguments.batch_size)
+
+    # the first batches are slow because of cudnn autotuning and memory allocation
+    for i, (images, _) in enumerate(loader):
+        embed(images)
+        if i + 1 >= params.service_number_of_warm_up_batches:
+            break
+    latencies = measure_latency(embed, loader, arguments.latency_images)
+
+    all_outputs = []
+    all_labels = []
+    torch.cuda.synchronize()
+    start_time = time.time()
+    for images, labels in loader:
+        all_outputs.append(embed(images))
+        all_labels.append(labels)
+    torch.cuda.synchronize()
+    total_time = time.time() - start_time
+    all_outputs = torch.cat(all_outputs, dim=0)
+    all_labels = torch.cat(all_labels, dim=0)
+
+    _, neighbors_lists = test.get_neighbors_lists_by_blocks(params.k_for_recall, all_outputs)
+    results.put({'resolution': resolution,
+                 'recall_at_k': test.get_recall_at_k_from_neighbors_lists(neighbors_lists, all_labels.numpy()),
+                 'k': params.k_for_recall,
+                 'mean_latency_ms': float(np.mean(latencies) * 1000),
+                 'p95_latency_ms': float(np.percentile(latencies, 95) * 1000),
+                 'images_per_second': all_outputs.size(0) / total_time,
+                 'batch_size': arguments.batch_size,
+                 'peak_gpu_memory_mb': torch.cuda.max_memory_allocated() / (1024.0 * 1024.0),
+                 # ru_maxrss is in kilobytes on linux
+                 'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0})
+
+
+# the result of the process or None if it has exited without the result
+def wait_for_result(process, results, poll_timeout=5):
+    while True:
+        try:
+            return results.get(timeout=poll_timeout)
+        except queue.Empty:
+            if not process.is_alive():
+                # the result can be put just before the exit
+                try:
+                    return results.get(timeout=1)
+                except queue.Empty:
+                    return None
+
+
+def run():
+    parser = argparse.ArgumentParser(description='Recall, latency, throughput and memory for input resolutions')
+    parser.add_argument('--resolutions', type=int, nargs='+', default=[224, 320, 448, 586, 768])
+    parser.add_argument('--backbone', default='spoc', help='spoc or representation')
+    parser.add_argument('--epoch', type=int, default=params.default_recovery_epoch_for_representation,
+                        help='epoch of the representation network checkpoint')
+    parser.add_argument('--pca', default=None, help='PCA_matrix file for spoc')
+    parser.add_argument('--singular-values', default='singular_values')
+    parser.add_argument('--data-folder', default='ukbench/full')
+    parser.add_argument('--batch-size', type=int, default=params.batch_size_for_spoc_extraction)
+    parser.add_argument('--latency-images', type=int, default=100)
+    parser.add_argument('--report', default='resolution_sweep.json')
+    arguments = parser.parse_args()
+
+    # every resolution runs in its own process, so peak memory of one resolution does not hide the others
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    report = []
+    for resolution in arguments.resolutions:
+        process = context.Process(target=evaluate_resolution, args=(arguments, resolution, results))
+        process.start()
+        result = wait_for_result(process, results)
+        process.join()
+        if result is None:
+            # e.g. CUDA out of memory at a large resolution, the other resolutions are still evaluated
+            result = {'resolution': resolution, 'failed': True, 'exitcode': process.exitcode}
+        print(result)
+        report.append(result)
+
+    print('\t'.join(['resolution', 'recall@%d' % params.k_for_recall, 'latency ms', 'p95 ms', 'images/s',
+                     'GPU MB', 'RSS MB']))
+    for result in report:
+        if result.get('failed', False):
+            print('%d\tfailed with exit code %s' % (result['resolution'], result['exitcode']))
+            continue
+        print('%d\t%f\t%f\t%f\t%f\t%f\t%f' % (result['resolution'], result['recall_at_k'],
+                                              result['mean_latency_ms'], result['p95_latency_ms'],
+                                              result['images_per_second'], result['peak_gpu_memory_mb'],
+                                              result['peak_rss_mb']))
+    with open(arguments.report, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('report is saved to ', arguments.report)
+
+
+if __name__ == '__main__':
+    run()
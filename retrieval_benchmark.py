@@ -0,0 +1,217 @@
+import argparse
+import json
+import queue
+import resource
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import torch
+import torch.multiprocessing as multiprocessing
+from sklearn.neighbors import NearestNeighbors
+
+import gallery_index
+import knn_graph
+import parallel_test
+import params
+import test
+
+
+# normalized embeddings around random cluster centers, the label of the item is its cluster
+def generate_clustered_embeddings(number_of_items, representation_length, number_of_clusters, noise, seed=0):
+    random_state = np.random.RandomState(seed)
+    centers = random_state.standard_normal((number_of_clusters, representation_length)).astype(np.float32)
+    centers = centers / np.linalg.norm(centers, axis=1).reshape(-1, 1)
+    labels = random_state.randint(low=0, high=number_of_clusters, size=number_of_items).astype(np.int64)
+    embeddings = np.empty((number_of_items, representation_length), dtype=np.float32)
+    # by chunks, so that 1M items do not need the float64 copy of the whole array
+    chunk_size = 65536
+    for start in range(0, number_of_items, chunk_size):
+        stop = min(start + chunk_size, number_of_items)
+        chunk = centers[labels[start:stop]] + noise / np.sqrt(representation_length) * \
+                random_state.standard_normal((stop - start, representation_length)).astype(np.float32)
+        embeddings[start:stop] = chunk / np.linalg.norm(chunk, axis=1).reshape(-1, 1)
+    return embeddings, labels
+
+
+def get_current_rss_in_mb():
+    with open('/proc/self/status', 'r') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) / 1024.0
+    return 0.0
+
+
+##################################################################
+#
+# Search paths, every one returns the build time and the neighbors lists of the queries
+#
+##################################################################
+
+def search_with_sklearn(k, gallery, queries):
+    # the same search as in test.get_neighbors_lists
+    start_time = time.time()
+    neigh = NearestNeighbors(n_neighbors=k, p=2)
+    neigh.fit(gallery)
+    build_time = time.time() - start_time
+    return build_time, neigh.kneighbors(queries, return_distance=False)
+
+
+def search_with_blocks(k, gallery, queries):
+    _, neighbors_lists = test.get_neighbors_lists_by_blocks(k, torch.from_numpy(queries), torch.from_numpy(gallery))
+    return 0.0, neighbors_lists
+
+
+def search_in_parallel(k, gallery, queries):
+    _, neighbors_lists = parallel_test.get_neighbors_lists_in_parallel(k, torch.from_numpy(queries),
+                                                                       torch.from_numpy(gallery))
+    return 0.0, neighbors_lists
+
+
+def search_in_gallery_index(k, gallery, queries):
+    folder = tempfile.mkdtemp(prefix='gallery-index-benchmark-')
+    try:
+        start_time = time.time()
+        index = gallery_index.GalleryIndex(folder, gallery.shape[1], initial_capacity=gallery.shape[0])
+        index.add(gallery, np.zeros(gallery.shape[0], dtype=np.int64))
+        build_time = time.time() - start_time
+        # ids of the items are their positions because they were added to the empty index in order
+        _, neighbors_lists, _ = index.search(queries, k)
+        index.log.close()
+        return build_time, neighbors_lists
+    finally:
+        shutil.rmtree(folder)
+
+
+def search_with_diffusion(k, gallery, queries):
+    start_time = time.time()
+    graph = knn_graph.build_knn_graph(gallery, params.k_for_knn_graph)
+    build_time = time.time() - start_time
+    _, neighbors_lists = knn_graph.rerank_with_diffusion(k, queries, gallery, graph=graph)
+    return build_time, neighbors_lists
+
+
+search_paths = {'sklearn': search_with_sklearn,
+                'blocked': search_with_blocks,
+                'parallel': search_in_parallel,
+                'gallery_index': search_in_gallery_index,
+                'diffusion': search_with_diffusion}
+
+
+def run_search_path(name, k, gallery, queries, results):
+    rss_at_start = get_current_rss_in_mb()
+    start_time = time.time()
+    build_time, neighbors_lists = search_paths[name](k, gallery, queries)
+    total_time = time.time() - start_time
+    # ru_maxrss is in kilobytes on linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    results.put({'build_time': build_time,
+                 'search_time': total_time - build_time,
+                 'peak_rss_mb': peak_rss,
+                 'peak_rss_increase_mb': peak_rss - rss_at_start,
+                 'neighbors_lists': np.asarray(neighbors_lists)})
+
+
+# every path runs in its own forked process, so that peak memory of one path does not hide the others
+def measure_search_path(name, k, gallery, queries):
+    context = multiprocessing.get_context('fork')
+    results = context.Queue()
+    process = context.Process(target=run_search_path, args=(name, k, gallery, queries, results))
+    process.start()
+    result = wait_for_result(process, results)
+    process.join()
+    if result is None:
+        # e.g. the path raised or was killed because of the memory, the other paths are still measured
+        print('%s failed with exit code %s' % (name, process.exitcode))
+        return {'failed': True, 'exitcode': process.exitcode}
+    return result
+
+
+# the result of the process or None if it has exited without the result
+def wait_for_result(process, results, poll_timeout=5):
+    while True:
+        try:
+            return results.get(timeout=poll_timeout)
+        except queue.Empty:
+            if not process.is_alive():
+                # the result can be put just before the exit
+                try:
+                    return results.get(timeout=1)
+                except queue.Empty:
+                    return None
+
+
+# queries are items of the gallery, so every query finds itself, it is removed from its list
+# (the last neighbor is removed if the path has not found the query itself)
+def remove_queries_from_neighbors_lists(neighbors_lists, query_indices, k):
+    neighbors_lists = np.asarray(neighbors_lists)
+    is_self = neighbors_lists == query_indices.reshape(-1, 1)
+    is_self[~is_self.any(axis=1), -1] = True
+    return neighbors_lists[~is_self].reshape(neighbors_lists.shape[0], k)
+
+
+def benchmark(sizes, paths, k, representation_length, number_of_queries, number_of_clusters, noise):
+    report = {'k': k, 'representation_length': representation_length, 'number_of_queries': number_of_queries,
+              'number_of_clusters': number_of_clusters, 'noise': noise, 'results': []}
+    for number_of_items in sizes:
+        print('generating %d items' % number_of_items)
+        gallery, labels = generate_clustered_embeddings(number_of_items, representation_length,
+                                                        number_of_clusters, noise)
+        query_indices = np.random.RandomState(1).choice(number_of_items, min(number_of_queries, number_of_items),
+                                                        replace=False)
+        queries = gallery[query_indices]
+        exact_neighbors_lists = None
+
+        for name in paths:
+            if number_of_items > params.benchmark_max_items.get(name, number_of_items):
+                print('%s is skipped for %d items' % (name, number_of_items))
+                continue
+            print('%s for %d items' % (name, number_of_items))
+            result = measure_search_path(name, k + 1, gallery, queries)
+            result['name'] = name
+            result['number_of_items'] = number_of_items
+            if result.get('failed', False):
+                report['results'].append(result)
+                continue
+            neighbors_lists = remove_queries_from_neighbors_lists(result.pop('neighbors_lists'), query_indices, k)
+            if name == 'blocked':
+                exact_neighbors_lists = neighbors_lists
+            result['queries_per_second'] = queries.shape[0] / max(result['search_time'], 1e-12)
+            result['recall_at_k'] = test.get_recall_at_k_from_neighbors_lists(neighbors_lists,
+                                                                              labels[query_indices], labels)
+            if exact_neighbors_lists is not None:
+                # fraction of the exact k nearest neighbors which are found by this path
+                result['overlap_with_exact'] = float(np.mean([np.intersect1d(a, b).shape[0] / float(k)
+                                                              for a, b in zip(neighbors_lists,
+                                                                              exact_neighbors_lists)]))
+            print(result)
+            report['results'].append(result)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Scaling of the evaluation and search with the gallery size')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument('--paths', nargs='+', default=['blocked', 'sklearn', 'parallel', 'gallery_index',
+                                                       'diffusion'],
+                        help='blocked should go first, other paths are compared with it')
+    parser.add_argument('--k', type=int, default=params.k_for_recall)
+    parser.add_argument('--dimension', type=int, default=256)
+    parser.add_argument('--queries', type=int, default=1000)
+    parser.add_argument('--clusters', type=int, default=1000)
+    # the norm of the noise of every item, with 0.5 the clusters are separated and every path has recall 1,
+    # with 2.0 the items of the same cluster are only a little closer than the items of the other clusters
+    parser.add_argument('--noise', type=float, default=2.0)
+    parser.add_argument('--report', default='retrieval_benchmark.json')
+    arguments = parser.parse_args()
+
+    report = benchmark(arguments.sizes, arguments.paths, arguments.k, arguments.dimension,
+                       arguments.queries, arguments.clusters, arguments.noise)
+    with open(arguments.report, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('report is saved to ', arguments.report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,313 @@
+import argparse
+import io
+import json
+import os
+import queue
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import torch
+import torchvision.transforms as transforms
+from PIL import Image
+from torch.autograd import Variable
+
+import gallery_index
+import main
+import params
+import spoc
+import test
+import utils
+
+
+def create_transformation_for_queries():
+    # the same as transform_test of the datasets, so that all the images of the batch have the same size
+    return transforms.Compose([
+        transforms.Scale(params.initial_image_scale_size),
+        transforms.CenterCrop(params.initial_image_size),
+        transforms.ToTensor(),
+    ])
+
+
+class Gallery():
+    """Exact search over the gallery outputs kept on the same device as the network
+    Arguments:
+        outputs (Tensor) : number_of_items x representation_length
+        labels (LongTensor) : number_of_items
+    """
+
+    def __init__(self, outputs, labels):
+        self.outputs = outputs
+        self.labels = labels.cpu().numpy()
+
+    def search(self, query_outputs, k):
+        distances, indices = test.get_top_k_for_block(query_outputs, self.outputs, k)
+        indices = indices.cpu().numpy()
+        return distances.cpu().numpy(), indices, self.labels[indices]
+
+
+class Statistics():
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=params.service_number_of_latencies_for_statistics)
+        self.batch_sizes = deque(maxlen=params.service_number_of_latencies_for_statistics)
+        self.number_of_requests = 0
+        self.start_time = time.time()
+
+    def add_batch(self, latencies):
+        with self.lock:
+            self.latencies.extend(latencies)
+            self.batch_sizes.append(len(latencies))
+            self.number_of_requests = self.number_of_requests + len(latencies)
+
+    def get(self):
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000
+            batch_sizes = np.array(self.batch_sizes)
+            number_of_requests = self.number_of_requests
+        elapsed_time = time.time() - self.start_time
+        statistics = {'number_of_requests': number_of_requests,
+                      'throughput': number_of_requests / elapsed_time,
+                      'mean_batch_size': float(np.mean(batch_sizes)) if batch_sizes.shape[0] > 0 else 0.0}
+        for percentile in [50, 90, 99]:
+            statistics['latency_p%d_ms' % percentile] = \
+                float(np.percentile(latencies, percentile)) if latencies.shape[0] > 0 else 0.0
+        return statistics
+
+
+class Request():
+    def __init__(self, image, k):
+        self.image = image
+        self.k = k
+        self.arrival_time = time.time()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class RetrievalService():
+    """Answers image -> top k requests, coalescing concurrent requests into micro-batches
+    Arguments:
+        network : representation network, already loaded from the checkpoint
+        gallery (Gallery) : the outputs of the gallery images
+        PCA_matrix, singular_values : optional PCA which was used for the gallery
+    """
+
+    def __init__(self, network, gallery, PCA_matrix=None, singular_values=None):
+        self.network = network
+        self.network.eval()
+        self.gallery = gallery
+        self.PCA_matrix = PCA_matrix
+        self.singular_values = singular_values
+        self.transform = create_transformation_for_queries()
+        self.requests = queue.Queue()
+        # the network is used by the batching thread and by the threads which add new gallery items
+        self.network_lock = threading.Lock()
+        self.statistics = Statistics()
+        self.thread = threading.Thread(target=self.batching_loop)
+        self.thread.daemon = True
+
+    def embed(self, images):
+        with self.network_lock:
+            outputs = self.network(Variable(images, volatile=True).cuda()).data
+        if self.PCA_matrix is not None:
+            outputs = spoc.apply_PCA_to_spocs(outputs, self.PCA_matrix, self.singular_values)
+        return outputs
+
+    def warm_up(self):
+        # first batches are slow because of cudnn autotuning and memory allocation
+        for batch_size in [1, params.service_max_batch_size] * params.service_number_of_warm_up_batches:
+            images = torch.zeros(batch_size, 3, params.initial_image_size, params.initial_image_size)
+            self.gallery.search(self.embed(images), params.k_for_recall)
+        print('warm up is finished')
+
+    def start(self):
+        self.warm_up()
+        self.statistics = Statistics()
+        self.thread.start()
+
+    def get_batch(self):
+        batch = [self.requests.get()]
+        # under load the queued requests are already older than the delay, they are taken without waiting
+        while len(batch) < params.service_max_batch_size:
+            try:
+                batch.append(self.requests.get_nowait())
+            except queue.Empty:
+                break
+        deadline = batch[0].arrival_time + params.service_max_batch_delay_ms / 1000.0
+        while len(batch) < params.service_max_batch_size:
+            remaining_time = deadline - time.time()
+            if remaining_time <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=remaining_time))
+            except queue.Empty:
+                break
+        return batch
+
+    def batching_loop(self):
+        while True:
+            batch = self.get_batch()
+            try:
+                images = torch.stack([request.image for request in batch], dim=0)
+                k = max(request.k for request in batch)
+                distances, indices, labels = self.gallery.search(self.embed(images), k)
+                for i, request in enumerate(batch):
+                    request.result = {'neighbors': indices[i, :request.k].tolist(),
+                                      'labels': labels[i, :request.k].tolist(),
+                                      'distances': distances[i, :request.k].tolist()}
+            except Exception as exception:
+                for request in batch:
+                    request.error = str(exception)
+            finish_time = time.time()
+            self.statistics.add_batch([finish_time - request.arrival_time for request in batch])
+            for request in batch:
+                request.done.set()
+
+    # called from the threads of the http server
+    def search(self, image_bytes, k):
+        image = Image.open(io.BytesIO(image_bytes)).convert('RGB')
+        request = Request(self.transform(image), k)
+        self.requests.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise Exception(request.error)
+        return request.result
+
+    # only for the mutable gallery index, the new items are searchable right after the answer
+    def add_to_gallery(self, image_bytes, label):
+        image = self.transform(Image.open(io.BytesIO(image_bytes)).convert('RGB'))
+        outputs = self.embed(image.unsqueeze(0))
+        return {'ids': self.gallery.add(outputs.cpu().numpy(), [label]).tolist()}
+
+    def delete_from_gallery(self, ids):
+        return {'deleted': self.gallery.delete(ids)}
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def create_request_handler(service):
+    class RequestHandler(BaseHTTPRequestHandler):
+        def send_json(self, code, answer):
+            body = json.dumps(answer).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if urlparse(self.path).path == '/stats':
+                self.send_json(200, service.statistics.get())
+            else:
+                self.send_json(404, {'error': 'unknown path'})
+
+        # POST /search?k=4 with the image file as the body
+        # POST /add?label=7 with the image file as the body and POST /delete?id=1&id=2 for the gallery index
+        def do_POST(self):
+            url = urlparse(self.path)
+            query = parse_qs(url.query)
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            try:
+                if url.path == '/search':
+                    self.send_json(200, service.search(body, int(query.get('k', [params.k_for_recall])[0])))
+                elif url.path == '/add' and isinstance(service.gallery, gallery_index.GalleryIndex):
+                    self.send_json(200, service.add_to_gallery(body, int(query.get('label', [-1])[0])))
+                elif url.path == '/delete' and isinstance(service.gallery, gallery_index.GalleryIndex):
+                    self.send_json(200, service.delete_from_gallery([int(x) for x in query.get('id', [])]))
+                else:
+                    self.send_json(404, {'error': 'unknown path'})
+            except Exception as exception:
+                self.send_json(500, {'error': str(exception)})
+
+        def log_message(self, format, *args):
+            pass
+
+    return RequestHandler
+
+
+def build_gallery_from_folder(service, folder, file_outputs, file_labels):
+    # every image of the folder is a separate item, its label is its index in the sorted list of files
+    files = sorted(file for file in os.listdir(folder) if file.lower().endswith(('.jpg', '.jpeg', '.png')))
+    all_outputs = []
+    for start in range(0, len(files), params.service_max_batch_size):
+        images = [service.transform(Image.open(os.path.join(folder, file)).convert('RGB'))
+                  for file in files[start:start + params.service_max_batch_size]]
+        all_outputs.append(service.embed(torch.stack(images, dim=0)))
+    all_outputs = torch.cat(all_outputs, dim=0)
+    all_labels = torch.arange(0, len(files)).long()
+    torch.save(all_outputs, file_outputs)
+    torch.save(all_labels, file_labels)
+    with open(file_labels + '-files.txt', 'w') as fout:
+        fout.write('\n'.join(files) + '\n')
+    return all_outputs, all_labels
+
+
+# the queries and the gallery must be embedded by the same network, e.g. the representation network outputs
+# cannot be searched among SPoCs, so the service does not start with the gallery of another width
+def check_gallery_width(service, gallery_outputs):
+    images = torch.zeros(1, 3, params.initial_image_size, params.initial_image_size)
+    query_width = service.embed(images).size(1)
+    if gallery_outputs.size(1) != query_width:
+        raise ValueError('gallery outputs have width %d, but queries are embedded to width %d, '
+                         'the gallery must be built by the same network (see --build-gallery-from)' %
+                         (gallery_outputs.size(1), query_width))
+
+
+def create_service(epoch, name_prefix_for_saved_model):
+    if params.service_spoc_extractor != '':
+        # PCA - whitening is inside the extractor, so queries are embedded by one forward call
+        return spoc.load_spoc_extractor(params.service_spoc_extractor).cuda(), None, None
+    network = utils.load_network_from_checkpoint(network=main.create_network(),
+                                                 epoch=epoch,
+                                                 name_prefix_for_saved_model=name_prefix_for_saved_model)
+    PCA_matrix, singular_values = None, None
+    if params.service_PCA_matrix != '':
+        PCA_matrix = torch.load(params.service_PCA_matrix).cuda()
+        singular_values = torch.load(params.service_singular_values).cuda()
+    return network, PCA_matrix, singular_values
+
+
+def run():
+    parser = argparse.ArgumentParser(description='Local image retrieval service')
+    parser.add_argument('--epoch', type=int, default=params.default_recovery_epoch_for_representation)
+    parser.add_argument('--prefix', default=params.name_prefix_for_saved_model_for_representation)
+    parser.add_argument('--gallery-outputs', default=params.service_gallery_outputs)
+    parser.add_argument('--gallery-labels', default=params.service_gallery_labels)
+    parser.add_argument('--build-gallery-from', default=None, help='folder with gallery images to embed first')
+    parser.add_argument('--gallery-index', default=None,
+                        help='folder of the mutable gallery index, it is created from the gallery outputs if empty')
+    parser.add_argument('--port', type=int, default=params.service_port)
+    arguments = parser.parse_args()
+
+    network, PCA_matrix, singular_values = create_service(arguments.epoch, arguments.prefix)
+    service = RetrievalService(network, None, PCA_matrix, singular_values)
+    if arguments.build_gallery_from is not None:
+        gallery_outputs, gallery_labels = build_gallery_from_folder(service, arguments.build_gallery_from,
+                                                                    arguments.gallery_outputs,
+                                                                    arguments.gallery_labels)
+    else:
+        gallery_outputs, gallery_labels = spoc.read_spocs_and_labels(arguments.gallery_outputs,
+                                                                     arguments.gallery_labels)
+    check_gallery_width(service, gallery_outputs)
+    if arguments.gallery_index is not None:
+        service.gallery = gallery_index.GalleryIndex(arguments.gallery_index, gallery_outputs.size(1))
+        if len(service.gallery) == 0:
+            service.gallery.add(gallery_outputs.cpu().numpy(), gallery_labels.numpy())
+    else:
+        service.gallery = Gallery(gallery_outputs.cuda(), gallery_labels)
+    service.start()
+
+    server = ThreadingHTTPServer(('127.0.0.1', arguments.port), create_request_handler(service))
+    print('retrieval service is listening on http://127.0.0.1:%d' % arguments.port)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    run()
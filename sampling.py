@@ -151,11 +151,16 @@ class UniformSampler(Sampler):
     def __iter__(self):
         if self.several_labels:
             # if we can have several labels for the 1 image we just take the random label
-            train_labels = np.array(self.data_source.train_labels)
-            for i, labels in enumerate(train_labels):
-                number_of_different_labels = labels.shape[0]
-                random_index = np.random.randint(low=0, high=number_of_different_labels)
-                train_labels[i] = labels[random_index]
+            # labels are in the CSR form (omniglot.MultiLabels), so the random label of every image is taken at once
+            multi_labels = self.data_source.train_labels
+            lengths = multi_labels.get_lengths()
+            if np.any(lengths == 0):
+                # positions of the labels are the indices of the images, so images without labels cannot be dropped
+                raise ValueError('%d images have no labels, the first is %d' % (np.sum(lengths == 0),
+                                                                                np.argmax(lengths == 0)))
+            random_positions = multi_labels.offsets[:-1] + \
+                               (np.random.rand(len(multi_labels)) * lengths).astype(np.int64)
+            train_labels = multi_labels.ids[random_positions]
             print('several train_labels', train_labels)
         else:
             train_labels = np.array(self.data_source.train_labels)
@@ -22,6 +22,25 @@ class AllPairs(nn.Module):
             #print('in all pairs self.fc3.weight.data ', self.fc3.weight.data)
             self.fc3.bias.data.fill_(0.0)
 
+    # fc1, fc2 and fc3 are linear, so fc3(fc1(x_1) + fc2(x_2)) = W3 fc1(x_1) + W3 fc2(x_2) + b3,
+    # W3 fc1 and W3 fc2 are computed once for every item and the pair is only the sum of two vectors
+    # of out_features, fc3 is never applied to the in_features wide sums of all pairs
+    def project_first(self, input):
+        return F.linear(self.fc1(input), self.fc3.weight)
+
+    def project_second(self, input):
+        return F.linear(self.fc2(input), self.fc3.weight)
+
+    # returns the same as forward but for already projected halves which can have different sizes,
+    # the rows of the result correspond to input_2 and the columns to input_1
+    def forward_from_projections(self, input_1, input_2):
+        size_1 = input_1.size(0)
+        size_2 = input_2.size(0)
+        all_sums = input_1.unsqueeze(0).expand(size_2, size_1, self.out_features) + \
+                   input_2.unsqueeze(1).expand(size_2, size_1, self.out_features)
+        return all_sums.view(-1, self.out_features) + self.fc3.bias.unsqueeze(0).expand(size_2 * size_1,
+                                                                                        self.out_features)
+
     def forward(self, input):
         #print('input', input)
         # split the input to 2 parts corresponding to 2 different batches
@@ -96,6 +115,12 @@ class EffectiveSimilarityNetwork(nn.Module):
             #print('self.fc3.weight ', self.fc3.weight)
 
 
+    def forward_from_projections(self, projected_1, projected_2):
+        x = F.relu(self.fc1.forward_from_projections(projected_1, projected_2))
+        x = F.relu(self.fc2(x))
+        x = self.fc3(x)
+        return x
+
     def forward(self, x):
         x = F.relu(self.fc1(x))
         #print('x after the all pairs layer', x)
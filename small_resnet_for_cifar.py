@@ -16,7 +16,8 @@ class L2Normalization(nn.Module):
         super(L2Normalization, self).__init__()
 
     def forward(self, input):
-        input = input.squeeze()
+        # flatten instead of squeeze, so that a batch of one vector stays a matrix
+        input = input.view(input.size(0), -1)
         return input.div(torch.norm(input, dim=1).view(-1, 1))
 
     def __repr__(self):
@@ -1,11 +1,18 @@
+import math
+
 import torch
 import torch.nn as nn
-import torchvision.models as models
+import torch.nn.functional as F
 from torch.autograd import Variable
 
 import UKB
+import backbones
+import knn_graph
 import params
+import spoc_extraction
+import streaming_pca
 import test
+import utils
 from small_resnet_for_cifar import L2Normalization
 
 
@@ -17,9 +24,44 @@ def learn_PCA_matrix_for_spocs(spocs, desired_dimension):
     return U[:, :desired_dimension], S[:desired_dimension]
 
 
+class PCAWhiteningL2Normalization(nn.Module):
+    """Projection, whitening and L2 - normalization as one matrix multiplication followed by the normalization
+    Arguments:
+        PCA_matrix (Tensor) : input_dimension x output_dimension, the first columns of U of spocs^T
+        singular_values (Tensor) : output_dimension singular values of spocs^T
+    The whitening is folded into the matrix, so it is applied to the small matrix once and not to every output.
+    """
+
+    def __init__(self, PCA_matrix=None, singular_values=None, input_dimension=None, output_dimension=None):
+        super(PCAWhiteningL2Normalization, self).__init__()
+        if PCA_matrix is not None:
+            whitening = torch.div(PCA_matrix, singular_values.view(1, -1).expand_as(PCA_matrix))
+        else:
+            # the values come from the checkpoint
+            whitening = torch.zeros(input_dimension, output_dimension)
+        self.whitening = nn.Parameter(whitening.contiguous(), requires_grad=False)
+
+    def forward(self, input):
+        output = torch.mm(input.view(input.size(0), -1), self.whitening)
+        norms = torch.norm(output, p=2, dim=1, keepdim=True).expand_as(output)
+        if output.requires_grad:
+            return output / norms
+        # the output is normalized in place, there is no second matrix of the same size
+        return output.div_(norms)
+
+    def __repr__(self):
+        return self.__class__.__name__ + ' (%d -> %d)' % (self.whitening.size(0), self.whitening.size(1))
+
+
+# projection, whitening and L2 - normalization
+def apply_PCA_to_spocs(spocs, PCA_matrix, singular_values):
+    head = PCAWhiteningL2Normalization(PCA_matrix, singular_values)
+    return head(Variable(spocs, volatile=True)).data
+
+
 # outputs is a Tensor with the shape batch_size x 512 x 37 x 37
 # we should return the Tensor of size batch_size x 256
-def compute_spoc_by_outputs(outputs, test_or_train):
+def compute_sum_pooled_spoc_by_outputs(outputs, test_or_train):
     batch_size = outputs.size(0)
     desired_representation_length = outputs.size(1)
     # sum pooling
@@ -30,9 +72,188 @@ def compute_spoc_by_outputs(outputs, test_or_train):
     return spocs
 
 
+##################################################################
+#
+# Regional pooling with integral images
+#
+##################################################################
+
+# Particular object retrieval with integral max-pooling of CNN activations, Tolias et al.
+# https://arxiv.org/abs/1511.05879
+# square regions of params.number_of_levels_for_regions levels with about 40% overlap,
+# every region is (y, x, height, width) in the cells of the feature map
+def get_rmac_regions(height, width, number_of_levels=None, overlap=0.4):
+    if number_of_levels is None:
+        number_of_levels = params.number_of_levels_for_regions
+    side = min(height, width)
+    # additional regions along the longer side, so that the regions cover it with the desired overlap
+    additional = 0
+    if height != width:
+        steps = range(1, 7)
+        step_sizes = [(max(height, width) - side) / float(number_of_steps) for number_of_steps in steps]
+        additional = steps[min(range(len(steps)),
+                               key=lambda i: abs((side * side - side * step_sizes[i]) / float(side * side) - overlap))]
+    additional_along_width = additional if width > height else 0
+    additional_along_height = additional if height > width else 0
+
+    regions = [(0, 0, height, width)]
+    for level in range(1, number_of_levels + 1):
+        region_side = int(math.floor(2.0 * side / (level + 1)))
+        if region_side == 0:
+            break
+        number_along_width = level + additional_along_width
+        number_along_height = level + additional_along_height
+        step_along_width = (width - region_side) / float(number_along_width - 1) if number_along_width > 1 else 0
+        step_along_height = (height - region_side) / float(number_along_height - 1) if number_along_height > 1 else 0
+        for i in range(number_along_height):
+            for j in range(number_along_width):
+                regions.append((int(math.floor(i * step_along_height)), int(math.floor(j * step_along_width)),
+                                region_side, region_side))
+    return regions
+
+
+# regions are computed once for every size of the feature map
+regions_for_sizes = {}
+
+
+def get_regions_for_size(height, width):
+    if (height, width) not in regions_for_sizes:
+        regions_for_sizes[(height, width)] = get_rmac_regions(height, width)
+    return regions_for_sizes[(height, width)]
+
+
+# integral image of outputs ^ p with zero first row and column, the shape is batch_size x C x (H + 1) x (W + 1),
+# p = 1 gives sum pooling and large p gives the generalized mean which is close to max pooling
+def get_integral_images(outputs, p=1):
+    if p != 1:
+        outputs = torch.clamp(outputs, min=params.eps_for_gem).pow(p)
+    integral_images = torch.cumsum(torch.cumsum(outputs, dim=2), dim=3)
+    return F.pad(integral_images, (1, 0, 1, 0))
+
+
+# the sum over every region is 4 reads of the integral image: I[y2, x2] - I[y1, x2] - I[y2, x1] + I[y1, x1],
+# the reads of all regions are done with one index_select on the flattened integral images
+def get_indices_of_corners(regions, width_of_integral_image, cuda):
+    corners = []
+    for y, x, height, width in regions:
+        corners.append([(y + height) * width_of_integral_image + x + width,
+                        y * width_of_integral_image + x + width,
+                        (y + height) * width_of_integral_image + x,
+                        y * width_of_integral_image + x])
+    indices = torch.LongTensor(corners).view(-1)
+    if cuda:
+        indices = indices.cuda()
+    return Variable(indices)
+
+
+# returns batch_size x number_of_regions x C: sums (p = 1) or generalized means (p > 1) of the regions
+def pool_regions(outputs, regions=None, p=1):
+    batch_size, number_of_channels, height, width = outputs.size()
+    if regions is None:
+        regions = get_regions_for_size(height, width)
+    integral_images = get_integral_images(outputs, p).contiguous().view(batch_size, number_of_channels, -1)
+    indices = get_indices_of_corners(regions, width + 1, outputs.is_cuda)
+    corners = integral_images.index_select(2, indices).view(batch_size, number_of_channels, len(regions), 4)
+    sums = corners[:, :, :, 0] - corners[:, :, :, 1] - corners[:, :, :, 2] + corners[:, :, :, 3]
+    if p != 1:
+        areas = torch.Tensor([float(height * width) for _, _, height, width in regions])
+        if outputs.is_cuda:
+            areas = areas.cuda()
+        means = sums / Variable(areas).view(1, 1, -1).expand_as(sums)
+        sums = torch.clamp(means, min=params.eps_for_gem).pow(1.0 / p)
+    return sums.transpose(1, 2).contiguous()
+
+
+# every region vector is L2 - normalized and optionally PCA - whitened and normalized again,
+# then regions are summed and the result is L2 - normalized, all regions of the batch are processed at once
+def aggregate_regional_descriptors(regional_descriptors, PCA_matrix=None, singular_values=None):
+    batch_size, number_of_regions, number_of_channels = regional_descriptors.size()
+    normalization = L2Normalization()
+    regional_descriptors = normalization(regional_descriptors.view(-1, number_of_channels))
+    if PCA_matrix is not None:
+        regional_descriptors = PCAWhiteningL2Normalization(PCA_matrix, singular_values)(regional_descriptors)
+    aggregated = torch.sum(regional_descriptors.view(batch_size, number_of_regions, -1), dim=1)
+    return normalization(aggregated)
+
+
+def compute_regional_spoc_by_outputs(outputs, test_or_train, PCA_matrix=None, singular_values=None):
+    regional_descriptors = pool_regions(outputs, p=params.p_for_gem)
+    return aggregate_regional_descriptors(regional_descriptors, PCA_matrix, singular_values)
+
+
+def compute_max_pooled_spoc_by_outputs(outputs, test_or_train):
+    batch_size = outputs.size(0)
+    max_pooled, _ = torch.max(outputs.view(batch_size, outputs.size(1), -1), dim=2)
+    normalization = L2Normalization()
+    return normalization(max_pooled)
+
+
+def compute_gem_by_outputs(outputs, test_or_train):
+    # the whole map is the only region
+    _, _, height, width = outputs.size()
+    return aggregate_regional_descriptors(pool_regions(outputs, regions=[(0, 0, height, width)], p=params.p_for_gem))
+
+
+# the descriptor which is used in the extraction, it is then PCA - whitened and L2 - normalized
+def compute_spoc_by_outputs(outputs, test_or_train, pooling=None):
+    if pooling is None:
+        pooling = params.pooling
+    if pooling == 'sum':
+        return compute_sum_pooled_spoc_by_outputs(outputs, test_or_train)
+    if pooling == 'max':
+        return compute_max_pooled_spoc_by_outputs(outputs, test_or_train)
+    if pooling == 'gem':
+        return compute_gem_by_outputs(outputs, test_or_train)
+    if pooling == 'regional':
+        return compute_regional_spoc_by_outputs(outputs, test_or_train)
+    raise Exception('You should use sum, max, gem or regional pooling!')
+
+
+class SpocExtractor(nn.Module):
+    """Images -> SPoCs after PCA - whitening and L2 - normalization in one forward call
+    Arguments:
+        backbone : truncated VGG16 from backbones.create_vgg16_features
+        head (PCAWhiteningL2Normalization) : learned PCA - whitening
+        number_of_layers (int) : number of layers of VGG16 in the backbone
+        pooling (string) : 'sum', 'max', 'gem' or 'regional', see compute_spoc_by_outputs
+    """
+
+    def __init__(self, backbone, head, number_of_layers=29, pooling=None):
+        super(SpocExtractor, self).__init__()
+        self.backbone = backbone
+        self.head = head
+        self.number_of_layers = number_of_layers
+        self.pooling = pooling if pooling is not None else params.pooling
+
+    def get_configuration(self):
+        return {'number_of_layers': self.number_of_layers,
+                'pooling': self.pooling,
+                'input_dimension': self.head.whitening.size(0),
+                'output_dimension': self.head.whitening.size(1)}
+
+    def forward(self, images):
+        spocs = compute_spoc_by_outputs(self.backbone(images), 'test', pooling=self.pooling)
+        return self.head(spocs)
+
+
+# the extractor is created from the configuration saved with it, the weights of the backbone are in the checkpoint
+def load_spoc_extractor(filename):
+    checkpoint = torch.load(filename, map_location=lambda storage, location: storage)
+    configuration = checkpoint['configuration']
+    extractor = SpocExtractor(backbones.create_vgg16_features(configuration['number_of_layers'], pretrained=False),
+                              PCAWhiteningL2Normalization(input_dimension=configuration['input_dimension'],
+                                                          output_dimension=configuration['output_dimension']),
+                              number_of_layers=configuration['number_of_layers'],
+                              pooling=configuration['pooling'])
+    extractor.load_state_dict(checkpoint['state_dict'])
+    print('=> loaded SPoC extractor ', filename, ' ', configuration)
+    return extractor
+
+
 def save_all_spocs_and_labels(test_loader, network, file_spoc, file_labels, test_or_train):
-    all_spocs = torch.cuda.FloatTensor()
-    all_labels = torch.LongTensor()
+    # batches are concatenated once at the end instead of copying everything for every batch
+    all_spocs = []
+    all_labels = []
     progress = 0
     for data in test_loader:
         progress = progress + 1
@@ -44,9 +265,11 @@ def save_all_spocs_and_labels(test_loader, network, file_spoc, file_labels, test
 
         spocs = compute_spoc_by_outputs(outputs, test_or_train)
         #print('spocs ', spocs)
-        all_spocs = torch.cat((all_spocs, spocs.data), dim=0)
-        all_labels = torch.cat((all_labels, labels), dim=0)
+        all_spocs.append(spocs.data)
+        all_labels.append(labels)
         #print('all_spocs ', all_spocs)
+    all_spocs = torch.cat(all_spocs, dim=0)
+    all_labels = torch.cat(all_labels, dim=0)
     print('all_spocs', all_spocs)
     print('all_labels', all_labels)
     torch.save(all_spocs, file_spoc)
@@ -62,53 +285,83 @@ def read_spocs_and_labels(file_spoc, file_labels):
     return all_spocs, all_labels
 
 
+# train SPoCs are extracted without PCA to learn it, test SPoCs are projected during the extraction,
+# PCA is kept next to the train SPoCs and is learned again only if the train SPoCs are extracted again
+def extract_spocs_with_PCA_to_memmaps(train_loader, test_loader, representation_network):
+    all_spocs_train, all_labels_train = spoc_extraction.extract_spocs_and_labels_to_memmap(
+        train_loader.dataset, representation_network, 'spocs_train', 'train')
+    PCA_matrix, singular_values = spoc_extraction.read_PCA('spocs_train')
+    if PCA_matrix is None:
+        # PCA is learned by batches read from the memmap, the full D x N matrix is not decomposed
+        all_spocs_memmap, _ = spoc_extraction.open_finished_memmaps('spocs_train')
+        PCA_matrix, singular_values = streaming_pca.learn_PCA_matrix(all_spocs_memmap, params.spoc_dimension_after_PCA)
+        spoc_extraction.write_PCA('spocs_train', PCA_matrix, singular_values)
+    PCA_matrix = PCA_matrix.cuda()
+    singular_values = singular_values.cuda()
+    all_spocs_train = apply_PCA_to_spocs(all_spocs_train.cuda(), PCA_matrix, singular_values)
+
+    all_spocs_test, all_labels_test = spoc_extraction.extract_spocs_and_labels_to_memmap(
+        test_loader.dataset, representation_network, 'spocs_test_after_pca', 'test',
+        PCA_matrix=PCA_matrix, singular_values=singular_values)
+    return all_spocs_train, all_labels_train, all_spocs_test.cuda(), all_labels_test, PCA_matrix, singular_values
+
+
+def create_representation_network():
+    # VGG16 up to the last convolutional layer, the classifier and the last max pooling are not created
+    representation_network = backbones.create_vgg16_features(number_of_layers=29).cuda()
+    return representation_network
+
+
 def get_spoc():
     #train_loader, test_loader = birds.download_BIRDS_for_representation(data_folder='CUB_200_2011')
 
     train_loader, test_loader = UKB.download_UKB_for_representation(data_folder='ukbench/full')
 
 
-    # this magic code allows us to take the network up to the specific layer even if this layer has no it's own name
-    # here 19 is a number of the desired level in the initial pretrained network
-    vgg = models.vgg16(pretrained=True)
-    print('full vgg ', vgg)
-    representation_network = nn.Sequential(*list(vgg.features.children())[:29]).cuda()
+    representation_network = create_representation_network()
 
     # batch_size x 512 x 18 x 18 should be batch_size x 512 x 37 x 37
     print('next(representation_network ', representation_network)
-    all_spocs_train, all_labels_train = save_all_spocs_and_labels(train_loader, representation_network,
-                                                      'all_spocs_file_train', 'all_labels_file_train', 'train')
+    if params.use_memmap_spoc_extraction:
+        all_spocs_train, all_labels_train, all_spocs_test, all_labels_test, PCA_matrix, singular_values = \
+            extract_spocs_with_PCA_to_memmaps(train_loader, test_loader, representation_network)
+    else:
+        all_spocs_train, all_labels_train = save_all_spocs_and_labels(train_loader, representation_network,
+                                                          'all_spocs_file_train', 'all_labels_file_train', 'train')
 
-    all_spocs_test, all_labels_test = save_all_spocs_and_labels(test_loader, representation_network,
-                                                      'all_spocs_file_test', 'all_labels_file_test', 'test')
+        all_spocs_test, all_labels_test = save_all_spocs_and_labels(test_loader, representation_network,
+                                                          'all_spocs_file_test', 'all_labels_file_test', 'test')
 
-    all_spocs_train, all_labels_train = read_spocs_and_labels('all_spocs_file_train', 'all_labels_file_train')
-    all_spocs_test, all_labels_test = read_spocs_and_labels('all_spocs_file_test', 'all_labels_file_test')
+        all_spocs_train, all_labels_train = read_spocs_and_labels('all_spocs_file_train', 'all_labels_file_train')
+        all_spocs_test, all_labels_test = read_spocs_and_labels('all_spocs_file_test', 'all_labels_file_test')
 
-    # PCA
-    PCA_matrix, singular_values = learn_PCA_matrix_for_spocs(all_spocs_train, 256)
-    torch.save(PCA_matrix, 'PCA_matrix')
-    torch.save(singular_values, 'singular_values')
+        # PCA
+        PCA_matrix, singular_values = learn_PCA_matrix_for_spocs(all_spocs_train, params.spoc_dimension_after_PCA)
+        torch.save(PCA_matrix, 'PCA_matrix')
+        torch.save(singular_values, 'singular_values')
 
-    all_spocs_train = torch.div(torch.mm(all_spocs_train, PCA_matrix), singular_values)
-    all_spocs_test = torch.div(torch.mm(all_spocs_test, PCA_matrix), singular_values)
+        all_spocs_train = apply_PCA_to_spocs(all_spocs_train, PCA_matrix, singular_values)
+        all_spocs_test = apply_PCA_to_spocs(all_spocs_test, PCA_matrix, singular_values)
 
     print('all_spocs_train_after_pca', all_spocs_train)
 
-    # L2 - normalization
-    normalization = L2Normalization()
-    all_spocs_train = normalization(Variable(all_spocs_train)).data
-    all_spocs_test = normalization(Variable(all_spocs_test)).data
-
     torch.save(all_spocs_train, 'all_spocs_file_train_after_pca')
     torch.save(all_spocs_test, 'all_spocs_file_test_after_pca')
 
+    # the backbone with PCA inside is all the online embedding of queries needs
+    head = PCAWhiteningL2Normalization(PCA_matrix, singular_values).cuda()
+    utils.save_extractor_checkpoint(SpocExtractor(representation_network, head), params.spoc_extractor_checkpoint)
+
     print("Evaluation on train")
     test.full_test_for_representation(k=params.k_for_recall,
                                       all_outputs=all_spocs_train, all_labels=all_labels_train)
     print("Evaluation on test")
     test.full_test_for_representation(k=params.k_for_recall,
                                       all_outputs=all_spocs_test, all_labels=all_labels_test)
+    if params.reranking != 'none':
+        print("Evaluation on test with reranking")
+        knn_graph.test_with_reranking_for_representation(k=params.k_for_recall,
+                                                         all_outputs=all_spocs_test, all_labels=all_labels_test)
 
 
 # get_spoc()
\ No newline at end of file
@@ -0,0 +1,186 @@
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+import torch
+import torch.utils.data as data
+from torch.autograd import Variable
+from torch.utils.data.sampler import Sampler
+
+import bucketing
+import params
+import spoc
+
+
+# indices from start to the end of the dataset in order, so the extraction continues where it stopped
+class SequentialSamplerFrom(Sampler):
+    def __init__(self, data_source, start):
+        self.data_source = data_source
+        self.start = start
+
+    def __iter__(self):
+        return iter(range(self.start, len(self.data_source)))
+
+    def __len__(self):
+        return len(self.data_source) - self.start
+
+
+def get_paths(prefix):
+    return prefix + '.spocs', prefix + '.labels', prefix + '.manifest'
+
+
+def read_manifest(prefix):
+    _, _, manifest_path = get_paths(prefix)
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, 'r') as f:
+        return json.load(f)
+
+
+# the manifest is written after the memmaps are flushed and is replaced atomically,
+# so the number of done items in it never counts items which are not on disk
+def write_manifest(prefix, manifest):
+    _, _, manifest_path = get_paths(prefix)
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump(manifest, f)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+
+# everything which changes the feature maps: the images, their sizes and the backbone with its weights
+def get_feature_maps_fingerprint(dataset, network):
+    sha1 = hashlib.sha1()
+    paths = dataset.train_images if dataset.train else dataset.test_images
+    sha1.update('\n'.join(str(path) for path in paths).encode('utf-8'))
+    settings = [params.initial_image_size, params.initial_image_scale_size, params.use_jpeg_draft]
+    sha1.update(repr(settings).encode('utf-8'))
+    sha1.update(str(network).encode('utf-8'))
+    for name, value in sorted(network.state_dict().items()):
+        sha1.update(name.encode('utf-8'))
+        sha1.update(value.cpu().numpy().tobytes())
+    return sha1.hexdigest()
+
+
+# everything which changes the SPoCs: the feature maps, the pooling, the buckets and PCA,
+# so the finished or half - done memmaps of another dataset or another configuration are never reused
+def get_fingerprint(dataset, network, test_or_train, PCA_matrix=None, singular_values=None):
+    sha1 = hashlib.sha1(get_feature_maps_fingerprint(dataset, network).encode('utf-8'))
+    settings = [test_or_train, params.pooling, params.p_for_gem, params.eps_for_gem,
+                params.number_of_levels_for_regions, params.use_buckets_for_spoc_extraction,
+                params.max_side_for_buckets, params.step_for_buckets]
+    sha1.update(repr(settings).encode('utf-8'))
+    for tensor in [PCA_matrix, singular_values]:
+        if tensor is not None:
+            sha1.update(tensor.cpu().numpy().tobytes())
+    return sha1.hexdigest()
+
+
+def open_memmaps(prefix, number_of_items, dimension, mode):
+    spocs_path, labels_path, _ = get_paths(prefix)
+    all_spocs = np.memmap(spocs_path, dtype=np.float32, mode=mode, shape=(number_of_items, dimension))
+    all_labels = np.memmap(labels_path, dtype=np.int64, mode=mode, shape=(number_of_items,))
+    return all_spocs, all_labels
+
+
+# SPoCs of all the images of the dataset are written to the preallocated memmap file prefix.spocs and
+# labels to prefix.labels, prefix.manifest keeps the progress, so an interrupted extraction is resumed
+# from the last flushed item, if the manifest has the same fingerprint (see get_fingerprint).
+# If PCA_matrix is given, SPoCs are stored after PCA - whitening.
+# With params.use_buckets_for_spoc_extraction images are not cropped and go in the order of the buckets,
+# but SPoCs are still written at the indices of their images.
+def extract_spocs_and_labels_to_memmap(dataset, network, prefix, test_or_train, PCA_matrix=None,
+                                       singular_values=None):
+    number_of_items = len(dataset)
+    dimension = PCA_matrix.size(1) if PCA_matrix is not None else params.spoc_dimension
+    manifest = read_manifest(prefix)
+    expected = {'number_of_items': number_of_items, 'dimension': dimension, 'pca': PCA_matrix is not None,
+                'buckets': params.use_buckets_for_spoc_extraction,
+                'fingerprint': get_fingerprint(dataset, network, test_or_train, PCA_matrix, singular_values)}
+    if manifest is not None and all(manifest.get(key) == value for key, value in expected.items()):
+        print('resume extraction of ', prefix, ' from item ', manifest['number_of_done_items'])
+        all_spocs, all_labels = open_memmaps(prefix, number_of_items, dimension, 'r+')
+    else:
+        if manifest is not None:
+            print('manifest of ', prefix, ' does not match the dataset or the configuration, extract again')
+        manifest = dict(expected, number_of_done_items=0)
+        all_spocs, all_labels = open_memmaps(prefix, number_of_items, dimension, 'w+')
+        write_manifest(prefix, manifest)
+
+    start = manifest['number_of_done_items']
+    if params.use_buckets_for_spoc_extraction:
+        # the order of the buckets is deterministic, so the first done items of it are skipped
+        loader = bucketing.create_bucket_loader(bucketing.create_bucketed_images(dataset), start=start)
+    else:
+        loader = data.DataLoader(dataset,
+                                 batch_size=params.batch_size_for_spoc_extraction,
+                                 sampler=SequentialSamplerFrom(dataset, start),
+                                 num_workers=params.number_of_workers_for_spoc_extraction)
+    start_time = time.time()
+    position = start
+    for batch_number, batch in enumerate(loader, 1):
+        images, labels = batch[0], batch[1]
+        if params.use_buckets_for_spoc_extraction:
+            indices = batch[2].numpy()
+        else:
+            indices = np.arange(position, position + images.size(0))
+        outputs = network(Variable(images, volatile=True).cuda())
+        spocs = spoc.compute_spoc_by_outputs(outputs, test_or_train).data
+        if PCA_matrix is not None:
+            spocs = spoc.apply_PCA_to_spocs(spocs, PCA_matrix, singular_values)
+        all_spocs[indices] = spocs.cpu().numpy()
+        all_labels[indices] = labels.numpy()
+        position = position + spocs.size(0)
+
+        if batch_number % params.spoc_extraction_flush_every_batches == 0 or position == number_of_items:
+            all_spocs.flush()
+            all_labels.flush()
+            manifest['number_of_done_items'] = position
+            write_manifest(prefix, manifest)
+            print('progress %d / %d, %f images/s' % (position, number_of_items,
+                                                     (position - start) / (time.time() - start_time)))
+    del all_spocs, all_labels
+    return read_spocs_and_labels_from_memmap(prefix)
+
+
+def open_finished_memmaps(prefix):
+    manifest = read_manifest(prefix)
+    if manifest is None or manifest['number_of_done_items'] != manifest['number_of_items']:
+        raise Exception('Extraction of %s is not finished!' % prefix)
+    return open_memmaps(prefix, manifest['number_of_items'], manifest['dimension'], 'r')
+
+
+# PCA learned on the finished SPoCs of prefix is kept in prefix.PCA_matrix and prefix.singular_values,
+# the manifest keeps the fingerprint of the SPoCs it was learned on, so PCA of other SPoCs is never loaded
+def get_PCA_paths(prefix):
+    return prefix + '.PCA_matrix', prefix + '.singular_values'
+
+
+def get_PCA_settings(manifest, dimension=None, method=None):
+    return {'fingerprint': manifest['fingerprint'],
+            'dimension': dimension if dimension is not None else params.spoc_dimension_after_PCA,
+            'method': method if method is not None else params.PCA_method}
+
+
+def read_PCA(prefix):
+    manifest = read_manifest(prefix)
+    PCA_matrix_path, singular_values_path = get_PCA_paths(prefix)
+    if manifest is None or manifest.get('PCA') != get_PCA_settings(manifest) or \
+            not os.path.exists(PCA_matrix_path) or not os.path.exists(singular_values_path):
+        return None, None
+    return torch.load(PCA_matrix_path), torch.load(singular_values_path)
+
+
+def write_PCA(prefix, PCA_matrix, singular_values, dimension=None, method=None):
+    manifest = read_manifest(prefix)
+    PCA_matrix_path, singular_values_path = get_PCA_paths(prefix)
+    torch.save(PCA_matrix, PCA_matrix_path)
+    torch.save(singular_values, singular_values_path)
+    # the manifest is written after the files, so it never points to PCA which is not on disk
+    manifest['PCA'] = get_PCA_settings(manifest, dimension, method)
+    write_manifest(prefix, manifest)
+
+
+def read_spocs_and_labels_from_memmap(prefix):
+    all_spocs, all_labels = open_finished_memmaps(prefix)
+    return torch.from_numpy(np.array(all_spocs)), torch.from_numpy(np.array(all_labels))
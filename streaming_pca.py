@@ -0,0 +1,116 @@
+import argparse
+import resource
+import time
+
+import numpy as np
+import torch
+
+import params
+import spoc
+import spoc_extraction
+
+
+# spoc.learn_PCA_matrix_for_spocs takes the left singular vectors of spocs^T, which are the eigenvectors of
+# the uncentered D x D matrix spocs^T spocs, and the singular values are the square roots of its eigenvalues,
+# so the same PCA is learned from this matrix accumulated by batches of any number of SPoCs
+def get_batches(spocs, batch_size=None):
+    if batch_size is None:
+        batch_size = params.batch_size_for_PCA
+    for start in range(0, spocs.shape[0], batch_size):
+        batch = spocs[start:start + batch_size]
+        if hasattr(batch, 'cpu'):
+            batch = batch.cpu().numpy()
+        yield np.asarray(batch, dtype=np.float64)
+
+
+def accumulate_gram_matrix(spocs):
+    gram = None
+    for batch in get_batches(spocs):
+        if gram is None:
+            gram = np.zeros((batch.shape[1], batch.shape[1]), dtype=np.float64)
+        gram += batch.T.dot(batch)
+    return gram
+
+
+def get_PCA_from_eigenvalues(eigenvalues, eigenvectors, desired_dimension):
+    # eigenvalues go from the largest as singular values of torch.svd
+    order = np.argsort(-eigenvalues)[:desired_dimension]
+    singular_values = np.sqrt(np.maximum(eigenvalues[order], 0))
+    return torch.from_numpy(eigenvectors[:, order].astype(np.float32)), \
+           torch.from_numpy(singular_values.astype(np.float32))
+
+
+def learn_PCA_matrix_by_covariance(spocs, desired_dimension):
+    eigenvalues, eigenvectors = np.linalg.eigh(accumulate_gram_matrix(spocs))
+    return get_PCA_from_eigenvalues(eigenvalues, eigenvectors, desired_dimension)
+
+
+# Finding structure with randomness, Halko et al.
+# https://arxiv.org/abs/0909.4061
+# subspace iteration with the D x D matrix which is never built: every product with it is one pass over the batches,
+# it is useful when D is too large for the full matrix
+def learn_PCA_matrix_randomized(spocs, desired_dimension, oversampling=None, number_of_iterations=None):
+    if oversampling is None:
+        oversampling = params.randomized_PCA_oversampling
+    if number_of_iterations is None:
+        number_of_iterations = params.randomized_PCA_number_of_iterations
+    dimension = spocs.shape[1]
+    size_of_subspace = min(desired_dimension + oversampling, dimension)
+    basis, _ = np.linalg.qr(np.random.RandomState(0).standard_normal((dimension, size_of_subspace)))
+    for iteration in range(number_of_iterations + 1):
+        product = np.zeros((dimension, size_of_subspace), dtype=np.float64)
+        for batch in get_batches(spocs):
+            product += batch.T.dot(batch.dot(basis))
+        if iteration < number_of_iterations:
+            basis, _ = np.linalg.qr(product)
+    # Rayleigh - Ritz: eigenvectors of the small projected matrix give the eigenvectors of the full one
+    eigenvalues, small_eigenvectors = np.linalg.eigh(basis.T.dot(product))
+    return get_PCA_from_eigenvalues(eigenvalues, basis.dot(small_eigenvectors), desired_dimension)
+
+
+def learn_PCA_matrix(spocs, desired_dimension, method=None):
+    if method is None:
+        method = params.PCA_method
+    start_time = time.time()
+    if method == 'svd':
+        if not hasattr(spocs, 'cpu'):
+            spocs = torch.from_numpy(np.array(spocs, dtype=np.float32))
+        PCA_matrix, singular_values = spoc.learn_PCA_matrix_for_spocs(spocs, desired_dimension)
+    elif method == 'covariance':
+        PCA_matrix, singular_values = learn_PCA_matrix_by_covariance(spocs, desired_dimension)
+    elif method == 'randomized':
+        PCA_matrix, singular_values = learn_PCA_matrix_randomized(spocs, desired_dimension)
+    else:
+        raise Exception('You should use svd, covariance or randomized PCA!')
+    # ru_maxrss is in kilobytes on linux
+    print('%s PCA for %d x %d SPoCs is learned in %f s, peak memory %f MB' %
+          (method, spocs.shape[0], spocs.shape[1], time.time() - start_time,
+           resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0))
+    return PCA_matrix, singular_values
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Learn PCA of SPoCs extracted to memmaps by spoc_extraction')
+    parser.add_argument('prefix', help='prefix of the memmaps, for example spocs_train')
+    parser.add_argument('--dimension', type=int, default=params.spoc_dimension_after_PCA)
+    parser.add_argument('--method', default=params.PCA_method)
+    parser.add_argument('--compare-with-svd', type=int, default=0,
+                        help='number of SPoCs to compare singular values with torch.svd, 0 for no comparison')
+    arguments = parser.parse_args()
+
+    all_spocs, _ = spoc_extraction.open_finished_memmaps(arguments.prefix)
+    PCA_matrix, singular_values = learn_PCA_matrix(all_spocs, arguments.dimension, method=arguments.method)
+    spoc_extraction.write_PCA(arguments.prefix, PCA_matrix, singular_values, arguments.dimension, arguments.method)
+    print('PCA is saved to ', spoc_extraction.get_PCA_paths(arguments.prefix))
+
+    if arguments.compare_with_svd > 0:
+        subset = all_spocs[:arguments.compare_with_svd]
+        _, svd_singular_values = learn_PCA_matrix(subset, arguments.dimension, method='svd')
+        _, subset_singular_values = learn_PCA_matrix(subset, arguments.dimension, method=arguments.method)
+        print('max relative difference of singular values with svd %f' %
+              float(torch.max(torch.abs(subset_singular_values - svd_singular_values.cpu()) /
+                              torch.clamp(svd_singular_values.cpu(), min=1e-12))))
+
+
+if __name__ == '__main__':
+    main()
@@ -52,6 +52,131 @@ def get_total_fraction_of_correct_labels_and_total_number_of_batches(labels, nei
     return total_fraction_of_correct_labels, total_number_of_batches
 
 
+# the same quantity as total_fraction_of_correct_labels for one batch, but computed at once
+# neighbors_lists is an array number_of_queries x k of the indices in the gallery
+def get_recall_at_k_from_neighbors_lists(neighbors_lists, query_labels, gallery_labels=None):
+    if gallery_labels is None:
+        gallery_labels = query_labels
+    query_labels = np.asarray(query_labels)
+    gallery_labels = np.asarray(gallery_labels)
+    neighbors_labels = gallery_labels[np.asarray(neighbors_lists)]
+    return float(np.mean(neighbors_labels == query_labels.reshape(-1, 1)))
+
+
+def pad_block(block, block_size):
+    # AllPairs layer of the similarity network can work only with two blocks of the same size
+    if block.size(0) == block_size:
+        return block
+    padding = block.new(block_size - block.size(0), block.size(1)).zero_()
+    return torch.cat((block, padding), dim=0)
+
+
+def get_similarity_scores_for_blocks(query_block, gallery_block, similarity_network):
+    number_of_queries = query_block.size(0)
+    number_of_gallery_items = gallery_block.size(0)
+    block_size = max(number_of_queries, number_of_gallery_items)
+    # the output of AllPairs viewed as block_size x block_size has the second half of the input along the rows
+    # and the first half along the columns, so we put the gallery first to have queries in rows
+    similarity_outputs = similarity_network(Variable(torch.cat((pad_block(gallery_block, block_size),
+                                                                pad_block(query_block, block_size)), dim=0),
+                                                     volatile=True))
+    scores = similarity_outputs.data.view(block_size, block_size)
+    return scores[:number_of_queries, :number_of_gallery_items]
+
+
+def get_euclidean_distances_for_blocks(query_block, gallery_block):
+    squared_norms_of_queries = torch.sum(query_block * query_block, dim=1).view(-1, 1)
+    squared_norms_of_gallery = torch.sum(gallery_block * gallery_block, dim=1).view(1, -1)
+    squared_distances = squared_norms_of_queries + squared_norms_of_gallery - 2 * torch.mm(query_block,
+                                                                                          torch.t(gallery_block))
+    return torch.sqrt(torch.clamp(squared_distances, min=0))
+
+
+# returns scores and indices of the k best gallery items for every query in the block, the best go first
+# without similarity network we search by euclidean distance as in get_neighbors_lists,
+# with similarity network larger scores are better for cosine and smaller ones for the other distances
+def get_top_k_for_block(query_block, gallery_outputs, k, similarity_network=None, gallery_block_size=None):
+    if similarity_network is None:
+        largest = False
+        if gallery_block_size is None:
+            gallery_block_size = params.gallery_block_size_for_evaluation
+    else:
+        largest = params.distance_type == 'cosine'
+        gallery_block_size = params.batch_size_for_similarity
+
+    best_scores = None
+    best_indices = None
+    number_of_gallery_items = gallery_outputs.size(0)
+    for start in range(0, number_of_gallery_items, gallery_block_size):
+        gallery_block = gallery_outputs[start:start + gallery_block_size]
+        if similarity_network is None:
+            scores = get_euclidean_distances_for_blocks(query_block, gallery_block)
+        else:
+            scores = get_similarity_scores_for_blocks(query_block, gallery_block, similarity_network)
+        indices = torch.arange(start, start + gallery_block.size(0)).long()
+        if scores.is_cuda:
+            indices = indices.cuda()
+        indices = indices.view(1, -1).expand_as(scores)
+        best_scores, best_indices = merge_top_k(best_scores, best_indices, scores, indices, k, largest)
+
+    return best_scores, best_indices
+
+
+# the same search as get_top_k_for_block with similarity network, but fc1 and fc2 of its AllPairs layer
+# with the weights of its fc3 are already applied to every query and gallery item once
+# (see AllPairs.project_first and project_second)
+def get_top_k_from_projections(projected_queries, projected_gallery, similarity_network, k, largest=True):
+    block_size = params.batch_size_for_similarity
+    all_scores = []
+    all_indices = []
+    for query_start in range(0, projected_queries.size(0), block_size):
+        projected_query_block = projected_queries[query_start:query_start + block_size]
+        best_scores = None
+        best_indices = None
+        for gallery_start in range(0, projected_gallery.size(0), block_size):
+            projected_gallery_block = projected_gallery[gallery_start:gallery_start + block_size]
+            # queries go to the second half, so they are along the rows of the result
+            scores = similarity_network.forward_from_projections(projected_gallery_block,
+                                                                 projected_query_block).data.view(
+                projected_query_block.size(0), projected_gallery_block.size(0))
+            indices = torch.arange(gallery_start, gallery_start + projected_gallery_block.size(0)).long()
+            if scores.is_cuda:
+                indices = indices.cuda()
+            indices = indices.view(1, -1).expand_as(scores)
+            best_scores, best_indices = merge_top_k(best_scores, best_indices, scores, indices, k, largest)
+        all_scores.append(best_scores.cpu())
+        all_indices.append(best_indices.cpu())
+    return torch.cat(all_scores, dim=0).numpy(), torch.cat(all_indices, dim=0).numpy()
+
+
+# merge the top k of the current gallery block with the top k found so far
+def merge_top_k(best_scores, best_indices, scores, indices, k, largest):
+    if best_scores is not None:
+        scores = torch.cat((best_scores, scores), dim=1)
+        indices = torch.cat((best_indices, indices), dim=1)
+    best_scores, positions = torch.topk(scores, min(k, scores.size(1)), dim=1, largest=largest, sorted=True)
+    return best_scores, torch.gather(indices, 1, positions)
+
+
+# serial blocked search which never keeps the full number_of_queries x number_of_gallery_items matrix
+def get_neighbors_lists_by_blocks(k, query_outputs, gallery_outputs=None, similarity_network=None):
+    if gallery_outputs is None:
+        gallery_outputs = query_outputs
+    if similarity_network is None:
+        query_block_size = params.query_block_size_for_evaluation
+    else:
+        query_block_size = params.batch_size_for_similarity
+
+    all_scores = []
+    all_indices = []
+    for start in tqdm(range(0, query_outputs.size(0), query_block_size)):
+        scores, indices = get_top_k_for_block(query_outputs[start:start + query_block_size], gallery_outputs, k,
+                                              similarity_network=similarity_network)
+        all_scores.append(scores.cpu())
+        all_indices.append(indices.cpu())
+    return torch.cat(all_scores, dim=0).numpy(), torch.cat(all_indices, dim=0).numpy()
+
+
 def get_neighbors_lists_from_distances_matrix(distances_matrix, k, distance_type='euclidean'):
     n = distances_matrix.shape[0]
     neighbors_lists = []
@@ -19,6 +19,14 @@ def save_checkpoint(network, optimizer, epoch, filename='checkpoint.pth.tar'):
                 }, filename)
 
 
+# the extractor is saved with its configuration, so it can be created again without params of this run
+def save_extractor_checkpoint(extractor, filename):
+    torch.save({
+                    'configuration': extractor.get_configuration(),
+                    'state_dict': extractor.state_dict()
+                }, filename)
+
+
 def load_network_and_optimizer_from_checkpoint(network, optimizer, epoch, name_prefix_for_saved_model):
     # optionally resume from a checkpoint
     print("=> loading checkpoint")
@@ -37,5 +45,5 @@ def load_network_from_checkpoint(network, epoch, name_prefix_for_saved_model, st
     else:
         checkpoint = torch.load(name_prefix_for_saved_model + '-%d' % epoch)
     network.load_state_dict(checkpoint['state_dict'])
-    print("=> loaded checkpoint '{%s}' (epoch {%d}) stage = %d" % (name_prefix_for_saved_model, epoch, stage))
+    print("=> loaded checkpoint '{%s}' (epoch {%d}) stage = %s" % (name_prefix_for_saved_model, epoch, stage))
     return network
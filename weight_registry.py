@@ -0,0 +1,153 @@
+import argparse
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+import torch
+
+import backbones
+import params
+
+# offsets of the tensors in the weights file are aligned, so every tensor view is aligned too
+ALIGNMENT = 64
+
+
+# the registry is a folder with files named by the sha256 of their content and with name.json for every
+# set of weights, which maps the names of the tensors to their dtypes, shapes and offsets in the file
+def get_path(name, folder=None):
+    if folder is None:
+        folder = params.weight_registry_folder
+    return os.path.join(folder, name)
+
+
+def get_file_sha256(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def register(name, state_dict, folder=None):
+    if folder is None:
+        folder = params.weight_registry_folder
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    tensors = []
+    offset = 0
+    temporary_path = get_path(name + '.weights.tmp', folder)
+    sha256 = hashlib.sha256()
+    with open(temporary_path, 'wb') as f:
+        for tensor_name, tensor in sorted(state_dict.items()):
+            # np.ascontiguousarray would turn 0 - d tensors, e.g. num_batches_tracked, into shape (1,)
+            array = np.require(tensor.cpu().numpy(), requirements='C')
+            padding = b'\0' * ((-offset) % ALIGNMENT)
+            for block in [padding, array.tobytes()]:
+                f.write(block)
+                sha256.update(block)
+            offset = offset + len(padding)
+            tensors.append({'name': tensor_name, 'dtype': array.dtype.str, 'shape': list(tensor.size()),
+                            'offset': offset})
+            offset = offset + array.nbytes
+    file_name = sha256.hexdigest()
+    os.replace(temporary_path, get_path(file_name, folder))
+    # the file is written by us, so it does not need the verification
+    mark_as_verified(file_name, folder)
+    with open(get_path(name + '.json.tmp', folder), 'w') as f:
+        json.dump({'file': file_name, 'tensors': tensors}, f)
+    os.replace(get_path(name + '.json.tmp', folder), get_path(name + '.json', folder))
+    print('weights %s are registered as %s' % (name, file_name))
+    return file_name
+
+
+def get_file_stamp(path):
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+def mark_as_verified(file_name, folder):
+    with open(get_path(file_name + '.verified', folder), 'w') as f:
+        json.dump(get_file_stamp(get_path(file_name, folder)), f)
+
+
+# the hash of the file is checked once, then the file is trusted while its size and time are the same
+def verify(file_name, folder):
+    path = get_path(file_name, folder)
+    verified_path = get_path(file_name + '.verified', folder)
+    if os.path.exists(verified_path):
+        with open(verified_path, 'r') as f:
+            if json.load(f) == get_file_stamp(path):
+                return
+    start_time = time.time()
+    if get_file_sha256(path) != file_name:
+        raise Exception('Weights file %s is corrupted!' % path)
+    mark_as_verified(file_name, folder)
+    print('weights file %s is verified in %f s' % (file_name, time.time() - start_time))
+
+
+def contains(name, folder=None):
+    return os.path.exists(get_path(name + '.json', folder))
+
+
+# tensors are views of the file memory-mapped in the copy-on-write mode: nothing is read until it is used,
+# processes which load the same weights share the same pages, and changes of the tensors never go to the file
+def load_state_dict(name, folder=None):
+    if folder is None:
+        folder = params.weight_registry_folder
+    with open(get_path(name + '.json', folder), 'r') as f:
+        description = json.load(f)
+    verify(description['file'], folder)
+    weights = np.memmap(get_path(description['file'], folder), dtype=np.uint8, mode='c')
+    state_dict = {}
+    for tensor in description['tensors']:
+        dtype = np.dtype(tensor['dtype'])
+        number_of_bytes = int(np.prod(tensor['shape'])) * dtype.itemsize
+        array = weights[tensor['offset']:tensor['offset'] + number_of_bytes].view(dtype).reshape(tensor['shape'])
+        state_dict[tensor['name']] = torch.from_numpy(array)
+    return state_dict
+
+
+# load_state_dict of the network copies the values, here parameters and buffers become the memory-mapped tensors,
+# every parameter and buffer must be in state_dict except those with not_loaded_prefixes, which keep their values,
+# num_batches_tracked of BatchNorm is not in the checkpoints published before it, it keeps its initial value
+# as in load_state_dict of the network
+def assign_state_dict(network, state_dict, not_loaded_prefixes=()):
+    own_state = network.state_dict(keep_vars=True)
+    missing = [name for name in own_state if name not in state_dict and not name.endswith('num_batches_tracked') and
+               not any(name.startswith(prefix) for prefix in not_loaded_prefixes)]
+    if len(missing) > 0:
+        raise Exception('Missing weights %s!' % ', '.join(sorted(missing)))
+    for name, tensor in state_dict.items():
+        if name not in own_state:
+            raise Exception('Unexpected weights %s!' % name)
+        if tuple(own_state[name].size()) != tuple(tensor.size()):
+            raise Exception('Weights %s have the shape %s instead of %s!' % (name, tuple(tensor.size()),
+                                                                          tuple(own_state[name].size())))
+        own_state[name].data = tensor
+    return network
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Register pretrained weights for the offline loading')
+    parser.add_argument('name', help='name of the weights, for example vgg16-features-29')
+    parser.add_argument('state_dict', help='file saved by torch.save(network.state_dict())')
+    parser.add_argument('--backbone', default=None,
+                        help='vgg16-features-N or resnet50-trunk, the tensors of the full pretrained state_dict '
+                             'are selected as the backbone uses them, the name is used if it is one of them')
+    parser.add_argument('--folder', default=params.weight_registry_folder)
+    arguments = parser.parse_args()
+    state_dict = torch.load(arguments.state_dict, map_location=lambda storage, location: storage)
+    backbone = arguments.backbone if arguments.backbone is not None else arguments.name
+    select = backbones.get_selection(backbone)
+    if select is not None:
+        state_dict = backbones.select_state_dict(state_dict, select)
+        print('%d tensors are selected for %s' % (len(state_dict), backbone))
+    elif arguments.backbone is not None:
+        raise Exception('Unknown backbone %s!' % arguments.backbone)
+    register(arguments.name, state_dict, folder=arguments.folder)
+
+
+if __name__ == '__main__':
+    main()